@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the Sql builder, ORM hydration and Db round trips. They run
+offline, Db benchmarks use the sqlite backed fake in test_data.
+
+    python bench_sqlrocks.py -o baseline.json
+    python bench_sqlrocks.py --compare baseline.json --threshold 0.1
+
+Compare mode exits with 1 when a benchmark got slower than the threshold.
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import tempfile
+
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import test_data.fake as fake
+
+from sqlrocks import *
+
+# name => function(rows) returning (callable, calls per timing)
+benches = OrderedDict()
+
+
+def bench(name):
+    def decorator(func):
+        benches[name] = func
+        return func
+    return decorator
+
+
+def where_tree(depth):
+    """
+    Nested AND/OR condition with 2 ** depth leaves
+
+    :param int depth: depth
+    :return: where conditions
+    """
+    if not depth:
+        return [('singer', 'Jay Chou'), ('is_published', '>', 0)]
+    op = 'AND' if depth % 2 else 'OR'
+    return {op: [where_tree(depth - 1), where_tree(depth - 1)]}
+
+
+def song_rows(size):
+    return [{'id': i, 'name': 'song %s' % i, 'singer': 'Jay Chou',
+             'tag': 'Chinese Style R&B', 'is_published': 1}
+            for i in range(size)]
+
+
+class Song(Model):
+    table = 'song'
+
+
+class CompactSong(Model):
+    table = 'song'
+    compact = True
+
+
+@bench('sql_chain')
+def bench_sql_chain(rows):
+    def run():
+        sql = Sql().select(['id', 'name']).fr('song').where(
+            [('singer', 'Jay Chou'), ('is_published', 1)])
+        return sql.order_by('-id').limit(10).sql
+    return run, 10000
+
+
+@bench('where_deep')
+def bench_where_deep(rows):
+    where = where_tree(6)
+    return lambda: Sql.parse_where_cond(where), 1000
+
+
+@bench('where_deep_cold')
+def bench_where_deep_cold(rows):
+    where = where_tree(6)
+
+    def run():
+        Sql.where_cache.clear()
+        return Sql.parse_where_cond(where)
+    return run, 1000
+
+
+@bench('fingerprint')
+def bench_fingerprint(rows):
+    sql = Sql().select().fr('song').where(where_tree(4)).sql
+    return lambda: Sql.fingerprint(sql), 10000
+
+
+@bench('fingerprint_cold')
+def bench_fingerprint_cold(rows):
+    sql = Sql().select().fr('song').where(where_tree(4)).sql
+
+    def run():
+        Sql.fingerprint_cache.clear()
+        return Sql.fingerprint(sql)
+    return run, 1000
+
+
+@bench('vals_1k')
+def bench_vals(rows):
+    data = [tuple(i.values()) for i in song_rows(1000)]
+    cols = list(song_rows(1)[0])
+    return lambda: Sql().insert('song').cols(cols).vals(data).sql, 100
+
+
+@bench('to_obj_dict')
+def bench_to_obj_dict(rows):
+    data = song_rows(rows)
+    return lambda: Song.to_obj(data), 1
+
+
+@bench('to_obj_compact')
+def bench_to_obj_compact(rows):
+    data = song_rows(rows)
+    return lambda: CompactSong.to_obj(data), 1
+
+
+@bench('to_obj_compact_tuple')
+def bench_to_obj_compact_tuple(rows):
+    data = [tuple(i.values()) for i in song_rows(rows)]
+    description = tuple((k,) for k in song_rows(1)[0])
+    return lambda: CompactSong.to_obj(data, description), 1
+
+
+class FakeDb:
+    """
+    Db on a temporary sqlite file, closed and removed at exit
+    """
+    path = None
+    conns = []
+
+    @classmethod
+    def get(cls):
+        if cls.path is None:
+            fd, cls.path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+
+        conn = fake.connect(cls.path)
+        cls.conns.append(conn)
+        return Db(conn, conn.cursor())
+
+    @classmethod
+    def remove(cls):
+        while cls.conns:
+            cls.conns.pop().close()
+
+        if cls.path is not None:
+            os.remove(cls.path)
+            cls.path = None
+
+
+@bench('db_get')
+def bench_db_get(rows):
+    db = FakeDb.get()
+    db.insert_many('song', song_rows(1000))
+    db.commit()
+
+    class DbSong(Song):
+        pass
+
+    DbSong.db = db
+    return lambda: DbSong.get(500), 1000
+
+
+@bench('db_insert_many_1k')
+def bench_db_insert_many(rows):
+    db = FakeDb.get()
+    data = [dict(i, id=None) for i in song_rows(1000)]
+
+    def run():
+        db.insert_many('song', data)
+        db.rocks('DELETE FROM song')
+        db.commit()
+    return run, 10
+
+
+@bench('db_rows_to_columns_10k')
+def bench_db_rows_to_columns(rows):
+    db = FakeDb.get()
+    db.rocks('DELETE FROM song')
+    db.insert_many('song', song_rows(10000))
+    db.commit()
+
+    class DbSong(Song):
+        pass
+
+    DbSong.db = db
+
+    def run():
+        data = DbSong.all(fetch_obj=False)
+        return {k: [i[k] for i in data] for k in data[0]}
+    return run, 5
+
+
+def bench_db_columns(rows):
+    db = FakeDb.get()
+    db.rocks('DELETE FROM song')
+    db.insert_many('song', song_rows(10000))
+    db.commit()
+
+    class DbSong(Song):
+        pass
+
+    DbSong.db = db
+    # tuple rows, fake.Cursor stands in for SSCursor
+    return lambda: DbSong.columns(cursorclass=fake.Cursor), 5
+
+
+if numpy is not None:
+    bench('db_columns_10k')(bench_db_columns)
+
+
+def run_benches(rows, repeat, only=None):
+    """
+    Run the benchmarks
+
+    :param int rows: rows of the hydration benchmarks
+    :param int repeat: timings per benchmark, the best one is kept
+    :param str only: run the benchmarks whose name contains it
+    :return: dict
+    """
+    results = OrderedDict()
+
+    try:
+        for name, func in benches.items():
+            if only and only not in name:
+                continue
+
+            run, number = func(rows)
+            timings = timeit.repeat(run, number=number, repeat=repeat)
+
+            results[name] = {
+                'best': min(timings) / number,
+                'mean': sum(timings) / len(timings) / number,
+                'number': number,
+            }
+    finally:
+        FakeDb.remove()
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'rows': rows,
+        'results': results,
+    }
+
+
+def compare(result, baseline, threshold):
+    """
+    Compare with a baseline
+
+    :param dict result: result of run_benches()
+    :param dict baseline: stored result
+    :param float threshold: allowed slowdown, 0.1 is 10%
+    :return: names of the regressed benchmarks
+    """
+    regressed = []
+    old = baseline['results']
+
+    print('%-24s %12s %12s %8s' % ('benchmark', 'baseline', 'current',
+                                   'ratio'))
+
+    for name, item in result['results'].items():
+        if name not in old:
+            print('%-24s %12s %12.3e %8s' % (name, '-', item['best'], 'new'))
+            continue
+
+        ratio = item['best'] / old[name]['best']
+        flag = ''
+
+        if ratio > 1 + threshold:
+            regressed.append(name)
+            flag = '  REGRESSION'
+
+        print('%-24s %12.3e %12.3e %7.2fx%s' % (
+            name, old[name]['best'], item['best'], ratio, flag))
+
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-o', '--output', help='write the JSON result here')
+    parser.add_argument('--compare', help='baseline JSON to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown ratio, default 0.1')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='rows of the hydration benchmarks')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', help='only names containing it')
+    args = parser.parse_args(argv)
+
+    result = run_benches(args.rows, args.repeat, args.filter)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if compare(result, baseline, args.threshold):
+            return 1
+    elif not args.output:
+        print(json.dumps(result, indent=2))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
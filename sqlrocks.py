@@ -1,28 +1,315 @@
 # -*- coding: utf-8 -*-
 
-from collections import Iterable
+import asyncio
+import datetime
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import re
+import threading
+import time
+import warnings
+
+from itertools import chain
+from contextvars import ContextVar
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from collections import Iterable, OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+from types import FunctionType
+
+
+class LruCache:
+    def __init__(self, maxsize=1024):
+        """
+        Init LruCache instance
+
+        :param int maxsize: max entries, 0 disables the cache
+        :return: LruCache instance
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get value and mark it as recently used
+
+        :param key: key
+        :param default: returned on miss
+        :return: value
+        """
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        try:
+            self.data.move_to_end(key)
+        except KeyError:
+            # evicted by another thread in the meantime
+            pass
+
+        self.hits += 1
+
+        return value
+
+    def set(self, key, value):
+        """
+        Set value, evicting the least recently used entries
+
+        :param key: key
+        :param value: value
+        """
+        if self.maxsize <= 0:
+            return
+
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries and reset counters
+        """
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Cache statistics
+
+        :return: dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+        }
+
+    def __len__(self):
+        return len(self.data)
+
+
+class Cache:
+    """
+    Query result cache backend for Db, entries are tagged with the tables
+    they were read from so a write can drop them
+    """
+
+    def get(self, key):
+        """
+        Get a live entry
+
+        :param Hashable key: key
+        :return: value or None
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, tables=(), ttl=None):
+        """
+        Set entry
+
+        :param Hashable key: key
+        :param value: value
+        :param Iterable tables: tables the value depends on
+        :param float ttl: seconds to live, default the backend's
+        """
+        raise NotImplementedError
+
+    def invalidate(self, table):
+        """
+        Drop the entries depending on a table
+
+        :param str table: table name
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Drop all entries
+        """
+        raise NotImplementedError
+
+
+class MemoryCache(Cache):
+    def __init__(self, maxsize=1024, ttl=60, clock=time.monotonic):
+        """
+        Init MemoryCache instance, an in-process LRU cache with expiry
+
+        :param int maxsize: max entries
+        :param float ttl: default seconds to live, None never expires
+        :param callable clock: time source
+        :return: MemoryCache instance
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        # key => (expires at, value, tables)
+        self.data = OrderedDict()
+        # table => keys
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry[0] is not None and entry[0] <= self.clock():
+                self.pop(key)
+                self.misses += 1
+                return None
+
+            self.data.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def set(self, key, value, tables=(), ttl=None):
+        if self.maxsize <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else self.clock() + ttl
+
+        with self.lock:
+            self.pop(key)
+            self.data[key] = (expires, value, tuple(tables))
+
+            for table in tables:
+                self.tables.setdefault(table, set()).add(key)
+
+            while len(self.data) > self.maxsize:
+                self.pop(next(iter(self.data)))
+
+    def invalidate(self, table):
+        with self.lock:
+            for key in self.tables.pop(table, ()):
+                self.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.tables.clear()
+
+    def pop(self, key):
+        """
+        Remove entry, the lock must be held
+
+        :param Hashable key: key
+        """
+        entry = self.data.pop(key, None)
+
+        if entry is None:
+            return
+
+        for table in entry[2]:
+            keys = self.tables.get(table)
+
+            if keys is not None:
+                keys.discard(key)
+
+                if not keys:
+                    del self.tables[table]
+
+    def info(self):
+        """
+        Cache statistics
+
+        :return: dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+        }
+
+    def __len__(self):
+        return len(self.data)
 
 
 class Sql:
-    def __init__(self, sql='', args=None, db=None):
+    # rendered where conditions keyed by their shape
+    where_cache = LruCache(1024)
+    # sql => (normalized sql, fingerprint)
+    fingerprint_cache = LruCache(4096)
+    # identifiers are kept, string and number literals become placeholders
+    literal_re = re.compile(
+        r"(`[^`]*`)|'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\""
+        r"|(?<![\w.])\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.I)
+    # IN (...) and VALUES (...) placeholder lists of any length
+    placeholders_re = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+    # rows of a multi-row VALUES
+    rows_re = re.compile(r'\(%s, \.\.\.\)(?:\s*,\s*\(%s, \.\.\.\))+')
+    spaces_re = re.compile(r'\s+')
+
+    def __init__(self, sql='', args=None, db=None, model=None):
         """
         Init Sql instance
 
         :param str sql: sql string
         :param list args: sql arguments
         :param Db db: Db instance
+        :param type model: Model class issuing it, reported to hooks
         :return: Sql instance
         """
-        self.sql = sql
+        self._parts = [sql] if sql else []
         self.args = args if args else []
         self.db = db
+        self.model = model
+
+    @property
+    def sql(self):
+        """
+        Sql string, the collected fragments are joined on first access
 
-    def rocks(self):
+        :return: string
+        """
+        parts = self._parts
+
+        if len(parts) > 1:
+            parts[:] = [''.join(parts)]
+
+        return parts[0] if parts else ''
+
+    @sql.setter
+    def sql(self, sql):
+        self._parts = [sql] if sql else []
+
+    def rocks(self, cache=False):
         """
         MAYDAY ROCKS \m/
+
+        :param bool|float cache: read through the Db result cache, a number
+            is the ttl
+        """
+        return self.db.execute(self.sql, self.args, cache, self.model)
+
+    def freeze(self):
+        """
+        Freeze into a reusable template, Param arguments are bound later
+
+        :return: Template instance
         """
-        self.db.rocks(self.sql, self.args)
-        return self.db.cur
+        return Template(self.sql, self.args, self.db)
 
     def select(self, expr='*'):
         """
@@ -33,7 +320,7 @@ class Sql:
         """
         expr, args = Sql.parse_expr(expr)
 
-        self.sql += 'SELECT ' + expr
+        self._parts.append('SELECT ' + expr)
         self.args.extend(args)
 
         return self
@@ -45,11 +332,11 @@ class Sql:
         :param Sql|str|Iterable expr: expression
         :return: Sql instance
         """
-        self.sql += 'DELETE'
+        self._parts.append('DELETE')
 
         if expr:
             expr, args = Sql.parse_expr(expr)
-            self.sql += ' ' + expr
+            self._parts.append(' ' + expr)
             self.args.extend(args)
 
         return self
@@ -63,7 +350,7 @@ class Sql:
         """
         expr, args = Sql.parse_expr(expr)
 
-        self.sql += ' FROM ' + expr
+        self._parts.append(' FROM ' + expr)
         self.args.extend(args)
 
         return self
@@ -75,7 +362,7 @@ class Sql:
         :param str|Iterable expr: expression
         :return: Sql instance
         """
-        self.sql += ' USE INDEX(' + self.add_quote(expr) + ')'
+        self._parts.append(' USE INDEX(' + self.add_quote(expr) + ')')
         return self
 
     def ignore_index(self, expr):
@@ -85,7 +372,7 @@ class Sql:
         :param str|Iterable expr: expression
         :return: Sql instance
         """
-        self.sql += ' IGNORE INDEX(' + self.add_quote(expr) + ')'
+        self._parts.append(' IGNORE INDEX(' + self.add_quote(expr) + ')')
         return self
 
     def join(self, expr):
@@ -95,7 +382,7 @@ class Sql:
         :param str expr: expression
         :return: Sql instance
         """
-        self.sql += ' ' + expr
+        self._parts.append(' ' + expr)
         return self
 
     def where(self, *args, **kwargs):
@@ -110,7 +397,7 @@ class Sql:
         cond_str, cond_args = Sql.parse_where_cond(cond)
 
         if cond_str:
-            self.sql += ' WHERE ' + cond_str
+            self._parts.append(' WHERE ' + cond_str)
         if cond_args:
             self.args.extend(cond_args)
 
@@ -125,7 +412,7 @@ class Sql:
         """
         expr, args = Sql.parse_expr(expr)
 
-        self.sql += ' GROUP BY ' + expr
+        self._parts.append(' GROUP BY ' + expr)
         self.args.extend(args)
 
         return self
@@ -142,7 +429,7 @@ class Sql:
         cond_str, cond_args = Sql.parse_where_cond(cond)
 
         if cond_str:
-            self.sql += ' HAVING ' + cond_str
+            self._parts.append(' HAVING ' + cond_str)
         if cond_args:
             self.args.extend(cond_args)
 
@@ -157,7 +444,8 @@ class Sql:
         """
         expr, args = Sql.parse_expr(expr)
 
-        self.sql += ' ORDER BY ' + expr if expr else ''
+        if expr:
+            self._parts.append(' ORDER BY ' + expr)
         self.args.extend(args)
 
         return self
@@ -171,14 +459,14 @@ class Sql:
         :return: Sql instance
         """
         if isinstance(a, (list, tuple)):
-            self.sql += ' LIMIT %s, %s' % (a[0], a[1])
+            self._parts.append(' LIMIT %s, %s' % (a[0], a[1]))
         else:
             if a is None:
                 pass
             elif b is None:
-                self.sql += ' LIMIT %s' % a
+                self._parts.append(' LIMIT %s' % a)
             else:
-                self.sql += ' LIMIT %s, %s' % (a, b)
+                self._parts.append(' LIMIT %s, %s' % (a, b))
 
         return self
 
@@ -189,7 +477,7 @@ class Sql:
         :param str table: table name
         :return: Sql instance
         """
-        self.sql += 'INSERT INTO `%s`' % table
+        self._parts.append('INSERT INTO `%s`' % table)
         return self
 
     def cols(self, cols):
@@ -199,7 +487,7 @@ class Sql:
         :param str|Iterable cols: expression
         :return: Sql instance
         """
-        self.sql += '(%s)' % Sql.add_quote(cols)
+        self._parts.append('(%s)' % Sql.add_quote(cols))
         return self
 
     def vals(self, *args):
@@ -209,17 +497,29 @@ class Sql:
         :param args: insert values
         :return: Sql instance
         """
-        self.sql += ' VALUES'
+        self._parts.append(' VALUES')
 
         values = args if len(args) > 1 else args[0]
 
         if isinstance(values[0], (list, tuple)):
+            # rows usually share one width, so build its placeholder once
+            placeholders = {}
+            rows = []
+
             for vals in values:
-                self.sql += '(' + ('%s,' * len(vals))[:-1] + '),'
+                size = len(vals)
+                placeholder = placeholders.get(size)
+
+                if placeholder is None:
+                    placeholder = Sql.placeholder(size)
+                    placeholders[size] = placeholder
+
+                rows.append(placeholder)
                 self.args.extend(vals)
-            self.sql = self.sql[0:-1]
+
+            self._parts.append(','.join(rows))
         else:
-            self.sql += '(' + ('%s,' * len(values))[:-1] + ')'
+            self._parts.append(Sql.placeholder(len(values)))
             self.args.extend(values)
 
         return self
@@ -231,24 +531,45 @@ class Sql:
         :param str table: table name
         :return: Sql instance
         """
-        self.sql += 'UPDATE `%s`' % table
+        self._parts.append('UPDATE `%s`' % table)
         return self
 
     def set(self, expr):
-        self.sql += ' SET '
+        self._parts.append(' SET ')
 
         if isinstance(expr, dict):
-            for k in expr:
-                self.sql += '`' + k + '`=%s, '
-                self.args.append(expr[k])
-            self.sql = self.sql[0:-2]
+            self._parts.append(', '.join(['`' + k + '`=%s' for k in expr]))
+            self.args.extend([expr[k] for k in expr])
         else:
             expr, args = Sql.parse_expr(expr)
-            self.sql += expr
+            self._parts.append(expr)
             self.args.extend(args)
 
         return self
 
+    def on_duplicate_key_update(self, expr):
+        """
+        On duplicate key update clause
+
+        :param dict|Sql|str|Iterable expr: dict of new values, expression,
+            or columns taking the inserted VALUES()
+        :return: Sql instance
+        """
+        self._parts.append(' ON DUPLICATE KEY UPDATE ')
+
+        if isinstance(expr, dict):
+            self._parts.append(', '.join(['`' + k + '`=%s' for k in expr]))
+            self.args.extend([expr[k] for k in expr])
+        elif isinstance(expr, (Sql, str)):
+            expr, args = Sql.parse_expr(expr)
+            self._parts.append(expr)
+            self.args.extend(args)
+        else:
+            self._parts.append(', '.join(
+                ['`%s`=VALUES(`%s`)' % (k, k) for k in expr]))
+
+        return self
+
     def alias(self, name):
         """
         Add alias
@@ -256,7 +577,7 @@ class Sql:
         :param str name: name
         :return: Sql Instance
         """
-        self.sql += ' AS `%s`' % name
+        self._parts.append(' AS `%s`' % name)
         return self
 
     def as_subquery(self, alias=None):
@@ -272,6 +593,16 @@ class Sql:
             self.sql = '(%s) AS `%s`' % (self.sql, alias)
         return self
 
+    @staticmethod
+    def placeholder(size):
+        """
+        Values placeholder
+
+        :param int size: number of values
+        :return: string like (%s,%s)
+        """
+        return '(' + ','.join(['%s'] * size) + ')'
+
     @staticmethod
     def add_quote(expr):
         """
@@ -365,23 +696,97 @@ class Sql:
                 # list or tuple
                 cond_str, cond_arg = Sql.parse_cond(val)
                 cond_str_list.append(cond_str)
-
-                if cond_arg is not None:
-                    if isinstance(cond_arg, str):
-                        cond_arg_list.append(cond_arg)
-                    elif isinstance(cond_arg, Iterable):
-                        cond_arg_list.extend(cond_arg)
-                    else:
-                        cond_arg_list.append(cond_arg)
+                Sql.add_cond_arg(cond_arg, cond_arg_list)
 
         conj = ' %s ' % conj
 
         return '(%s)' % conj.join(cond_str_list)
 
+    @staticmethod
+    def add_cond_arg(cond_arg, cond_arg_list):
+        """
+        Add condition argument
+
+        :param cond_arg: condition argument
+        :param list cond_arg_list: condition argument list
+        """
+        if cond_arg is not None:
+            if isinstance(cond_arg, str):
+                cond_arg_list.append(cond_arg)
+            elif isinstance(cond_arg, Iterable):
+                cond_arg_list.extend(cond_arg)
+            else:
+                cond_arg_list.append(cond_arg)
+
+    @staticmethod
+    def where_shape(where_cond, cond_arg_list):
+        """
+        Get the shape of where conditions, i.e. everything the condition
+        string depends on (columns, operators, IN-list lengths, conjunctions)
+        but not the argument values, which are collected on the way
+
+        :param dict where_cond: where conditions
+        :param list cond_arg_list: condition argument list
+        :return: hashable shape and the where conditions, where_cond itself
+            unless an iterator in it was read into a list on the way
+        """
+        conj = next(iter(where_cond))
+        conds = where_cond[conj]
+        copied = not isinstance(conds, (list, tuple))
+
+        if copied:
+            conds = list(conds)
+
+        shape = ['d', conj]
+
+        for i, val in enumerate(conds):
+            if isinstance(val, dict):
+                sub_shape, sub_cond = Sql.where_shape(val, cond_arg_list)
+                shape.append(sub_shape)
+
+                if sub_cond is not val:
+                    if not copied:
+                        conds = list(conds)
+                        copied = True
+                    conds[i] = sub_cond
+            elif isinstance(val, str):
+                shape.append(('s', val))
+            else:
+                # list or tuple, mirrors parse_cond
+                cond_len = len(val)
+                cond_arg = None
+
+                if cond_len == 1:
+                    shape.append(('c', val[0]))
+                elif cond_len == 2:
+                    if isinstance(val[1], Sql):
+                        shape.append(('c', val[0], val[1].sql))
+                        cond_arg = val[1].args
+                    else:
+                        shape.append(('c', val[0], None))
+                        cond_arg = val[1]
+                elif cond_len == 3:
+                    if isinstance(val[2], Sql):
+                        shape.append(('c', val[0], val[1], val[2].sql))
+                        cond_arg = val[2].args
+                    elif val[1].upper() in {'IN', 'NOT IN'}:
+                        shape.append(('c', val[0], val[1], len(val[2])))
+                        cond_arg = val[2]
+                    else:
+                        shape.append(('c', val[0], val[1], None))
+                        cond_arg = val[2]
+                else:
+                    shape.append(('c', len(val)))
+
+                Sql.add_cond_arg(cond_arg, cond_arg_list)
+
+        return tuple(shape), {conj: conds} if copied else where_cond
+
     @staticmethod
     def parse_where_cond(where_cond):
         """
-        parse where conditions
+        parse where conditions, condition strings are cached by shape in
+        Sql.where_cache so repeated shapes only collect their arguments
 
         :param dict|list|tuple|str where_cond: where conditions
         :return: condition string
@@ -397,353 +802,5502 @@ class Sql:
                     where_cond = [where_cond]
                 where_cond = {'AND': where_cond}
 
+            cache = Sql.where_cache
             cond_arg_list = []
-            cond_str = Sql.flatten_where_cond(where_cond, cond_arg_list)
 
-            return cond_str, cond_arg_list
+            if cache.maxsize <= 0:
+                cond_str = Sql.flatten_where_cond(where_cond, cond_arg_list)
+                return cond_str, cond_arg_list
 
-    @property
-    def val(self):
-        return self.sql
+            try:
+                shape, where_cond = Sql.where_shape(where_cond, cond_arg_list)
+                cond_str = cache.get(shape)
+            except TypeError:
+                # unhashable shape, render it the slow way
+                shape = cond_str = None
 
-    def __repr__(self):
-        return self.sql
+            if cond_str is None:
+                cond_arg_list = []
+                cond_str = Sql.flatten_where_cond(where_cond, cond_arg_list)
 
+                if shape is not None:
+                    cache.set(shape, cond_str)
 
-class Db:
-    def __init__(self, conn, cur, debug=False):
+            return cond_str, cond_arg_list
+
+    @staticmethod
+    def normalize(sql):
         """
-        Init Db instance
+        Statement shape: literals become placeholders, placeholder lists and
+        VALUES rows are folded whatever their length, whitespace collapsed
 
-        :param conn: MySQLdb conn
-        :param cur: MySQLdb cursor
-        :param bool debug: default False
-        :return: Db instance
+        :param Sql|str sql: sql
+        :return: str
         """
-        self.conn = conn
-        self.cur = cur
-        self.debug = debug
+        return Sql.fingerprinted(sql)[0]
 
-    def sql(self):
+    @staticmethod
+    def fingerprint(sql):
         """
-        Create a Sql instance
+        Hash of the normalized sql, stable across argument values and
+        IN-list lengths, cached by sql string
 
-        :return: Sql instance
+        :param Sql|str sql: sql
+        :return: 16 hex digits
         """
-        return Sql(db=self)
+        return Sql.fingerprinted(sql)[1]
 
-    def select(self, expr='*'):
+    @staticmethod
+    def fingerprinted(sql):
         """
-        Create a Sql instance
+        Normalized sql and its fingerprint
 
-        :param Sql|str|Iterable expr: expression
-        :return: Sql instance
+        :param Sql|str sql: sql
+        :return: tuple
         """
-        return self.sql().select(expr)
+        if isinstance(sql, Sql):
+            sql = sql.sql
 
-    def count(self, table, where=None):
+        item = Sql.fingerprint_cache.get(sql)
+
+        if item is None:
+            normalized = Sql.literal_re.sub(
+                lambda m: m.group(1) or '%s', sql)
+            normalized = Sql.placeholders_re.sub('(%s, ...)', normalized)
+            normalized = Sql.rows_re.sub('(%s, ...)', normalized)
+            normalized = Sql.spaces_re.sub(' ', normalized).strip()
+
+            digest = hashlib.blake2b(normalized.encode('utf-8'), digest_size=8)
+            item = (normalized, digest.hexdigest())
+
+            Sql.fingerprint_cache.set(sql, item)
+
+        return item
+
+    @staticmethod
+    def and_where(*wheres):
         """
-        Count table
+        Join where conditions with AND
 
-        :param str table: table name
-        :param dict|list|tuple|str where: where conditions
-        :return: int
+        :param dict|list|tuple|str wheres: where conditions
+        :return: where conditions
         """
-        sql = self.select('COUNT(*)').fr('`%s`' % table)
-        result = sql.where(where).rocks().fetchone()
-        return result['COUNT(*)'] if isinstance(result, dict) else result[0]
+        cond_list = []
+
+        for where in wheres:
+            if not where:
+                continue
+            elif isinstance(where, list):
+                # a list of conditions
+                cond_list.extend(where)
+            else:
+                cond_list.append(where)
+
+        return {'AND': cond_list} if cond_list else None
+
+    @property
+    def val(self):
+        return self.sql
+
+    def __repr__(self):
+        return self.sql
 
-    def insert(self, table, data):
+
+class Param:
+    def __init__(self, name):
         """
-        Insert clause
+        Init Param instance, a named argument bound when a template rocks
 
-        :param str table: table name
-        :param dict data: data
-        :return: last row id
+        :param str name: param name
+        :return: Param instance
         """
-        return self.sql().insert(table).set(data).rocks().lastrowid
+        self.name = name
+
+    def __repr__(self):
+        return 'Param(%r)' % self.name
+
 
-    def update(self, table, data, where=None, order_by=None, limit=None):
+class Template:
+    def __init__(self, sql, args=None, db=None):
         """
-        Update clause
+        Init Template instance
 
-        :param str table: table name
-        :param dict data: data
-        :param dict|list|tuple|str where: where conditions
-        :param str|Iterable order_by: order_by
-        :param list|tuple|int|str limit: limit
-        :return: affected rows
+        :param str sql: sql string
+        :param list args: sql arguments, may contain Param instances
+        :param Db db: Db instance
+        :return: Template instance
         """
-        sql = self.sql().update(table).set(data).where(where)
-        return sql.order_by(order_by).limit(limit).rocks().rowcount
+        self.sql = sql
+        self.args = tuple(args) if args else ()
+        self.db = db
+        self.params = [
+            (i, arg.name) for i, arg in enumerate(self.args)
+            if isinstance(arg, Param)
+        ]
 
-    def save(self, table, data, pk, insert=None):
+    def bind(self, *args, **kwargs):
         """
-        Save data
+        Bind param values
 
-        :param str table: table name
-        :param dict data: data
-        :param str pk: primary key
-        :param bool insert: insert
-        :return: last row id or affected rows
+        :param dict args: param values by name, or use kwargs
+        :return: sql arguments
         """
-        if insert or pk not in data:
-            return self.insert(table, data)
-        else:
-            sub_data = {k: data[k] for k in data if k != pk}
-            return self.update(table, sub_data, (pk, data[pk]))
+        values = args[0] if args else kwargs
+        bound = list(self.args)
+
+        for i, name in self.params:
+            bound[i] = values[name]
 
-    def delete(self, table, where=None, order_by=None, limit=None):
+        return bound
+
+    def rocks(self, *args, **kwargs):
         """
-        Delete clause
+        Execute with param values
 
-        :param str table: table name
-        :param dict|list|tuple|str where: where conditions
-        :param str|Iterable order_by: order_by
-        :param list|tuple|int|str limit: limit
-        :return: affected rows
+        :param dict args: param values by name, or use kwargs
         """
-        sql = self.sql().delete().fr('`%s`' % table).where(where)
-        return sql.order_by(order_by).limit(limit).rocks().rowcount
+        return self.db.execute(self.sql, self.bind(*args, **kwargs))
+
+    @property
+    def val(self):
+        return self.sql
+
+    def __repr__(self):
+        return self.sql
 
-    def rocks(self, sql, args=None):
+
+class QueryEvent:
+    def __init__(self, hooks, sql, args=None, model=None, conn=None):
         """
-        Execute sql
+        Init QueryEvent instance, one execution seen by the hooks
 
+        :param list hooks: Hook instances
         :param str sql: sql
         :param Iterable args: args
-        :return:
+        :param type model: Model class issuing it, or None
+        :param conn: connection it ran on when hooks may query it, None for
+            streaming cursors
+        :return: QueryEvent instance
         """
-        if self.debug:
-            print('%s\n%s' % (sql, args))
-        return self.cur.execute(sql, args)
+        self.hooks = hooks
+        self.sql = sql
+        self.args = args
+        self.model = model
+        self.conn = conn
+        self.rowcount = -1
+        self.error = None
+        self.elapsed = None
+        self.started = time.perf_counter()
 
-    def commit(self, *args, **kwargs):
+    @classmethod
+    def start(cls, hooks, sql, args=None, model=None, conn=None):
         """
-        Commit
+        Create the event and run the before hooks
 
-        :param args:
-        :param kwargs:
+        :param list hooks: Hook instances
+        :param str sql: sql
+        :param Iterable args: args
+        :param type model: Model class
+        :param conn: connection it runs on
+        :return: QueryEvent instance
         """
-        self.conn.commit(*args, **kwargs)
+        event = cls(hooks, sql, args, model, conn)
 
-    def rollback(self, *args, **kwargs):
-        """
-        Rollback
+        for hook in hooks:
+            hook.before(event)
 
-        :param args:
-        :param kwargs:
-        """
-        self.conn.rollback(*args, **kwargs)
+        # time the statement, not the hooks
+        event.started = time.perf_counter()
 
-    def close(self, *args, **kwargs):
+        return event
+
+    def finish(self, rowcount=-1):
         """
-        Close connection
+        Run the after hooks
 
-        :param args:
-        :param kwargs:
+        :param int rowcount: rows returned or affected
         """
-        self.conn.close(*args, **kwargs)
+        self.elapsed = time.perf_counter() - self.started
+        self.rowcount = rowcount
 
+        for hook in self.hooks:
+            hook.after(self)
 
-class Model:
-    """:type db: Db"""
-    db = None
+    def fail(self, error):
+        """
+        Run the error hooks
 
-    # table name
-    table = ''
+        :param Exception error: error raised by the driver
+        """
+        self.elapsed = time.perf_counter() - self.started
+        self.error = error
 
-    # primary key
-    pk = 'id'
+        for hook in self.hooks:
+            hook.error(self)
 
-    def __init__(self, *args, **kwargs):
+    @property
+    def fingerprint(self):
         """
-        Init Model instance
+        Fingerprint of the statement, see Sql.fingerprint()
 
-        :return: Model instance
+        :return: str
         """
-        self._row = args[0] if args else kwargs
+        return Sql.fingerprint(self.sql)
+
+    @property
+    def normalized(self):
+        """
+        Statement shape, see Sql.normalize()
+
+        :return: str
+        """
+        return Sql.normalize(self.sql)
+
+
+class Hook:
+    """
+    Callbacks around every statement a Db executes, add with Db.add_hook()
+    """
+
+    def before(self, event):
+        """
+        Called before execution
+
+        :param QueryEvent event: event
+        """
+        pass
+
+    def after(self, event):
+        """
+        Called after a successful execution, event.elapsed and
+        event.rowcount are set
+
+        :param QueryEvent event: event
+        """
+        pass
+
+    def error(self, event):
+        """
+        Called when the execution raised, event.error is set
+
+        :param QueryEvent event: event
+        """
+        pass
+
+
+class QueryStats(Hook):
+    def __init__(self, samples=1000):
+        """
+        Init QueryStats instance, aggregates timings per fingerprint
+
+        :param int samples: latest timings kept per fingerprint for the
+            percentiles
+        :return: QueryStats instance
+        """
+        self.samples = samples
+        # fingerprint => [count, errors, total seconds, rows, timings, models,
+        #                 normalized sql]
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def after(self, event):
+        self.record(event)
+
+    def error(self, event):
+        self.record(event)
+
+    def record(self, event):
+        """
+        Record an execution
+
+        :param QueryEvent event: event
+        """
+        fingerprint = event.fingerprint
+
+        with self.lock:
+            item = self.data.get(fingerprint)
+
+            if item is None:
+                item = self.data[fingerprint] = [
+                    0, 0, 0.0, 0, deque(maxlen=self.samples), set(),
+                    event.normalized]
+
+            item[0] += 1
+            item[2] += event.elapsed
+            item[4].append(event.elapsed)
+
+            if event.error is not None:
+                item[1] += 1
+            elif event.rowcount > 0:
+                item[3] += event.rowcount
+
+            if event.model is not None:
+                item[5].add(event.model.__name__)
+
+    @staticmethod
+    def percentile(timings, q):
+        """
+        Nearest rank percentile
+
+        :param list timings: sorted timings
+        :param float q: percentile, 0 to 100
+        :return: float
+        """
+        if not timings:
+            return 0.0
+        index = int(round(q / 100.0 * (len(timings) - 1)))
+        return timings[index]
+
+    def report(self, top=None):
+        """
+        Aggregated timings, by total time descending
+
+        :param int top: max entries
+        :return: list of dict
+        """
+        with self.lock:
+            items = [(k, v[6], list(v[:4]), sorted(v[4]), sorted(v[5]))
+                     for k, v in self.data.items()]
+
+        result = []
+
+        for fingerprint, sql, (count, errors, total, rows), timings, models \
+                in items:
+            result.append({
+                'fingerprint': fingerprint,
+                'sql': sql,
+                'count': count,
+                'errors': errors,
+                'rows': rows,
+                'total': total,
+                'mean': total / count,
+                'p50': QueryStats.percentile(timings, 50),
+                'p95': QueryStats.percentile(timings, 95),
+                'p99': QueryStats.percentile(timings, 99),
+                'models': models,
+            })
+
+        result.sort(key=lambda i: i['total'], reverse=True)
+
+        return result[:top] if top else result
+
+    def reset(self):
+        """
+        Forget everything
+        """
+        with self.lock:
+            self.data.clear()
+
+
+class SlowLog(Hook):
+    def __init__(self, threshold=1.0, explain=True, interval=60, limit=10,
+                 logger=logging.getLogger('sqlrocks'), maxlen=100,
+                 clock=time.monotonic):
+        """
+        Init SlowLog instance, records the statements slower than threshold
+
+        A statement shape is recorded at most once per interval, and at most
+        limit entries are recorded per interval overall, the others are
+        counted as suppressed.
+
+        :param float threshold: seconds
+        :param bool explain: run EXPLAIN for SELECTs on the same connection
+        :param float interval: seconds
+        :param int limit: max entries per interval
+        :param logging.Logger logger: default the sqlrocks logger, None to
+            only keep the entries
+        :param int maxlen: latest entries kept in self.entries
+        :param clock: time function
+        :return: SlowLog instance
+        """
+        self.threshold = threshold
+        self.explain = explain
+        self.interval = interval
+        self.limit = limit
+        self.logger = logger
+        self.entries = deque(maxlen=maxlen)
+        self.clock = clock
+        # fingerprint => [last recorded, suppressed since]
+        self.seen = LruCache(1024)
+        self.window = (None, 0)
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def after(self, event):
+        if event.elapsed < self.threshold:
+            return
+
+        fingerprint = event.fingerprint
+        now = self.clock()
+
+        with self.lock:
+            seen = self.seen.get(fingerprint)
+
+            if seen is not None and now - seen[0] < self.interval:
+                seen[1] += 1
+                self.suppressed += 1
+                return
+
+            started, count = self.window
+
+            if started is None or now - started >= self.interval:
+                started, count = now, 0
+
+            if count >= self.limit:
+                self.suppressed += 1
+                return
+
+            self.window = (started, count + 1)
+            self.seen.set(fingerprint, [now, 0])
+
+        entry = {
+            'fingerprint': fingerprint,
+            'sql': event.normalized,
+            'elapsed': event.elapsed,
+            'rows': event.rowcount,
+            'model': event.model.__name__ if event.model else None,
+            'suppressed': seen[1] if seen else 0,
+            'explain': self.run_explain(event) if self.explain else None,
+        }
+
+        self.entries.append(entry)
+
+        if self.logger is not None:
+            self.logger.warning(
+                'slow query %.3fs %s explain=%s', entry['elapsed'],
+                entry['sql'], entry['explain'])
+
+    @staticmethod
+    def run_explain(event):
+        """
+        EXPLAIN a SELECT on a new cursor of the connection it ran on
+
+        :param QueryEvent event: event
+        :return: plan rows, None when it can't be explained
+        """
+        if event.conn is None or event.sql.lstrip()[:6].upper() != 'SELECT':
+            return None
+
+        cur = event.conn.cursor()
+
+        try:
+            cur.execute('EXPLAIN ' + event.sql, event.args)
+            return list(cur.fetchall())
+        except Exception:
+            return None
+        finally:
+            cur.close()
+
+
+def driver_cursor(module, name):
+    """
+    Cursor class of the driver, imported on first use. Without the driver
+    it warns and returns None, the connection's cursor, which buffers the
+    whole result client-side.
+
+    :param str module: module of the cursor classes, e.g. MySQLdb.cursors
+    :param str name: class name, e.g. SSDictCursor
+    :return: cursor class or None
+    """
+    try:
+        return getattr(importlib.import_module(module), name)
+    except ImportError:
+        warnings.warn('%s is not installed, set stream_cursor to stream rows '
+                      'unbuffered' % module, RuntimeWarning, stacklevel=4)
+        return None
+
+
+class Db:
+    # tables a statement reads
+    tables_re = re.compile(r'\b(?:FROM|JOIN)\s+`?(\w+)`?', re.I)
+    # driver of the default unbuffered cursors
+    stream_driver = 'MySQLdb.cursors'
+
+    def __init__(self, conn, cur, debug=False, stream_cursor=None,
+                 cache=None):
+        """
+        Init Db instance
+
+        :param conn: MySQLdb conn
+        :param cur: MySQLdb cursor
+        :param bool debug: default False
+        :param stream_cursor: cursor class for streaming, default the
+            driver's unbuffered SSDictCursor
+        :param Cache cache: result cache for queries run with cache=True
+        :return: Db instance
+        """
+        self.conn = conn
+        self.cur = cur
+        self.debug = debug
+        self.stream_cursor = stream_cursor
+        self.cache = cache
+        self.identity = None
+        self.hooks = []
+        # tables written since the last commit
+        self.written_tables = set()
+
+    def add_hook(self, hook):
+        """
+        Add a hook called around every statement
+
+        :param Hook hook: hook
+        :return: hook
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        """
+        Remove a hook
+
+        :param Hook hook: hook
+        """
+        self.hooks.remove(hook)
+
+    def sql(self, model=None):
+        """
+        Create a Sql instance
+
+        :param type model: Model class issuing it
+        :return: Sql instance
+        """
+        return Sql(db=self, model=model)
+
+    def select(self, expr='*'):
+        """
+        Create a Sql instance
+
+        :param Sql|str|Iterable expr: expression
+        :return: Sql instance
+        """
+        return self.sql().select(expr)
+
+    def count(self, table, where=None, cache=False, model=None,
+              approx=False, max=None):
+        """
+        Count table
+
+        :param str table: table name
+        :param dict|list|tuple|str where: where conditions
+        :param bool|float cache: read through the result cache
+        :param type model: Model class issuing it, reported to hooks
+        :param bool approx: estimate from the table statistics, or from
+            EXPLAIN with where, exact when no estimate is available
+        :param int max: stop counting at max rows
+        :return: int
+        """
+        if approx:
+            cur = self.approx_sql(table, where, model).rocks(cache)
+            rows = Db.estimated(cur, cur.fetchone())
+
+            if rows is not None:
+                return rows if max is None else min(rows, max)
+
+        result = self.count_sql(table, where, max, model).rocks(cache)
+        result = result.fetchone()
+        return result['COUNT(*)'] if isinstance(result, dict) else result[0]
+
+    def count_sql(self, table, where=None, max=None, model=None):
+        """
+        Build the count query, with max the rows are counted in a subquery
+        limited to max rows so it stops early
+
+        :param str table: table name
+        :param dict|list|tuple|str where: where conditions
+        :param int max: max rows
+        :param type model: Model class issuing it
+        :return: Sql instance
+        """
+        sql = self.sql(model).select('COUNT(*)')
+
+        if max is None:
+            return sql.fr('`%s`' % table).where(where)
+
+        sub = Sql().select('1').fr('`%s`' % table).where(where).limit(max)
+        return sql.fr(sub.as_subquery('t'))
+
+    def approx_sql(self, table, where=None, model=None):
+        """
+        Build the row estimate query, the table statistics without where
+        and EXPLAIN with it
+
+        :param str table: table name
+        :param dict|list|tuple|str where: where conditions
+        :param type model: Model class issuing it
+        :return: Sql instance
+        """
+        if not where:
+            sql = self.sql(model).select('TABLE_ROWS AS `rows`')
+            return sql.fr('information_schema.TABLES').where([
+                'TABLE_SCHEMA = DATABASE()', ('TABLE_NAME', table)])
+
+        sql = Sql().select('1').fr('`%s`' % table).where(where)
+        return Sql('EXPLAIN ' + sql.sql, sql.args, self, model)
+
+    @staticmethod
+    def estimated(cur, row):
+        """
+        Read the estimate of approx_sql(), EXPLAIN rows are scaled by the
+        filtered percentage when there is one
+
+        :param cur: cursor holding the row
+        :param dict|tuple row: first row
+        :return: int or None
+        """
+        if row is None:
+            return None
+
+        if not isinstance(row, dict):
+            row = dict(zip([d[0] for d in cur.description], row))
+
+        rows, filtered = row.get('rows'), row.get('filtered')
+
+        if rows is None:
+            return None
+        elif filtered is not None:
+            return int(round(int(rows) * float(filtered) / 100))
+
+        return int(rows)
+
+    def exists(self, table, where=None, model=None):
+        """
+        Whether a row matches, SELECT 1 ... LIMIT 1
+
+        :param str table: table name
+        :param dict|list|tuple|str where: where conditions
+        :param type model: Model class issuing it, reported to hooks
+        :return: bool
+        """
+        sql = self.sql(model).select('1').fr('`%s`' % table).where(where)
+        return sql.limit(1).rocks().fetchone() is not None
+
+    def describe(self, table):
+        """
+        Columns of a table
+
+        :param str table: table name
+        :return: SHOW COLUMNS rows
+        """
+        return self.execute('SHOW COLUMNS FROM `%s`' % table).fetchall()
+
+    def insert(self, table, data, model=None):
+        """
+        Insert clause
+
+        :param str table: table name
+        :param dict data: data
+        :param type model: Model class issuing it, reported to hooks
+        :return: last row id
+        """
+        self.touch(table)
+        lastrowid = self.sql(model).insert(table).set(data).rocks().lastrowid
+        self.written(table)
+        return lastrowid
+
+    def insert_many(self, table, rows, chunk_rows=1000, max_packet_bytes=None,
+                    model=None):
+        """
+        Insert rows with multi-row VALUES statements
+
+        :param str table: table name
+        :param Iterable rows: dicts sharing the same keys
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size, keep it
+            below the server max_allowed_packet
+        :param type model: Model class issuing it, reported to hooks
+        :return: (affected rows, first insert id) per statement
+        """
+        chunks = self.insert_chunks(table, rows, chunk_rows, max_packet_bytes,
+                                    model=model)
+        return [(cur.rowcount, cur.lastrowid) for size, cur in chunks]
+
+    def insert_chunks(self, table, rows, chunk_rows=1000,
+                      max_packet_bytes=None, update=None, pk=None,
+                      model=None):
+        """
+        Execute multi-row inserts chunk by chunk
+
+        :param str table: table name
+        :param Iterable rows: dicts sharing the same keys
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :param dict|Sql|str|Iterable|bool update: add ON DUPLICATE KEY
+            UPDATE, True updates every column but pk
+        :param str pk: primary key
+        :param type model: Model class issuing it, reported to hooks
+        :return: generator of (rows in chunk, cursor)
+        """
+        for size, sql in self.insert_sqls(table, rows, chunk_rows,
+                                          max_packet_bytes, update, pk,
+                                          model):
+            self.touch(table)
+            cur = sql.rocks()
+            self.written(table)
+
+            yield size, cur
+
+    def insert_sqls(self, table, rows, chunk_rows=1000, max_packet_bytes=None,
+                    update=None, pk=None, model=None):
+        """
+        Build the multi-row inserts of insert_chunks()
+
+        :param str table: table name
+        :param Iterable rows: dicts sharing the same keys
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :param dict|Sql|str|Iterable|bool update: add ON DUPLICATE KEY
+            UPDATE, True updates every column but pk
+        :param str pk: primary key
+        :param type model: Model class issuing it, reported to hooks
+        :return: generator of (rows in chunk, Sql instance)
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+
+        if first is None:
+            return
+
+        cols = list(first.keys())
+
+        if update is True:
+            update = [col for col in cols if col != pk] or cols
+
+        reserve = len(table)
+
+        if update:
+            reserve += len(Sql().on_duplicate_key_update(update).sql)
+
+        for chunk in Db.chunks(chain([first], rows), cols, chunk_rows,
+                               max_packet_bytes, reserve):
+            sql = self.sql(model).insert(table).cols(cols).vals(chunk)
+
+            if update:
+                sql.on_duplicate_key_update(update)
+
+            yield len(chunk), sql
+
+    @staticmethod
+    def chunks(rows, cols, chunk_rows=1000, max_packet_bytes=None,
+               reserve=0):
+        """
+        Split rows into chunks of value tuples
+
+        :param Iterable rows: dicts
+        :param list cols: columns
+        :param int chunk_rows: max rows per chunk
+        :param int max_packet_bytes: max estimated statement size
+        :param int reserve: extra statement bytes besides the values
+        :return: generator of lists of value tuples
+        """
+        # INSERT INTO `table`(`col`, ...) VALUES
+        base = 32 + reserve + sum(len(col) + 4 for col in cols)
+        size = base
+        chunk = []
+
+        for row in rows:
+            values = tuple(row[col] for col in cols)
+
+            if max_packet_bytes:
+                # (v1,v2,...),
+                row_size = 3 + sum(Db.estimate(v) + 1 for v in values)
+
+                if chunk and size + row_size > max_packet_bytes:
+                    yield chunk
+                    size = base
+                    chunk = []
+
+                size += row_size
+
+            chunk.append(values)
+
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                size = base
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def estimate(value):
+        """
+        Estimate the size of an escaped value in a statement
+
+        :param value: value
+        :return: bytes
+        """
+        if value is None:
+            return 4
+        elif isinstance(value, str):
+            b = value.encode('utf-8')
+            return len(b) + b.count(b"'") + b.count(b'\\') + 2
+        elif isinstance(value, (bytes, bytearray)):
+            return len(value) * 2 + 10
+        else:
+            return len(str(value)) + 2
+
+    def update(self, table, data, where=None, order_by=None, limit=None,
+               model=None):
+        """
+        Update clause
+
+        :param str table: table name
+        :param dict data: data
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        self.touch(table)
+        sql = self.sql(model).update(table).set(data).where(where)
+        rowcount = sql.order_by(order_by).limit(limit).rocks().rowcount
+        self.written(table)
+        return rowcount
+
+    def save(self, table, data, pk, insert=None, upsert=False, model=None):
+        """
+        Save data
+
+        :param str table: table name
+        :param dict data: data
+        :param str pk: primary key
+        :param bool insert: insert
+        :param bool upsert: insert or update in one statement, see upsert()
+        :param type model: Model class issuing it, reported to hooks
+        :return: last row id or affected rows, (inserted, updated) on upsert
+        """
+        if upsert:
+            return self.upsert(table, data, pk=pk, model=model)
+        elif insert or pk not in data:
+            return self.insert(table, data, model)
+        else:
+            sub_data = {k: data[k] for k in data if k != pk}
+            return self.update(table, sub_data, (pk, data[pk]), model=model)
+
+    def upsert(self, table, data, update=None, pk=None, chunk_rows=1000,
+               max_packet_bytes=None, model=None):
+        """
+        Insert rows, updating the existing ones in the same statement with
+        INSERT ... ON DUPLICATE KEY UPDATE
+
+        :param str table: table name
+        :param dict|Iterable data: a dict or dicts sharing the same keys
+        :param dict|Sql|str|Iterable update: on duplicate key update, default
+            every column but pk takes the inserted value
+        :param str pk: primary key
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :param type model: Model class issuing it, reported to hooks
+        :return: (inserted, updated), told apart by MySQL counting 1 affected
+            row per insert and 2 per update, rows left unchanged blur it
+        """
+        rows = [data] if isinstance(data, dict) else data
+        inserted = updated = 0
+
+        for size, cur in self.insert_chunks(table, rows, chunk_rows,
+                                            max_packet_bytes,
+                                            update or True, pk, model):
+            extra = Db.upserted(size, cur.rowcount)
+            updated += extra
+            inserted += min(cur.rowcount, size) - extra
+
+        return inserted, updated
+
+    @staticmethod
+    def upserted(size, count):
+        """
+        Rows an upsert chunk updated, MySQL counts 1 affected row per insert
+        and 2 per update
+
+        :param int size: rows in the chunk
+        :param int count: affected rows
+        :return: updated rows
+        """
+        return count - size if count > size else 0
+
+    def update_many(self, table, rows, key='id', chunk_rows=1000, case=True,
+                    model=None):
+        """
+        Update rows with different values in a few statements, in one
+        transaction, see atomic() and update_chunks()
+
+        :param str table: table name
+        :param Iterable rows: dicts holding the key and the new values
+        :param str|list|tuple key: key column(s) identifying the rows
+        :param int chunk_rows: max rows per statement
+        :param bool case: use CASE updates where possible
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        with self.atomic():
+            return sum(self.update_chunks(table, rows, key, chunk_rows, case,
+                                          model))
+
+    def update_chunks(self, table, rows, key='id', chunk_rows=1000,
+                      case=True, model=None):
+        """
+        Execute batched updates chunk by chunk. Rows are grouped by their
+        column set, each chunk of a group becomes one UPDATE ... SET col =
+        CASE key WHEN ... END, or an executemany() of single-row updates for
+        composite keys, single rows or case=False.
+
+        :param str table: table name
+        :param Iterable rows: dicts holding the key and the new values
+        :param str|list|tuple key: key column(s) identifying the rows
+        :param int chunk_rows: max rows per statement
+        :param bool case: use CASE updates where possible
+        :param type model: Model class issuing it, reported to hooks
+        :return: generator of affected rows
+        """
+        for sql, args, many in self.update_sqls(table, rows, key, chunk_rows,
+                                                case, model):
+            self.touch(table)
+
+            if many:
+                rowcount = self.executemany(sql, args, model)
+            else:
+                rowcount = self.execute(sql, args, model=model).rowcount
+
+            self.written(table)
+
+            yield rowcount
+
+    def update_sqls(self, table, rows, key='id', chunk_rows=1000, case=True,
+                    model=None):
+        """
+        Build the batched updates of update_chunks()
+
+        :param str table: table name
+        :param Iterable rows: dicts holding the key and the new values
+        :param str|list|tuple key: key column(s) identifying the rows
+        :param int chunk_rows: max rows per statement
+        :param bool case: use CASE updates where possible
+        :param type model: Model class issuing it, reported to hooks
+        :return: generator of (sql, args, whether to executemany() the args)
+        """
+        keys = [key] if isinstance(key, str) else list(key)
+        groups = OrderedDict()
+
+        for row in rows:
+            cols = tuple(k for k in row if k not in keys)
+
+            if cols:
+                groups.setdefault(frozenset(cols), (cols, []))[1].append(row)
+
+        for cols, group in groups.values():
+            for i in range(0, len(group), chunk_rows):
+                chunk = group[i:i + chunk_rows]
+
+                if case and len(keys) == 1 and len(chunk) > 1:
+                    sql = self.case_sql(table, chunk, keys[0], cols, model)
+                    yield sql.sql, sql.args, False
+                else:
+                    sql = 'UPDATE `%s` SET %s WHERE %s' % (
+                        table,
+                        ', '.join(['`%s`=%%s' % col for col in cols]),
+                        ' AND '.join(['`%s`=%%s' % k for k in keys]))
+                    yield sql, [
+                        [row[col] for col in cols] + [row[k] for k in keys]
+                        for row in chunk], True
+
+    def update_case(self, table, rows, key, cols, model=None):
+        """
+        Update rows in one statement with a CASE per column
+
+        :param str table: table name
+        :param list rows: dicts holding the key and cols
+        :param str key: key column
+        :param tuple cols: columns to update
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        return self.case_sql(table, rows, key, cols, model).rocks().rowcount
+
+    def case_sql(self, table, rows, key, cols, model=None):
+        """
+        Build the statement of update_case()
+
+        :param str table: table name
+        :param list rows: dicts holding the key and cols
+        :param str key: key column
+        :param tuple cols: columns to update
+        :param type model: Model class issuing it, reported to hooks
+        :return: Sql instance
+        """
+        when = ' WHEN %s THEN %s' * len(rows)
+        args = []
+
+        for col in cols:
+            for row in rows:
+                args.extend([row[key], row[col]])
+
+        sets = Sql(', '.join(
+            ['`%s`=CASE `%s`%s END' % (col, key, when) for col in cols]), args)
+
+        sql = self.sql(model).update(table).set(sets)
+        return sql.where((key, 'IN', [row[key] for row in rows]))
+
+    def save_many(self, table, rows, pk='id', chunk_rows=1000, model=None):
+        """
+        Save rows in batches, in one transaction, see atomic(). Rows without
+        pk are inserted with multi-row inserts, the others updated like
+        update_many().
+
+        :param str table: table name
+        :param Iterable rows: dicts
+        :param str pk: primary key
+        :param int chunk_rows: max rows per statement
+        :param type model: Model class issuing it, reported to hooks
+        :return: (inserted rows, updated rows)
+        """
+        inserts, updates = Db.save_groups(rows, pk)
+        inserted = 0
+
+        with self.atomic():
+            for group in inserts:
+                for size, cur in self.insert_chunks(table, group, chunk_rows,
+                                                    model=model):
+                    inserted += cur.rowcount
+
+            updated = sum(self.update_chunks(table, updates, pk, chunk_rows,
+                                             model=model))
+
+        return inserted, updated
+
+    @staticmethod
+    def save_groups(rows, pk='id'):
+        """
+        Split the rows of save_many()
+
+        :param Iterable rows: dicts
+        :param str pk: primary key
+        :return: (rows without pk grouped by their keys, rows with pk)
+        """
+        inserts = OrderedDict()
+        updates = []
+
+        for row in rows:
+            if pk in row:
+                updates.append(row)
+            else:
+                inserts.setdefault(frozenset(row), []).append(row)
+
+        return list(inserts.values()), updates
+
+    def executemany(self, sql, seq_args, model=None):
+        """
+        Execute sql once per args
+
+        :param str sql: sql
+        :param Iterable seq_args: args of each execution
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        self.call(self.cur, 'executemany', sql, seq_args, model, self.conn)
+        return self.cur.rowcount
+
+    def delete(self, table, where=None, order_by=None, limit=None,
+               model=None):
+        """
+        Delete clause
+
+        :param str table: table name
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        self.touch(table)
+        sql = self.sql(model).delete().fr('`%s`' % table).where(where)
+        rowcount = sql.order_by(order_by).limit(limit).rocks().rowcount
+        self.written(table)
+        return rowcount
+
+    def rocks(self, sql, args=None, model=None):
+        """
+        Execute sql
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param type model: Model class issuing it, reported to hooks
+        :return:
+        """
+        if isinstance(sql, Template):
+            sql, args = sql.sql, sql.bind(args if args else {})
+
+        return self.call(self.cur, 'execute', sql, args, model, self.conn)
+
+    def call(self, cur, method, sql, args=None, model=None, conn=None):
+        """
+        Run cur.execute() or cur.executemany(), through the hooks if any
+
+        :param cur: cursor
+        :param str method: execute or executemany
+        :param str sql: sql
+        :param Iterable args: args
+        :param type model: Model class issuing it, reported to hooks
+        :param conn: connection of a buffered cursor, hooks may run their
+            own statements on it
+        :return: what the cursor method returns
+        """
+        if self.debug:
+            print('%s\n%s' % (sql, args))
+
+        if not self.hooks:
+            return getattr(cur, method)(sql, args)
+
+        event = QueryEvent.start(self.hooks, sql, args, model, conn)
+
+        try:
+            result = getattr(cur, method)(sql, args)
+        except Exception as e:
+            event.fail(e)
+            raise
+
+        event.finish(cur.rowcount)
+
+        return result
+
+    def execute(self, sql, args=None, cache=False, model=None):
+        """
+        Execute sql and return the cursor holding the result
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param bool|float cache: read through the result cache, a number
+            is the ttl
+        :param type model: Model class issuing it, reported to hooks
+        :return: cursor
+        """
+        if cache and self.cache is not None:
+            return self.cached(sql, args, cache, model)
+
+        self.rocks(sql, args, model)
+        return self.cur
+
+    def cached(self, sql, args=None, ttl=True, model=None):
+        """
+        Execute a query through the result cache, keyed by sql and args and
+        dropped by writes to the tables it reads
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param bool|float ttl: seconds to live, True for the cache default
+        :param type model: Model class issuing it, reported to hooks
+        :return: Result instance
+        """
+        if isinstance(sql, Template):
+            sql, args = sql.sql, sql.bind(args if args else {})
+
+        key, result = self.cache_get(sql, args)
+
+        if key is None:
+            return self.execute(sql, args, model=model)
+
+        if result is None:
+            result = Result.from_cursor(self.execute(sql, args, model=model))
+            self.cache_set(key, result, ttl)
+
+        return result.copy()
+
+    def cache_get(self, sql, args=None):
+        """
+        Look a query up in the result cache
+
+        :param str sql: sql
+        :param Iterable args: args
+        :return: (key, Result instance or None), key is None for unhashable
+            args, which are not cached
+        """
+        key = (sql, tuple(args) if args else ())
+
+        try:
+            return key, self.cache.get(key)
+        except TypeError:
+            # unhashable args
+            return None, None
+
+    def cache_set(self, key, result, ttl=True):
+        """
+        Cache a query result, dropped by writes to the tables it reads
+
+        :param tuple key: key of cache_get()
+        :param Result result: result
+        :param bool|float ttl: seconds to live, True for the cache default
+        """
+        tables = set(Db.tables_re.findall(key[0]))
+        self.cache.set(key, result, tables, None if ttl is True else ttl)
+
+    def cursor(self, cursorclass=None):
+        """
+        Create a new cursor
+
+        :param cursorclass: cursor class, default the connection's
+        :return: cursor
+        """
+        if cursorclass is None:
+            return self.conn.cursor()
+        return self.conn.cursor(cursorclass)
+
+    def stream_class(self, cursorclass=None, tuples=False):
+        """
+        Cursor class of stream(): cursorclass, else self.stream_cursor, else
+        the unbuffered SSDictCursor of the driver, SSCursor with tuples
+
+        :param cursorclass: cursor class
+        :param bool tuples: prefer a cursor returning tuples
+        :return: cursor class, None for the connection's
+        """
+        if cursorclass is not None:
+            return cursorclass
+        elif self.stream_cursor is not None:
+            return self.stream_cursor
+        return driver_cursor(self.stream_driver,
+                             'SSCursor' if tuples else 'SSDictCursor')
+
+    @contextmanager
+    def stream(self, sql, args=None, cursorclass=None, model=None):
+        """
+        Execute sql on a new cursor, unbuffered (server-side) by default,
+        which is closed when the block exits. An unbuffered cursor keeps
+        the connection busy until then.
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param cursorclass: cursor class, default self.stream_class()
+        :param type model: Model class issuing it, reported to hooks
+        :return: cursor
+        """
+        if isinstance(sql, Template):
+            sql, args = sql.sql, sql.bind(args if args else {})
+
+        cursorclass = self.stream_class(cursorclass)
+
+        cur = self.cursor(cursorclass)
+
+        try:
+            self.call(cur, 'execute', sql, args, model)
+            yield cur
+        finally:
+            cur.close()
+
+    def iter(self, sql, args=None, batch_size=1000):
+        """
+        Iterate rows lazily, fetching batch_size rows at a time
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param int batch_size: rows per fetch
+        :return: generator of rows
+        """
+        with self.stream(sql, args) as cur:
+            while True:
+                rows = cur.fetchmany(batch_size)
+
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield row
+
+    def fetch_columns(self, sql, args=None, dtype_map=None, batch_size=10000,
+                      cursorclass=None, model=None):
+        """
+        Fetch the result into NumPy arrays, one per column, reading
+        batch_size rows at a time. Strings and values numpy can not hold
+        exactly are kept in object arrays, columns with NULLs are masked
+        arrays. It reads with self.stream_cursor when set, else with the
+        driver's unbuffered tuple cursor SSCursor, so no dict is built per
+        row.
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param dict dtype_map: column name => dtype, the others are inferred
+        :param int batch_size: rows per fetch
+        :param cursorclass: cursor class, default self.stream_class(None,
+            True)
+        :param type model: Model class issuing it, reported to hooks
+        :return: dict, column name => array
+        """
+        cursorclass = self.stream_class(cursorclass, True)
+
+        with self.stream(sql, args, cursorclass, model) as cur:
+            columns = Columns(cur.description, dtype_map, batch_size)
+
+            while True:
+                rows = cur.fetchmany(batch_size)
+
+                if not rows:
+                    break
+
+                columns.add(rows)
+
+        return columns.result()
+
+    def gather(self, *queries, timeout=None):
+        """
+        Run independent queries and return their results in order. One
+        connection can only run them one after another, PoolDb runs them
+        concurrently.
+
+        :param Sql|callable queries: Sql to fetch, or callables to call
+        :param float timeout: max seconds per query, a query can not be
+            timed out here, so it raises ValueError
+        :return: list of Result instances or callable return values
+        """
+        if timeout is not None:
+            raise ValueError('%s runs the queries one by one on its '
+                             'connection and can not time them out, use '
+                             'PoolDb' % type(self).__name__)
+
+        return [self.perform(query) for query in queries]
+
+    def perform(self, query):
+        """
+        Run one query of gather()
+
+        :param Sql|callable query: query
+        :return: Result instance or callable return value
+        """
+        if isinstance(query, Sql):
+            return Result.from_cursor(
+                self.execute(query.sql, query.args, model=query.model))
+        return query()
+
+    @contextmanager
+    def session(self):
+        """
+        Keep an identity map for the block, Model.get() answers rows already
+        loaded by pk from memory. Writes through this Db drop the rows of
+        the written table, raw statements run with rocks() do not.
+
+        :return: identity map, {table: {pk: object}}
+        """
+        if self.identity is not None:
+            # nested session shares the outer map
+            yield self.identity
+            return
+
+        self.identity = {}
+
+        try:
+            yield self.identity
+        finally:
+            self.identity = None
+
+    def touch(self, table):
+        """
+        Forget what is cached about a table, called before writing to it
+
+        :param str table: table name
+        """
+        if self.identity:
+            self.identity.pop(table, None)
+
+        if self.cache is not None:
+            self.cache.invalidate(table)
+
+    def written(self, table):
+        """
+        Forget the cached results of a table again once a write to it ran,
+        a read racing the write may have cached the old rows. Until the
+        commit other connections still read them, so the table is kept in
+        uncommitted() and forgotten once more by committed().
+
+        :param str table: table name
+        """
+        if self.cache is None:
+            return
+
+        self.cache.invalidate(table)
+        tables = self.uncommitted()
+
+        if tables is not None:
+            tables.add(table)
+
+    def uncommitted(self):
+        """
+        Tables written since the last commit, autocommit is up to the
+        connection so they are kept until commit() or rollback()
+
+        :return: set
+        """
+        return self.written_tables
+
+    def committed(self, commit=True, tables=None):
+        """
+        Forget the tables written by the transaction once it committed
+
+        :param bool commit: False for a rollback, nothing to forget
+        :param set tables: default self.uncommitted()
+        """
+        if tables is None:
+            tables = self.uncommitted()
+
+        if not tables:
+            return
+
+        if commit and self.cache is not None:
+            for table in tables:
+                self.cache.invalidate(table)
+
+        tables.clear()
+
+    def begin(self):
+        """
+        Begin a transaction, the connection is expected to run with
+        autocommit off so there is nothing to send
+        """
+        pass
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the statements of the block in one transaction, committed on
+        success and rolled back on error
+        """
+        self.begin()
+
+        try:
+            yield self
+        except Exception:
+            self.rollback()
+            raise
+
+        self.commit()
+
+    @contextmanager
+    def atomic(self):
+        """
+        Run the statements of the block in one transaction, the caller's
+        when in_transaction(), which the caller commits or rolls back,
+        else a transaction() of its own
+        """
+        if self.in_transaction():
+            yield self
+        else:
+            with self.transaction():
+                yield self
+
+    def in_transaction(self):
+        """
+        Whether statements run in a transaction committed by the caller, on
+        a connection running with autocommit off they always do
+
+        :return: bool
+        """
+        get_autocommit = getattr(self.conn, 'get_autocommit', None)
+        return get_autocommit is None or not get_autocommit()
+
+    def commit(self, *args, **kwargs):
+        """
+        Commit
+
+        :param args:
+        :param kwargs:
+        """
+        self.conn.commit(*args, **kwargs)
+        self.committed()
+
+    def rollback(self, *args, **kwargs):
+        """
+        Rollback
+
+        :param args:
+        :param kwargs:
+        """
+        self.conn.rollback(*args, **kwargs)
+        self.committed(False)
+
+    def close(self, *args, **kwargs):
+        """
+        Close connection
+
+        :param args:
+        :param kwargs:
+        """
+        self.conn.close(*args, **kwargs)
+
+
+class Result:
+    def __init__(self, description=None, rows=(), rowcount=-1,
+                 lastrowid=None):
+        """
+        Init Result instance, a cursor-like holder of fetched rows
+
+        :param tuple description: cursor description
+        :param tuple rows: rows
+        :param int rowcount: affected rows
+        :param int lastrowid: last row id
+        :return: Result instance
+        """
+        self.description = description
+        self.rows = rows
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+        self.pos = 0
+
+    @classmethod
+    def from_cursor(cls, cur):
+        """
+        Buffer everything an executed cursor holds
+
+        :param cur: cursor
+        :return: Result instance
+        """
+        rows = tuple(cur.fetchall()) if cur.description else ()
+        return cls(cur.description, rows, cur.rowcount, cur.lastrowid)
+
+    def fetchone(self):
+        """
+        Fetch next row
+
+        :return: row or None
+        """
+        if self.pos < len(self.rows):
+            self.pos += 1
+            return self.rows[self.pos - 1]
+        return None
+
+    def fetchmany(self, size=1):
+        """
+        Fetch next rows
+
+        :param int size: number of rows
+        :return: rows
+        """
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        """
+        Fetch remaining rows
+
+        :return: rows
+        """
+        rows = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return rows
+
+    def copy(self):
+        """
+        Copy with its own cursor position and row dicts
+
+        :return: Result instance
+        """
+        rows = tuple(dict(i) if isinstance(i, dict) else i for i in self.rows)
+        return Result(self.description, rows, self.rowcount, self.lastrowid)
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class ColumnArray:
+    def __init__(self, np, dtype=None, capacity=1024):
+        """
+        Init ColumnArray instance, a growable NumPy array of one column
+
+        :param module np: numpy
+        :param dtype: dtype, inferred from the first value when None, a
+            given dtype is cast to as numpy does, e.g. 2 => True for bool
+        :param int capacity: initial capacity
+        :return: ColumnArray instance
+        """
+        self.np = np
+        self.dtype = dtype
+        self.cast = dtype is not None
+        self.data = None
+        self.mask = None
+        self.size = 0
+        self.capacity = capacity
+
+    @staticmethod
+    def infer(np, value):
+        """
+        dtype for a value, object for strings and anything else numpy
+        would not hold exactly
+
+        :param module np: numpy
+        :param value: first non NULL value
+        :return: dtype
+        """
+        if isinstance(value, bool):
+            return np.bool_
+        elif isinstance(value, int):
+            return np.int64
+        elif isinstance(value, float):
+            return np.float64
+        elif isinstance(value, datetime.datetime):
+            return 'datetime64[us]'
+        elif isinstance(value, datetime.date):
+            return 'datetime64[D]'
+        elif isinstance(value, datetime.timedelta):
+            return 'timedelta64[us]'
+        return object
+
+    def extend(self, values):
+        """
+        Append values, None is stored masked
+
+        :param tuple values: values
+        """
+        np = self.np
+        n = len(values)
+
+        if not n:
+            return
+
+        if self.data is None:
+            if self.dtype is None:
+                first = next((i for i in values if i is not None), None)
+                self.dtype = ColumnArray.infer(np, first)
+            self.data = np.empty(max(self.capacity, n), self.dtype)
+
+        end = self.size + n
+
+        if end > len(self.data):
+            capacity = max(end, len(self.data) * 2)
+            self.data = np.resize(self.data, capacity)
+            if self.mask is not None:
+                self.mask = np.resize(self.mask, capacity)
+
+        if None in values:
+            if self.mask is None:
+                self.mask = np.zeros(len(self.data), np.bool_)
+
+            nulls = [i is None for i in values]
+            self.mask[self.size:end] = nulls
+
+            if self.data.dtype != object:
+                fill = np.zeros(1, self.data.dtype)[0]
+                values = [fill if i is None else i for i in values]
+        elif self.mask is not None:
+            self.mask[self.size:end] = False
+
+        self.data[self.size:end] = self.batch(values)
+        self.size = end
+
+    def batch(self, values):
+        """
+        Values as an array the column holds, an inferred column is widened
+        (bool => int => float) or turned into object when numpy would cast
+        the batch silently, e.g. 1.7 => 1 or 2 => True
+
+        :param list values: values, NULLs already filled
+        :return: numpy.ndarray or list
+        """
+        np = self.np
+        dtype = self.data.dtype
+
+        if dtype == object:
+            return values
+
+        if self.cast:
+            return np.asarray(values, dtype)
+
+        try:
+            if dtype.kind in 'Mm':
+                return np.asarray(values, dtype)
+            batch = np.asarray(values)
+        except (TypeError, ValueError, OverflowError):
+            batch = None
+
+        if batch is not None:
+            if np.can_cast(batch.dtype, dtype, 'safe'):
+                return batch
+
+            wider = np.promote_types(batch.dtype, dtype)
+
+            if wider.kind in 'biuf' and np.can_cast(dtype, wider, 'safe'):
+                self.data = self.data.astype(wider)
+                return batch
+
+        # mixed types or out of range, keep the python objects
+        self.data = self.data.astype(object)
+        return values
+
+    def array(self):
+        """
+        Get the array, a masked array when there were NULLs
+
+        :return: numpy.ndarray or numpy.ma.MaskedArray
+        """
+        np = self.np
+
+        if self.data is None:
+            return np.empty(0, self.dtype if self.dtype else object)
+
+        data = self.data[:self.size]
+
+        if self.mask is None:
+            return data
+
+        return np.ma.MaskedArray(data, self.mask[:self.size])
+
+
+class Columns:
+    def __init__(self, description, dtype_map=None, capacity=1024):
+        """
+        Init Columns instance, collects rows into one ColumnArray per column
+
+        :param tuple description: cursor description
+        :param dict dtype_map: column name => dtype, the others are inferred
+        :param int capacity: initial capacity
+        :return: Columns instance
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('columnar fetch needs numpy')
+
+        dtype_map = dtype_map if dtype_map else {}
+        self.names = [d[0] for d in description]
+        self.arrays = [ColumnArray(numpy, dtype_map.get(i), capacity)
+                       for i in self.names]
+
+    def add(self, rows):
+        """
+        Add a batch of rows, tuples or dicts
+
+        :param tuple rows: rows
+        """
+        if not rows:
+            return
+
+        if isinstance(rows[0], dict):
+            rows = [tuple(i.values()) for i in rows]
+
+        for array, values in zip(self.arrays, zip(*rows)):
+            array.extend(values)
+
+    def result(self):
+        """
+        Get the columns
+
+        :return: dict, column name => array
+        """
+        return {k: v.array() for k, v in zip(self.names, self.arrays)}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Pool:
+    # upper bounds in seconds of the checkout wait histogram buckets
+    wait_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf'))
+
+    def __init__(self, factory, min_size=0, max_size=10, timeout=None,
+                 max_lifetime=None, ping=None, ping_idle=0):
+        """
+        Init Pool instance
+
+        :param callable factory: returns a new DB-API connection
+        :param int min_size: connections opened up front
+        :param int max_size: max open connections
+        :param float timeout: max seconds to wait for a checkout
+        :param float max_lifetime: seconds before a connection is recycled
+        :param callable ping: health check, takes a connection and returns
+            False or raises when it is unusable, default conn.ping()
+        :param float ping_idle: only check connections idle this long
+        :return: Pool instance
+        """
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping = ping if ping else Pool.ping_conn
+        self.ping_idle = ping_idle
+
+        # idle (conn, released at) pairs, used LIFO to keep conns warm
+        self.idle = deque()
+        self.born = {}
+        self.size = 0
+        self.in_use = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.waits = [0] * len(self.wait_buckets)
+        self.wait_total = 0.0
+
+        for i in range(min_size):
+            self.size += 1
+            self.idle.append((self.connect(), time.time()))
+
+    @staticmethod
+    def ping_conn(conn):
+        """
+        Default health check, MySQLdb raises from ping() when the server
+        has gone away
+
+        :param conn: connection
+        :return: bool
+        """
+        ping = getattr(conn, 'ping', None)
+
+        if ping is not None:
+            ping()
+
+        return True
+
+    def connect(self):
+        """
+        Open a new connection
+
+        :return: connection
+        """
+        conn = self.factory()
+        self.born[id(conn)] = time.time()
+        return conn
+
+    def expired(self, conn):
+        """
+        Check connection lifetime
+
+        :param conn: connection
+        :return: bool
+        """
+        if self.max_lifetime is None:
+            return False
+        born = self.born.get(id(conn), 0)
+        return time.time() - born >= self.max_lifetime
+
+    def healthy(self, conn):
+        """
+        Run the health check
+
+        :param conn: connection
+        :return: bool
+        """
+        try:
+            return self.ping(conn) is not False
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Check out a connection
+
+        :param float timeout: max seconds to wait, default self.timeout
+        :return: connection
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+
+        while True:
+            conn = None
+
+            with self.cond:
+                while not self.idle and self.size >= self.max_size:
+                    remaining = None
+
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.record_wait(time.time() - start)
+                            raise PoolTimeout(
+                                'no connection available in %ss' % timeout)
+
+                    self.cond.wait(remaining)
+
+                if self.idle:
+                    conn, released = self.idle.pop()
+                else:
+                    self.size += 1
+
+                self.in_use += 1
+
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self.cond:
+                        self.size -= 1
+                        self.in_use -= 1
+                        self.cond.notify()
+                    raise
+            elif self.expired(conn):
+                self.discard(conn)
+                continue
+            elif time.time() - released >= self.ping_idle:
+                if not self.healthy(conn):
+                    self.discard(conn)
+                    continue
+
+            with self.cond:
+                self.record_wait(time.time() - start)
+
+            return conn
+
+    def release(self, conn, discard=False):
+        """
+        Return a checked out connection
+
+        :param conn: connection
+        :param bool discard: close it instead of reusing
+        """
+        if discard or self.closed or self.expired(conn):
+            self.discard(conn)
+            return
+
+        with self.cond:
+            self.in_use -= 1
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def discard(self, conn):
+        """
+        Close a checked out connection
+
+        :param conn: connection
+        """
+        self.born.pop(id(conn), None)
+
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+        with self.cond:
+            self.size -= 1
+            self.in_use -= 1
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Check out a connection for the block
+
+        :param float timeout: max seconds to wait
+        """
+        conn = self.acquire(timeout)
+
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def record_wait(self, seconds):
+        """
+        Record checkout wait time, called with the lock held
+
+        :param float seconds: seconds
+        """
+        self.wait_total += seconds
+
+        for i, bound in enumerate(self.wait_buckets):
+            if seconds <= bound:
+                self.waits[i] += 1
+                break
+
+    def stats(self):
+        """
+        Pool metrics
+
+        :return: dict
+        """
+        return {
+            'size': self.size,
+            'in_use': self.in_use,
+            'idle': len(self.idle),
+            'wait_count': sum(self.waits),
+            'wait_total': self.wait_total,
+            'wait_histogram': list(zip(self.wait_buckets, self.waits)),
+        }
+
+    def close(self):
+        """
+        Close idle connections, checked out ones are closed on release
+        """
+        with self.cond:
+            self.closed = True
+            idle = list(self.idle)
+            self.idle.clear()
+            self.size -= len(idle)
+
+        for conn, released in idle:
+            self.born.pop(id(conn), None)
+
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class PoolDb(Db):
+    def __init__(self, factory, min_size=0, max_size=10, timeout=None,
+                 max_lifetime=None, ping=None, ping_idle=0, autocommit=True,
+                 debug=False, stream_cursor=None, cache=None):
+        """
+        Init PoolDb instance, every execution checks out its own connection
+        so one PoolDb can be shared by threads
+
+        :param callable factory: returns a new DB-API connection
+        :param int min_size: connections opened up front
+        :param int max_size: max open connections
+        :param float timeout: max seconds to wait for a checkout
+        :param float max_lifetime: seconds before a connection is recycled
+        :param callable ping: connection health check
+        :param float ping_idle: only check connections idle this long
+        :param bool autocommit: commit statements run outside transaction()
+        :param bool debug: default False
+        :param stream_cursor: cursor class for streaming, default the
+            driver's unbuffered SSDictCursor
+        :param Cache cache: result cache for queries run with cache=True
+        :return: PoolDb instance
+        """
+        self.pool = Pool(factory, min_size, max_size, timeout, max_lifetime,
+                         ping, ping_idle)
+        self.autocommit = autocommit
+        self.debug = debug
+        self.stream_cursor = stream_cursor
+        self.cache = cache
+        self.conn = None
+        self.hooks = []
+        self.local = threading.local()
+        # thread pool of gather(), started on first use
+        self.workers = None
+        self.lock = threading.Lock()
+
+    @property
+    def cur(self):
+        """
+        Result of the last execution in this thread
+
+        :return: Result instance
+        """
+        return getattr(self.local, 'cur', None)
+
+    @property
+    def identity(self):
+        """
+        Identity map of the session() open in this thread
+
+        :return: dict or None
+        """
+        return getattr(self.local, 'identity', None)
+
+    @identity.setter
+    def identity(self, value):
+        self.local.identity = value
+
+    def rocks(self, sql, args=None, model=None):
+        """
+        Execute sql
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        return self.execute(sql, args, model=model).rowcount
+
+    def execute(self, sql, args=None, cache=False, model=None):
+        """
+        Execute sql on a pooled connection and buffer the result
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param bool|float cache: read through the result cache
+        :param type model: Model class issuing it, reported to hooks
+        :return: Result instance
+        """
+        if cache and self.cache is not None:
+            return self.cached(sql, args, cache, model)
+
+        if isinstance(sql, Template):
+            sql, args = sql.sql, sql.bind(args if args else {})
+
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is not None:
+            # inside a transaction
+            return self.run(conn, sql, args, model)
+
+        conn = self.pool.acquire()
+
+        try:
+            result = self.run(conn, sql, args, model)
+
+            if self.autocommit:
+                conn.commit()
+        except Exception:
+            self.pool.release(conn, not self.recover(conn))
+            raise
+
+        self.pool.release(conn)
+
+        return result
+
+    def executemany(self, sql, seq_args, model=None):
+        """
+        Execute sql once per args, on one connection
+
+        :param str sql: sql
+        :param Iterable seq_args: args of each execution
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            with self.transaction():
+                return self.executemany(sql, seq_args, model)
+
+        cur = conn.cursor()
+
+        try:
+            self.call(cur, 'executemany', sql, seq_args, model, conn)
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    def run(self, conn, sql, args=None, model=None):
+        """
+        Execute sql on the connection
+
+        :param conn: connection
+        :param str sql: sql
+        :param Iterable args: args
+        :param type model: Model class issuing it, reported to hooks
+        :return: Result instance
+        """
+        cur = conn.cursor()
+
+        try:
+            self.call(cur, 'execute', sql, args, model, conn)
+            result = Result.from_cursor(cur)
+        finally:
+            cur.close()
+
+        self.local.cur = result
+
+        return result
+
+    @contextmanager
+    def stream(self, sql, args=None, cursorclass=None, model=None):
+        """
+        Execute sql on a new cursor of a pooled connection, which stays
+        checked out until the block exits
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param cursorclass: cursor class, default self.stream_class()
+        :param type model: Model class issuing it, reported to hooks
+        :return: cursor
+        """
+        if isinstance(sql, Template):
+            sql, args = sql.sql, sql.bind(args if args else {})
+
+        cursorclass = self.stream_class(cursorclass)
+
+        tx_conn = getattr(self.local, 'conn', None)
+        conn = tx_conn if tx_conn is not None else self.pool.acquire()
+        done = False
+
+        try:
+            if cursorclass is None:
+                cur = conn.cursor()
+            else:
+                cur = conn.cursor(cursorclass)
+
+            try:
+                self.call(cur, 'execute', sql, args, model)
+                yield cur
+            finally:
+                cur.close()
+
+            if tx_conn is None and self.autocommit:
+                conn.commit()
+
+            done = True
+        finally:
+            # also reached when a generator reading the cursor is closed
+            if tx_conn is None:
+                self.pool.release(conn, not done and not self.recover(conn))
+
+    @staticmethod
+    def recover(conn):
+        """
+        Roll back a failed connection
+
+        :param conn: connection
+        :return: whether the connection can be reused
+        """
+        try:
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def begin(self):
+        """
+        Begin a transaction, binding a connection to this thread
+        """
+        depth = getattr(self.local, 'depth', 0)
+
+        if not depth:
+            self.local.conn = self.pool.acquire()
+
+        self.local.depth = depth + 1
+
+    def end(self, finish):
+        """
+        End the transaction of this thread
+
+        :param str finish: commit or rollback
+        """
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            return
+
+        self.local.depth -= 1
+
+        if self.local.depth and finish == 'commit':
+            # inner block of a nested transaction
+            return
+
+        tables = self.uncommitted()
+        self.local.conn = None
+        self.local.depth = 0
+
+        try:
+            getattr(conn, finish)()
+        except Exception:
+            self.pool.release(conn, True)
+            raise
+
+        self.pool.release(conn)
+        self.committed(finish == 'commit', tables)
+
+    def gather(self, *queries, timeout=None):
+        """
+        Run independent queries concurrently on pooled connections and
+        return their results in order. On the first error or timeout the
+        queries not started yet are cancelled and the error is raised, the
+        running ones finish in the background. Inside a transaction they
+        run one by one on its connection, see Db.gather().
+
+        :param Sql|callable queries: Sql to fetch, or callables to call
+        :param float timeout: max seconds per query, counted from its start
+            on a worker, so the ones waiting for a worker are not charged
+        :return: list of Result instances or callable return values
+        """
+        if getattr(self.local, 'conn', None) is not None or \
+                len(queries) < 2 and timeout is None:
+            return Db.gather(self, *queries, timeout=timeout)
+
+        workers = self.workers
+
+        if workers is None:
+            with self.lock:
+                if self.workers is None:
+                    self.workers = ThreadPoolExecutor(
+                        self.pool.max_size, 'sqlrocks-gather')
+                workers = self.workers
+
+        # start time of each query on its worker
+        starts = {}
+
+        def perform(i, query):
+            starts[i] = time.monotonic()
+            return self.perform(query)
+
+        futures = [workers.submit(perform, i, query)
+                   for i, query in enumerate(queries)]
+        pending = set(futures)
+        late = []
+
+        while pending:
+            wait_for = None
+
+            if timeout is not None:
+                started = [starts[i] for i, future in enumerate(futures)
+                           if future in pending and i in starts]
+                # until the first running query is due
+                wait_for = max(min(started) + timeout - time.monotonic(),
+                               0) if started else timeout
+
+            done, pending = wait(pending, wait_for, FIRST_EXCEPTION)
+
+            if any(future.exception() is not None for future in done):
+                break
+
+            if timeout is not None:
+                now = time.monotonic()
+                late = [i for i, future in enumerate(futures)
+                        if future in pending and i in starts and
+                        now - starts[i] >= timeout]
+
+                if late:
+                    break
+
+        for future in pending:
+            future.cancel()
+
+        for future in futures:
+            if future not in pending and future.exception() is not None:
+                raise future.exception()
+
+        if late:
+            raise TimeoutError('queries %s unfinished in %ss' % (
+                ', '.join(str(i) for i in late), timeout))
+
+        return [future.result() for future in futures]
+
+    def uncommitted(self):
+        """
+        Tables written by the transaction of this thread, statements outside
+        one are committed as they run
+
+        :return: set, None outside a transaction
+        """
+        if not self.in_transaction():
+            return None
+
+        tables = getattr(self.local, 'tables', None)
+
+        if tables is None:
+            tables = self.local.tables = set()
+
+        return tables
+
+    def in_transaction(self):
+        """
+        Whether this thread is in a transaction()
+
+        :return: bool
+        """
+        return getattr(self.local, 'conn', None) is not None
+
+    def commit(self, *args, **kwargs):
+        """
+        Commit the transaction of this thread
+        """
+        self.end('commit')
+
+    def rollback(self, *args, **kwargs):
+        """
+        Roll back the transaction of this thread
+        """
+        self.end('rollback')
+
+    def close(self, *args, **kwargs):
+        """
+        Close the pool
+        """
+        if self.workers is not None:
+            self.workers.shutdown(wait=False, cancel_futures=True)
+            self.workers = None
+
+        self.pool.close()
+
+
+class RoutingDb(Db):
+    # statements a replica may answer
+    read_re = re.compile(r'^\s*\(*\s*SELECT\b', re.I)
+    # locking reads belong to the primary
+    locking_re = re.compile(
+        r'\bFOR\s+(?:UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b', re.I)
+    # reads of the connection state, only the primary's holds the writes
+    session_re = re.compile(
+        r'\b(?:LAST_INSERT_ID|FOUND_ROWS|ROW_COUNT|CONNECTION_ID)\s*\(|@',
+        re.I)
+    # statements that write, they start the read-your-writes window
+    write_re = re.compile(
+        r'^\s*\(*\s*(?:INSERT|UPDATE|DELETE|REPLACE|LOAD|CREATE|ALTER|DROP|'
+        r'TRUNCATE|RENAME|CALL|GRANT|REVOKE)\b', re.I)
+
+    def __init__(self, primary, replicas, strategy='round_robin',
+                 ryw_window=1.0, cache=None, clock=time.monotonic):
+        """
+        Init RoutingDb instance, SELECTs go to the replicas and everything
+        else to the primary, like locking reads and reads of the connection
+        state such as LAST_INSERT_ID(). Reads also go to the primary inside
+        a transaction, inside use_primary() and for ryw_window seconds after
+        a write (INSERT, UPDATE, DDL, ...) of the same thread, so it reads
+        its own writes.
+
+        :param Db primary: Db or PoolDb of the primary
+        :param list replicas: Db or PoolDb of each replica
+        :param str strategy: round_robin or least_busy (fewest in flight)
+        :param float ryw_window: seconds reads stick to the primary after a
+            write, 0 disables it
+        :param Cache cache: result cache for queries run with cache=True
+        :param clock: time function
+        :return: RoutingDb instance
+        """
+        if strategy not in {'round_robin', 'least_busy'}:
+            raise ValueError('unknown strategy %r' % strategy)
+
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.ryw_window = ryw_window
+        self.cache = cache
+        self.clock = clock
+        self.conn = None
+        self.debug = False
+        self.stream_cursor = None
+        self.hooks = []
+        # statements running on each replica
+        self.in_flight = [0] * len(self.replicas)
+        self.turn = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @property
+    def cur(self):
+        """
+        Result of the last execution in this thread
+
+        :return: cursor or Result instance
+        """
+        return getattr(self.local, 'cur', None)
+
+    @property
+    def identity(self):
+        """
+        Identity map of the session() open in this thread
+
+        :return: dict or None
+        """
+        return getattr(self.local, 'identity', None)
+
+    @identity.setter
+    def identity(self, value):
+        self.local.identity = value
+
+    @property
+    def members(self):
+        """
+        Primary and replicas
+
+        :return: list of Db instances
+        """
+        return [self.primary] + self.replicas
+
+    def add_hook(self, hook):
+        """
+        Add a hook called around every statement of every member
+
+        :param Hook hook: hook
+        :return: hook
+        """
+        self.hooks.append(hook)
+
+        for db in self.members:
+            db.add_hook(hook)
+
+        return hook
+
+    def remove_hook(self, hook):
+        """
+        Remove a hook
+
+        :param Hook hook: hook
+        """
+        self.hooks.remove(hook)
+
+        for db in self.members:
+            db.remove_hook(hook)
+
+    def pinned(self):
+        """
+        Whether the reads of this thread must go to the primary
+
+        :return: bool
+        """
+        if getattr(self.local, 'depth', 0) or getattr(self.local, 'tx', 0) \
+                or getattr(self.local, 'open', False):
+            return True
+
+        written = getattr(self.local, 'written', None)
+
+        return written is not None and \
+            self.clock() - written < self.ryw_window
+
+    def route(self, sql):
+        """
+        Pick the member to run sql on
+
+        :param str sql: sql
+        :return: replica index, None for the primary
+        """
+        if not self.replicas or not RoutingDb.read_re.match(sql) or \
+                RoutingDb.locking_re.search(sql) or \
+                RoutingDb.session_re.search(sql) or self.pinned():
+            return None
+
+        with self.lock:
+            n = len(self.replicas)
+            start = self.turn
+            self.turn = (start + 1) % n
+
+            if self.strategy == 'least_busy':
+                index = min(range(n), key=lambda i: (
+                    self.in_flight[i], (i - start) % n))
+            else:
+                index = start
+
+            self.in_flight[index] += 1
+
+        return index
+
+    def done(self, index):
+        """
+        A statement routed to a replica finished
+
+        :param int index: replica index
+        """
+        with self.lock:
+            self.in_flight[index] -= 1
+
+    def wrote(self):
+        """
+        Start the read-your-writes window of this thread
+        """
+        if self.ryw_window:
+            self.local.written = self.clock()
+
+    def touch(self, table):
+        """
+        Forget what is cached about a table, called before writing to it.
+        On a primary connection running with autocommit off the write opens
+        a transaction, which pins the reads until commit() or rollback().
+
+        :param str table: table name
+        """
+        self.wrote()
+
+        get_autocommit = getattr(self.primary.conn, 'get_autocommit', None)
+
+        if get_autocommit is not None and not get_autocommit():
+            self.local.open = True
+
+        Db.touch(self, table)
+
+    def rocks(self, sql, args=None, model=None):
+        """
+        Execute sql
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        return self.execute(sql, args, model=model).rowcount
+
+    def execute(self, sql, args=None, cache=False, model=None):
+        """
+        Execute sql on the member it is routed to
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param bool|float cache: read through the result cache
+        :param type model: Model class issuing it, reported to hooks
+        :return: cursor or Result instance
+        """
+        if cache and self.cache is not None:
+            return self.cached(sql, args, cache, model)
+
+        if isinstance(sql, Template):
+            sql, args = sql.sql, sql.bind(args if args else {})
+
+        index = self.route(sql)
+
+        if index is None:
+            result = self.primary.execute(sql, args, model=model)
+
+            if RoutingDb.write_re.match(sql):
+                self.wrote()
+        else:
+            try:
+                result = self.replicas[index].execute(sql, args, model=model)
+            finally:
+                self.done(index)
+
+        self.local.cur = result
+
+        return result
+
+    def executemany(self, sql, seq_args, model=None):
+        """
+        Execute sql once per args on the primary
+
+        :param str sql: sql
+        :param Iterable seq_args: args of each execution
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        rowcount = self.primary.executemany(sql, seq_args, model)
+        self.local.cur = self.primary.cur
+        self.wrote()
+
+        return rowcount
+
+    def cursor(self, cursorclass=None):
+        """
+        Create a new cursor on the primary
+
+        :param cursorclass: cursor class, default the connection's
+        :return: cursor
+        """
+        return self.primary.cursor(cursorclass)
+
+    @contextmanager
+    def stream(self, sql, args=None, cursorclass=None, model=None):
+        """
+        Execute sql on a new cursor of the member it is routed to, a replica
+        counts it in flight until the block exits
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param cursorclass: cursor class, default the member's
+        :param type model: Model class issuing it, reported to hooks
+        :return: cursor
+        """
+        if isinstance(sql, Template):
+            sql, args = sql.sql, sql.bind(args if args else {})
+
+        index = self.route(sql)
+
+        if index is None:
+            with self.primary.stream(sql, args, cursorclass, model) as cur:
+                yield cur
+            return
+
+        try:
+            with self.replicas[index].stream(sql, args, cursorclass,
+                                             model) as cur:
+                yield cur
+        finally:
+            self.done(index)
+
+    @contextmanager
+    def use_primary(self):
+        """
+        Send the reads of the block to the primary
+        """
+        self.local.depth = getattr(self.local, 'depth', 0) + 1
+
+        try:
+            yield self
+        finally:
+            self.local.depth -= 1
+
+    def begin(self):
+        """
+        Begin a transaction on the primary, the reads of this thread go to
+        the primary until commit() or rollback()
+        """
+        self.primary.begin()
+        self.local.tx = getattr(self.local, 'tx', 0) + 1
+
+    def commit(self, *args, **kwargs):
+        """
+        Commit the primary, the inner commit of nested transactions keeps
+        the reads pinned
+        """
+        try:
+            self.primary.commit(*args, **kwargs)
+        finally:
+            self.end(getattr(self.local, 'tx', 0) - 1)
+
+        if not self.local.tx:
+            self.committed()
+
+    def rollback(self, *args, **kwargs):
+        """
+        Roll back the primary
+        """
+        try:
+            self.primary.rollback(*args, **kwargs)
+        finally:
+            self.end(0)
+
+        self.committed(False)
+
+    def end(self, depth):
+        """
+        Close transaction levels of this thread, the read-your-writes window
+        starts when the last one ends
+
+        :param int depth: open levels left
+        """
+        self.local.tx = max(depth, 0)
+
+        if not self.local.tx:
+            self.local.open = False
+            self.wrote()
+
+    def in_transaction(self):
+        """
+        Whether this thread is in a transaction() or the primary is
+
+        :return: bool
+        """
+        return bool(getattr(self.local, 'tx', 0)) or \
+            self.primary.in_transaction()
+
+    def uncommitted(self):
+        """
+        Tables written by this thread since its last commit
+
+        :return: set
+        """
+        tables = getattr(self.local, 'tables', None)
+
+        if tables is None:
+            tables = self.local.tables = set()
+
+        return tables
+
+    def close(self, *args, **kwargs):
+        """
+        Close every member
+        """
+        for db in self.members:
+            db.close(*args, **kwargs)
+
+
+class CompactField:
+    __slots__ = ('name', 'index')
+
+    def __init__(self, name, index=None):
+        """
+        Init CompactField instance, reads one value of a compact row, a
+        value assigned to the instance wins
+
+        :param str name: column name
+        :param int index: position in the values tuple, None for a column
+            outside the row, e.g. a deferred one
+        :return: CompactField instance
+        """
+        self.name = name
+        self.index = index
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+
+        changes = obj._changes
+
+        if changes and self.name in changes:
+            return changes[self.name]
+        elif self.index is None:
+            return obj._deferred(self.name)
+        return obj._values[self.index]
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
+class CompactMeta(type):
+    """
+    Metaclass of the classes generated by Model.compact_class(), the class
+    attributes they do not copy are read from the model, so a db or table
+    set on the model later is seen
+    """
+
+    def __getattr__(cls, item):
+        if item == '_model':
+            raise AttributeError(item)
+        return getattr(cls._model, item)
+
+
+class CompactRow:
+    """
+    Base of the classes generated by Model.compact_class(), a row is kept
+    as a tuple of values and the column index is shared by the class. It
+    does not inherit the model, so instances have no __dict__, the model's
+    methods are copied and __class__ reports the model.
+    """
+    __slots__ = ('_values', '_changes')
+
+    # model the class was generated for
+    _model = None
+
+    # column names and their positions in the values tuple
+    _cols = ()
+    _index = {}
+
+    def __init__(self, values):
+        """
+        Init compact Model instance
+
+        :param tuple values: row values in _cols order
+        :return: Model instance
+        """
+        self._values = values
+        self._changes = None
+
+    @property
+    def __class__(self):
+        return self._model
+
+    @property
+    def __dict__(self):
+        """
+        Assigned fields and lazily loaded columns, created on first write
+
+        :return: dict
+        """
+        if self._changes is None:
+            self._changes = {}
+        return self._changes
+
+    def __getattr__(self, item):
+        """
+        Get model attribute or deferred column from attr
+
+        :param str item: item
+        :return:
+        """
+        if item.startswith('__') or item in CompactRow.__slots__:
+            raise AttributeError(item)
+
+        try:
+            return getattr(self._model, item)
+        except AttributeError:
+            return self._deferred(item)
+
+    def __getitem__(self, item):
+        """
+        Get field from item
+
+        :param str item: item
+        :return:
+        """
+        changes = self._changes
+
+        if changes and item in changes:
+            return changes[item]
+
+        try:
+            return self._values[self._index[item]]
+        except KeyError:
+            return self._deferred(item)
+
+    def _deferred(self, item):
+        """
+        Get a lazily loaded column, loading it if deferred
+
+        :param str item: item
+        :return:
+        """
+        loaded = self._changes and self._changes.get('_loaded')
+
+        if loaded and item in loaded:
+            return loaded[item]
+        elif item in self._model.projection()[1]:
+            return self.load_deferred(item)
+
+        raise AttributeError(item)
+
+    @property
+    def _row(self):
+        """
+        Row as dict
+
+        :return: dict
+        """
+        row = dict(zip(self._cols, self._values))
+        loaded = self._changes and self._changes.get('_loaded')
+
+        if loaded:
+            row.update(loaded)
+
+        return row
+
+    def _merge(self, data):
+        """
+        Merge saved fields into the row
+
+        :param dict data: saved fields
+        """
+        self._values = tuple(
+            data.get(col, v) for col, v in zip(self._cols, self._values))
+        changes = self._changes
+
+        if not changes:
+            return
+
+        loaded = changes.get('_loaded')
+
+        if loaded:
+            for col in loaded:
+                if col in data:
+                    loaded[col] = data[col]
+                    changes.pop(col, None)
+
+        for col in self._cols:
+            # fields outside the row have nowhere else to live
+            changes.pop(col, None)
+
+    def _load(self, col, value):
+        """
+        Add a lazily loaded column, kept beside the values tuple
+
+        :param str col: column name
+        :param value: value
+        """
+        self.__dict__.setdefault('_loaded', {})[col] = value
+
+
+class Pending:
+    __slots__ = ('loader', 'pk')
+
+    def __init__(self, loader, pk):
+        """
+        Init Pending instance, a row queued on a Loader
+
+        :param Loader loader: loader
+        :param Hashable pk: primary key
+        :return: Pending instance
+        """
+        self.loader = loader
+        self.pk = pk
+
+    @property
+    def value(self):
+        """
+        Row of the pk or None, dispatching the queued pks if needed
+
+        :return: row
+        """
+        if self.pk not in self.loader.rows:
+            self.loader.dispatch()
+        return self.loader.rows[self.pk]
+
+    def __repr__(self):
+        return 'Pending(%r)' % (self.pk,)
+
+
+class Loader:
+    def __init__(self, model, max_in=1000, expr='*', fetch_obj=True):
+        """
+        Init Loader instance, collects pks and loads them in batches with
+        Model.get(pks), one query per max_in pks. Rows are kept for the
+        life of the loader so keep it request scoped.
+
+        :param type model: Model class
+        :param int max_in: max pks per IN list
+        :param Sql|str|Iterable expr: expression, must select the pk
+        :param bool fetch_obj: default True
+        :return: Loader instance
+        """
+        self.model = model
+        self.max_in = max_in
+        self.expr = expr
+        self.fetch_obj = fetch_obj
+        self.queue = OrderedDict()
+        self.rows = {}
+        self.batches = 0
+
+    def load(self, pk):
+        """
+        Queue a pk
+
+        :param Hashable pk: primary key
+        :return: Pending instance
+        """
+        if pk not in self.rows:
+            self.queue[pk] = None
+        return Pending(self, pk)
+
+    def load_many(self, pks):
+        """
+        Load rows by pks
+
+        :param Iterable pks: primary keys
+        :return: rows in pks order, None for missing ones
+        """
+        return [i.value for i in [self.load(pk) for pk in pks]]
+
+    def dispatch(self):
+        """
+        Load the queued pks
+        """
+        pk = self.model.pk
+
+        while self.queue:
+            chunk = []
+
+            while self.queue and len(chunk) < self.max_in:
+                chunk.append(self.queue.popitem(last=False)[0])
+
+            self.batches += 1
+
+            for obj in self.model.get(chunk, self.expr):
+                self.rows[obj[pk]] = obj if self.fetch_obj else obj._row
+
+            for i in chunk:
+                self.rows.setdefault(i, None)
+
+    def clear(self):
+        """
+        Forget the loaded rows
+        """
+        self.rows.clear()
+
+
+class AsyncPending:
+    __slots__ = ('loader', 'pk')
+
+    def __init__(self, loader, pk):
+        """
+        Init AsyncPending instance, a row queued on an AsyncLoader, await
+        it for the row
+
+        :param AsyncLoader loader: loader
+        :param Hashable pk: primary key
+        :return: AsyncPending instance
+        """
+        self.loader = loader
+        self.pk = pk
+
+    def __await__(self):
+        return self.loader.value(self.pk).__await__()
+
+    def __repr__(self):
+        return 'AsyncPending(%r)' % (self.pk,)
+
+
+class AsyncLoader(Loader):
+    def __init__(self, model, max_in=1000, expr='*', fetch_obj=True):
+        """
+        Init AsyncLoader instance, the Loader of an AsyncModel. The pks
+        queued by the tasks until one of them is awaited are loaded
+        together.
+
+        :param type model: AsyncModel class
+        :param int max_in: max pks per IN list
+        :param Sql|str|Iterable expr: expression, must select the pk
+        :param bool fetch_obj: default True
+        :return: AsyncLoader instance
+        """
+        super(AsyncLoader, self).__init__(model, max_in, expr, fetch_obj)
+        # pk => future of the batch loading it
+        self.loading = {}
+
+    def load(self, pk):
+        """
+        Queue a pk
+
+        :param Hashable pk: primary key
+        :return: AsyncPending instance
+        """
+        if pk not in self.rows and pk not in self.loading:
+            self.queue[pk] = None
+        return AsyncPending(self, pk)
+
+    async def load_many(self, pks):
+        """
+        Load rows by pks
+
+        :param Iterable pks: primary keys
+        :return: rows in pks order, None for missing ones
+        """
+        return [await i for i in [self.load(pk) for pk in pks]]
+
+    async def value(self, pk):
+        """
+        Row of the pk or None, dispatching the queued pks if needed
+
+        :param Hashable pk: primary key
+        :return: row
+        """
+        while pk not in self.rows:
+            loading = self.loading.get(pk)
+
+            if loading is not None:
+                # another task loads it
+                await asyncio.shield(loading)
+            elif pk in self.queue:
+                await self.dispatch()
+            else:
+                self.queue[pk] = None
+
+        return self.rows[pk]
+
+    async def dispatch(self):
+        """
+        Load the queued pks
+        """
+        pk = self.model.pk
+
+        while self.queue:
+            chunk = []
+
+            while self.queue and len(chunk) < self.max_in:
+                chunk.append(self.queue.popitem(last=False)[0])
+
+            self.batches += 1
+            done = asyncio.get_running_loop().create_future()
+
+            for i in chunk:
+                self.loading[i] = done
+
+            try:
+                for obj in await self.model.get(chunk, self.expr):
+                    self.rows[obj[pk]] = obj if self.fetch_obj else obj._row
+
+                for i in chunk:
+                    self.rows.setdefault(i, None)
+
+                done.set_result(None)
+            except asyncio.CancelledError:
+                # queue them again for a task waiting for them
+                for i in chunk:
+                    self.queue.setdefault(i, None)
+
+                done.set_result(None)
+                raise
+            except Exception as e:
+                done.set_exception(e)
+                # retrieved, the tasks waiting for it raise it themselves
+                done.exception()
+                raise
+            finally:
+                for i in chunk:
+                    self.loading.pop(i, None)
+
+
+class Schema:
+    def __init__(self, table, columns, types=None, pk=None):
+        """
+        Init Schema instance, the columns of a table
+
+        :param str table: table name
+        :param Iterable columns: column names in table order
+        :param dict types: column name => type, e.g. varchar(256)
+        :param str pk: primary key column
+        :return: Schema instance
+        """
+        self.table = table
+        self.columns = tuple(columns)
+        self.fields = frozenset(self.columns)
+        self.types = dict(types) if types else {}
+        self.pk = pk
+
+    @classmethod
+    def from_rows(cls, table, rows):
+        """
+        Build from SHOW COLUMNS rows, dicts or tuples
+
+        :param str table: table name
+        :param Iterable rows: rows
+        :return: Schema instance
+        """
+        columns, types, pk = [], {}, None
+
+        for row in rows:
+            if isinstance(row, dict):
+                name, kind, key = row['Field'], row['Type'], row['Key']
+            else:
+                name, kind, key = row[0], row[1], row[3]
+
+            columns.append(name)
+            types[name] = kind
+
+            if key == 'PRI' and pk is None:
+                pk = name
+
+        return cls(table, columns, types, pk)
+
+    def to_dict(self):
+        """
+        JSON friendly dict
+
+        :return: dict
+        """
+        return {
+            'columns': list(self.columns),
+            'types': self.types,
+            'pk': self.pk,
+        }
+
+    def __repr__(self):
+        return 'Schema(%r, %r)' % (self.table, self.columns)
+
+
+class SchemaCache:
+    def __init__(self, path=None):
+        """
+        Init SchemaCache instance, tables are introspected once per process.
+        With a path they are kept in a JSON snapshot, loaded on first use,
+        so other processes do not introspect them again.
+
+        :param str path: snapshot file
+        :return: SchemaCache instance
+        """
+        self.path = path
+        self.data = None
+        self.lock = threading.RLock()
+
+    def get(self, db, table):
+        """
+        Get the schema of a table, running SHOW COLUMNS on first use
+
+        :param Db db: Db instance
+        :param str table: table name
+        :return: Schema instance
+        """
+        schema = self.load().get(table)
+
+        if schema is None:
+            with self.lock:
+                schema = self.data.get(table)
+
+                if schema is None:
+                    schema = Schema.from_rows(table, db.describe(table))
+                    self.add(schema)
+
+        return schema
+
+    def add(self, schema):
+        """
+        Add a schema and update the snapshot
+
+        :param Schema schema: schema
+        """
+        with self.lock:
+            self.load()[schema.table] = schema
+            self.save()
+
+    def load(self):
+        """
+        Load the snapshot on first use
+
+        :return: dict, table => Schema instance
+        """
+        data = self.data
+
+        if data is not None:
+            return data
+
+        with self.lock:
+            if self.data is None:
+                data = {}
+
+                if self.path and os.path.exists(self.path):
+                    with open(self.path) as f:
+                        for table, item in json.load(f).items():
+                            data[table] = Schema(
+                                table, item['columns'], item.get('types'),
+                                item.get('pk'))
+
+                self.data = data
+
+        return self.data
+
+    def save(self):
+        """
+        Write the snapshot, atomically replacing the file
+        """
+        if not self.path:
+            return
+
+        with self.lock:
+            data = {k: v.to_dict() for k, v in self.data.items()}
+            tmp = '%s.%s.tmp' % (self.path, os.getpid())
+
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+
+            os.replace(tmp, self.path)
+
+    def clear(self, table=None):
+        """
+        Forget a table or everything, the snapshot is left as is
+
+        :param str table: table name
+        """
+        with self.lock:
+            if table is None:
+                self.data = {}
+            else:
+                self.load().pop(table, None)
+
+
+class Model:
+    """:type db: Db"""
+    db = None
+
+    # table name
+    table = ''
+
+    # primary key
+    pk = 'id'
+
+    # map rows to compact tuple-backed objects, see compact_class()
+    compact = False
+
+    # query templates shared by models, see prepare()
+    templates = LruCache(1024)
+
+    # classes generated by compact_class()
+    compact_classes = {}
+
+    # discover the columns with SHOW COLUMNS, see schema()
+    introspect = False
+
+    # schemas discovered, shared by models, set SchemaCache(path) to keep a
+    # snapshot on disk
+    schemas = SchemaCache()
+
+    # frozenset of get_fields() per class, see field_set()
+    field_sets = {}
+
+    # columns left out of the default projection, loaded on first access
+    defer = ()
+
+    # columns of the default projection, set on the classes of only()
+    only_fields = None
+
+    # classes generated by only()
+    only_classes = {}
+
+    # (default select expression, deferred columns) per class
+    projections = {}
+
+    def __init__(self, *args, **kwargs):
+        """
+        Init Model instance
+
+        :return: Model instance
+        """
+        self._row = args[0] if args else kwargs
 
     def __getattr__(self, item):
         """
-        Get field from attr
+        Get field from attr, a deferred column is loaded on first access
+
+        :param str item: item
+        :return:
+        """
+        if item in self._row:
+            return self._row[item]
+        elif item in self.projection()[1]:
+            return self.load_deferred(item)
+        else:
+            raise AttributeError
+
+    def __getitem__(self, item):
+        """
+        Get field from item
+
+        :param str item: item
+        :return:
+        """
+        if item in self._row:
+            return self._row[item]
+        elif item in self.projection()[1]:
+            return self.load_deferred(item)
+        else:
+            raise AttributeError
+
+    @classmethod
+    def projection(cls):
+        """
+        Get the default select expression, '*' unless defer or only() are
+        used, and the deferred columns
+
+        :return: (expression, frozenset of deferred columns)
+        """
+        item = Model.projections.get(cls)
+
+        if item is not None:
+            return item
+
+        if cls.only_fields is None and not cls.defer:
+            item = ('*', frozenset())
+        else:
+            if cls.introspect:
+                columns = cls.schema().columns
+            else:
+                columns = tuple(cls.get_fields())
+
+            if cls.only_fields is not None:
+                cols = [cls.pk] + [
+                    i for i in cls.only_fields if i != cls.pk]
+            elif columns:
+                cols = [i for i in columns if i not in cls.defer]
+            else:
+                raise ValueError('%s.defer needs the columns, override '
+                                 'get_fields() or set introspect = True'
+                                 % cls.__name__)
+
+            deferred = frozenset(columns).difference(cols)
+            deferred = deferred.union(cls.defer).difference(cols)
+            item = (', '.join('`%s`' % i for i in cols), deferred)
+
+        Model.projections[cls] = item
+
+        return item
+
+    @classmethod
+    def eager_expr(cls):
+        """
+        Get the default select expression with the deferred columns, for
+        reads that can not load them later
+
+        :return: str
+        """
+        expr, deferred = cls.projection()
+
+        if not deferred:
+            return expr
+
+        return ', '.join([expr] + ['`%s`' % i for i in sorted(deferred)])
+
+    @classmethod
+    def only(cls, *columns):
+        """
+        Get the model class selecting only these columns and the pk by
+        default, the other known columns are deferred
+
+        :param str columns: column names
+        :return: class
+        """
+        key = (cls, columns)
+        klass = Model.only_classes.get(key)
+
+        if klass is None:
+            klass = type(cls.__name__, (cls,), {'only_fields': columns})
+            Model.only_classes[key] = klass
+
+        return klass
+
+    @classmethod
+    def batched(cls, data, lazy=True):
+        """
+        Group objects of one result, a deferred column read on one of them
+        is loaded for all of them
+
+        :param Model|list data: object(s)
+        :param bool lazy: False to never load deferred columns of these
+            objects, e.g. read from a connection that is still streaming
+        :return: object(s)
+        """
+        if not data or not cls.projection()[1]:
+            return data
+
+        objs = data if isinstance(data, list) else [data]
+        batch = objs if lazy else None
+
+        for obj in objs:
+            obj.__dict__['_batch'] = batch
+
+        return data
+
+    def load_deferred(self, col, max_in=1000):
+        """
+        Load a deferred column of this object and of the objects fetched
+        with it that miss it, WHERE pk IN (...) by max_in pks
+
+        :param str col: column name
+        :param int max_in: max pks per IN list
+        :return: value
+        """
+        cls = type(self)
+        batch = self.__dict__.get('_batch', (self,))
+
+        if batch is None or cls.pk not in self._row:
+            # unsaved, or no connection free to load it by the pk
+            raise AttributeError(col)
+
+        objs = [i for i in batch if col not in i._row]
+
+        if self not in objs:
+            objs.append(self)
+
+        for i in range(0, len(objs), max_in):
+            chunk = objs[i:i + max_in]
+            pks = [obj._row[cls.pk] for obj in chunk]
+            values = {}
+
+            for row in cls.all([cls.pk, col], (cls.pk, 'IN', pks),
+                               fetch_obj=False):
+                if isinstance(row, dict):
+                    values[row[cls.pk]] = row[col]
+                else:
+                    values[row[0]] = row[1]
+
+            for obj in chunk:
+                obj._load(col, values.get(obj._row[cls.pk]))
+
+        return self._row[col]
+
+    def _load(self, col, value):
+        """
+        Add a lazily loaded column to the row
+
+        :param str col: column name
+        :param value: value
+        """
+        # rebind, the row dict may be shared with the caller
+        self._row = dict(self._row, **{col: value})
+
+    @classmethod
+    def to_obj(cls, data, description=None):
+        """
+        Mapping table row(s) to class object(s)
+
+        :param list|tuple|dict data: table rows, dicts or tuples
+        :param tuple description: cursor description, needed for tuples
+        :return: class objects
+        """
+        if data is None:
+            return None
+        elif isinstance(data, dict):
+            if cls.compact:
+                return cls.compact_class(tuple(data))(tuple(data.values()))
+            return cls(data)
+        elif not data:
+            return []
+        elif not isinstance(data[0], (dict, tuple, list)):
+            # one tuple row
+            return cls.to_obj([data], description)[0]
+        elif isinstance(data[0], dict):
+            if cls.compact:
+                klass = cls.compact_class(tuple(data[0]))
+                return [klass(tuple(i.values())) for i in data]
+            return [cls(i) for i in data]
+        else:
+            cols = tuple(d[0] for d in description)
+
+            if cls.compact:
+                klass = cls.compact_class(cols)
+
+                if isinstance(data[0], tuple):
+                    return list(map(klass, data))
+                return [klass(tuple(i)) for i in data]
+            return [cls(dict(zip(cols, i))) for i in data]
+
+    @classmethod
+    def compact_class(cls, cols):
+        """
+        Get the compact class for rows with these columns, a CompactRow
+        with __slots__ storing the row values in a tuple, and the model's
+        methods and properties
+
+        :param tuple cols: column names
+        :return: class
+        """
+        key = (cls, cols)
+        klass = Model.compact_classes.get(key)
+
+        if klass is None:
+            attrs = {}
+
+            for base in reversed(cls.__mro__[:-1]):
+                for name, value in vars(base).items():
+                    # classmethods and plain attributes are read from the
+                    # model by CompactMeta
+                    if isinstance(value, (FunctionType, property,
+                                          staticmethod)) and \
+                            name not in vars(CompactRow):
+                        attrs[name] = value
+
+            attrs.update({
+                '__slots__': (),
+                '__module__': cls.__module__,
+                '_model': cls,
+                '_cols': cols,
+                '_index': {col: i for i, col in enumerate(cols)},
+            })
+
+            index = attrs['_index']
+
+            for col in cls.field_set().union(cls.projection()[1], cols):
+                # never shadow Model attributes like pk or save
+                if not hasattr(cls, col):
+                    attrs[col] = CompactField(col, index.get(col))
+
+            klass = CompactMeta(cls.__name__, (CompactRow,), attrs)
+            Model.compact_classes[key] = klass
+
+        return klass
+
+    @classmethod
+    def select(cls, expr=None):
+        """
+        Select clause
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :return: Sql instance
+        """
+        if expr is None:
+            expr = cls.projection()[0]
+
+        return cls.db.sql(cls).select(expr).fr(cls.table)
+
+    @classmethod
+    def get(cls, pk, expr=None, fetch_obj=True):
+        """
+        Get row(s) by pk(s)
+
+        :param int|str|Iterable pk: primary key(s)
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :param fetch_obj: default True
+        :return row(s)
+        """
+        identity = cls.db.identity
+
+        if expr is None:
+            expr, whole = cls.projection()[0], True
+        else:
+            whole = expr == '*'
+
+        if isinstance(pk, Iterable) and not isinstance(pk, str):
+            sql = cls.select(expr).where((cls.pk, 'IN', pk))
+            data, description = cls.fetch(sql.sql, sql.args)
+        elif identity and fetch_obj and whole and \
+                pk in identity.get(cls.table, ()):
+            return identity[cls.table][pk]
+        elif isinstance(expr, str) and cls.templated():
+            # plain expression, only bind the pk into a cached template
+            tpl = cls.prepare(('get', expr), lambda: Sql().select(expr).fr(
+                cls.table).where((cls.pk, Param('pk'))))
+            data, description = cls.fetch(tpl, {'pk': pk}, one=True)
+        else:
+            sql = cls.select(expr).where((cls.pk, pk))
+            data, description = cls.fetch(sql.sql, sql.args, one=True)
+
+        if not fetch_obj:
+            return data
+
+        data = cls.batched(cls.to_obj(data, description))
+
+        return cls.identify(data, '*' if whole else expr)
+
+    @classmethod
+    def identify(cls, data, expr=None):
+        """
+        Swap whole rows for the objects already in the session identity map
+        of the Db, or add them to it
+
+        :param Model|list data: object(s)
+        :param Sql|str|Iterable expr: expression the rows were selected by,
+            None for the projection()
+        :return: object(s)
+        """
+        identity = cls.db.identity
+
+        if identity is None or expr not in (None, '*') or not data:
+            return data
+
+        objs = identity.setdefault(cls.table, {})
+
+        if isinstance(data, list):
+            return [objs.setdefault(i[cls.pk], i) for i in data]
+        return objs.setdefault(data[cls.pk], data)
+
+    @classmethod
+    def loader(cls, max_in=1000, expr='*', fetch_obj=True):
+        """
+        Get a batching loader, load() queues pks and the first value read
+        fetches all the queued ones with WHERE pk IN (...)
+
+        :param int max_in: max pks per IN list
+        :param Sql|str|Iterable expr: expression, must select the pk
+        :param bool fetch_obj: default True
+        :return: Loader instance
+        """
+        return Loader(cls, max_in, expr, fetch_obj)
+
+    @classmethod
+    def prepare(cls, name, build):
+        """
+        Get a query template, built and frozen on first use
+
+        :param Hashable name: template name
+        :param callable build: returns the Sql to freeze
+        :return: Template instance
+        """
+        key = (cls.table, cls.pk, name)
+        tpl = Model.templates.get(key)
+
+        if tpl is None:
+            tpl = build().freeze()
+            Model.templates.set(key, tpl)
+
+        return tpl
+
+    @classmethod
+    def templated(cls):
+        """
+        Whether queries may use a template instead of select(), not when a
+        subclass overrides select(), e.g. with a default scope
+
+        :return: bool
+        """
+        return getattr(cls.select, '__func__', None) is Model.select.__func__
+
+    @classmethod
+    def one_sql(cls, expr=None, where=None, order_by=None):
+        """
+        Statement of one(), a cached template when expr, where and order_by
+        are plain strings (first() and last()) and templated()
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :return: Sql or Template instance
+        """
+        if expr is None:
+            expr = cls.projection()[0]
+
+        plain = all(i is None or isinstance(i, str)
+                    for i in (expr, where, order_by))
+
+        if not plain or not cls.templated():
+            return cls.select(expr).where(where).order_by(order_by).limit(1)
+
+        def build():
+            sql = Sql().select(expr).fr(cls.table).where(where)
+            return sql.order_by(order_by).limit(1)
+
+        return cls.prepare(('one', expr, where, order_by), build)
+
+    @classmethod
+    def one(cls, expr=None, where=None, order_by=None, fetch_obj=True,
+            cache=False):
+        """
+        Get one row
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param fetch_obj: default True
+        :param bool|float cache: read through the Db result cache
+        :return row
+        """
+        sql = cls.one_sql(expr, where, order_by)
+        row, description = cls.fetch(sql.sql, sql.args, cache, True)
+
+        if not fetch_obj:
+            return row
+
+        return cls.identify(cls.batched(cls.to_obj(row, description)), expr)
+
+    @classmethod
+    def first(cls, expr=None, fetch_obj=True):
+        """
+        Get first row
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :param fetch_obj: default True
+        :return row
+        """
+        return cls.one(expr=expr, order_by=cls.pk, fetch_obj=fetch_obj)
+
+    @classmethod
+    def last(cls, expr=None, fetch_obj=True):
+        """
+        Get last row
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :param fetch_obj: default True
+        :return row
+        """
+        return cls.one(expr=expr, order_by='-' + cls.pk, fetch_obj=fetch_obj)
+
+    @classmethod
+    def exists(cls, where=None):
+        """
+        Exists
+
+        :param dict|list|tuple|str where: where conditions
+        :return: bool
+        """
+        return cls.db.exists(cls.table, where, cls)
+
+    @classmethod
+    def all(cls, expr=None, where=None, order_by=None, limit=None,
+            fetch_obj=True, cache=False):
+        """
+        Get rows
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :param fetch_obj: default True
+        :param bool|float cache: read through the Db result cache
+        :return: rows
+        """
+        sql = cls.select(expr).where(where).order_by(order_by).limit(limit)
+        rows, description = cls.fetch(sql.sql, sql.args, cache)
+
+        if not fetch_obj:
+            return rows
+
+        return cls.identify(cls.batched(cls.to_obj(rows, description)), expr)
+
+    @classmethod
+    def fetch(cls, sql, args=None, cache=False, one=False):
+        """
+        Execute a query of the model and fetch its rows, a compact model
+        reads them with a tuple cursor, see Db.stream_class(), so no dict
+        is built per row
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param bool|float cache: read through the Db result cache
+        :param bool one: fetch one row
+        :return: (row(s), cursor description)
+        """
+        db = cls.db
+
+        if cls.compact and not (cache and db.cache is not None):
+            with db.stream(sql, args, db.stream_class(None, True), cls) as cur:
+                return cur.fetchone() if one else cur.fetchall(), \
+                    cur.description
+
+        cur = db.execute(sql, args, cache, cls)
+        return cur.fetchone() if one else cur.fetchall(), cur.description
+
+    @classmethod
+    def iter(cls, expr=None, where=None, order_by=None, limit=None,
+             batch_size=1000, fetch_obj=True):
+        """
+        Iterate rows lazily with a streaming cursor. Deferred columns are
+        selected too, loading them later would query the connection that is
+        still streaming, so with an explicit expr they are not loaded.
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+            and the deferred columns
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :param int batch_size: rows per fetch
+        :param fetch_obj: default True
+        :return: generator of rows
+        """
+        if expr is None:
+            expr = cls.eager_expr()
+
+        sql = cls.select(expr).where(where).order_by(order_by).limit(limit)
+        # compact rows are built from tuples
+        cursorclass = cls.db.stream_class(None, True) if cls.compact else None
+
+        with cls.db.stream(sql.sql, sql.args, cursorclass, cls) as cur:
+            while True:
+                rows = cur.fetchmany(batch_size)
+
+                if not rows:
+                    break
+
+                if fetch_obj:
+                    rows = cls.batched(cls.to_obj(rows, cur.description),
+                                       False)
+
+                for row in rows:
+                    yield row
+
+    @classmethod
+    def columns(cls, expr=None, where=None, order_by=None, limit=None,
+                dtype_map=None, batch_size=10000, cursorclass=None):
+        """
+        Get rows as NumPy arrays, one per column, see Db.fetch_columns()
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :param dict dtype_map: column name => dtype, the others are inferred
+        :param int batch_size: rows per fetch
+        :param cursorclass: cursor class, default self.stream_cursor or the
+            driver's SSCursor
+        :return: dict, column name => array
+        """
+        sql = cls.select(expr).where(where).order_by(order_by).limit(limit)
+        return cls.db.fetch_columns(sql.sql, sql.args, dtype_map, batch_size,
+                                    cursorclass, cls)
+
+    @classmethod
+    def scan(cls, batch_size=1000, where=None, expr='*', key=None, desc=False,
+             fetch_obj=True):
+        """
+        Walk the table in key order with keyset (seek) pagination, i.e.
+        WHERE key > last ORDER BY key LIMIT n, which stays cheap for deep
+        pages unlike a growing LIMIT offset
+
+        :param int batch_size: rows per batch
+        :param dict|list|tuple|str where: where conditions
+        :param Sql|str|Iterable expr: expression, must include the key
+        :param str|list|tuple key: key column(s), default cls.pk
+        :param bool desc: walk in descending order
+        :param fetch_obj: default True
+        :return: generator of row batches
+        """
+        key = cls.pk if key is None else key
+        keys = [key] if isinstance(key, str) else list(key)
+        order_by = ', '.join(k + ' DESC' for k in keys) if desc else keys
+        op = '<' if desc else '>'
+        last = None
+
+        while True:
+            seek = Model.seek_cond(keys, last, op) if last else None
+            sql = cls.select(expr).where(Sql.and_where(where, seek))
+            cur = sql.order_by(order_by).limit(batch_size).rocks()
+            rows = cur.fetchall()
+
+            if not rows:
+                break
+
+            if fetch_obj:
+                yield cls.batched(cls.to_obj(rows, cur.description))
+            else:
+                yield rows
+
+            if len(rows) < batch_size:
+                break
+
+            last = Model.seek_last(rows[-1], keys, cur.description)
+
+    @staticmethod
+    def seek_last(row, keys, description):
+        """
+        Key values of the last row of a scan() batch
+
+        :param dict|tuple row: row
+        :param list keys: key columns
+        :param tuple description: cursor description, needed for tuples
+        :return: list
+        """
+        if isinstance(row, dict):
+            return [row[k] for k in keys]
+
+        cols = [d[0] for d in description]
+        return [row[cols.index(k)] for k in keys]
+
+    @staticmethod
+    def seek_cond(keys, last, op):
+        """
+        Condition for rows after the last key, composite keys are expanded
+        to (a > x) OR (a = x AND b > y) so indexes are used
+
+        :param list keys: key columns
+        :param list last: last key values
+        :param str op: > or <
+        :return: where conditions
+        """
+        if len(keys) == 1:
+            return keys[0], op, last[0]
+
+        branches = []
+
+        for i in range(len(keys)):
+            cond = [(keys[j], last[j]) for j in range(i)]
+            cond.append((keys[i], op, last[i]))
+            branches.append({'AND': cond} if i else cond[0])
+
+        return {'OR': branches}
+
+    @classmethod
+    def count(cls, where=None, cache=False, approx=False, max=None):
+        """
+        Count table
+
+        :param dict|list|tuple|str where: where conditions
+        :param bool|float cache: read through the Db result cache
+        :param bool approx: estimate, see Db.count()
+        :param int max: stop counting at max rows
+        :return: int
+        """
+        return cls.db.count(cls.table, where, cache, cls, approx, max)
+
+    @classmethod
+    def gather(cls, *queries, timeout=None, fetch_obj=True):
+        """
+        Run independent queries with Db.gather(), e.g.
+        Song.gather(Song.select().where(...), lambda: Song.count())
+
+        :param Sql|callable queries: Sql to fetch, or callables to call
+        :param float timeout: max seconds per query
+        :param fetch_obj: map the rows of Sql queries to objects
+        :return: list of rows or callable return values
+        """
+        results = cls.db.gather(*queries, timeout=timeout)
+
+        for i, query in enumerate(queries):
+            if isinstance(query, Sql):
+                rows = results[i].fetchall()
+
+                if fetch_obj:
+                    rows = cls.batched(
+                        cls.to_obj(rows, results[i].description))
+
+                results[i] = rows
+
+        return results
+
+    @classmethod
+    def add(cls, *args, **kwargs):
+        """
+        Insert clause
+
+        :return: last row id
+        """
+        return cls.db.insert(cls.table, args[0] if args else kwargs, cls)
+
+    @classmethod
+    def add_many(cls, rows, chunk_rows=1000, max_packet_bytes=None):
+        """
+        Insert rows in multi-row statements
+
+        :param Iterable rows: dicts sharing the same keys
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :return: (affected rows, first insert id) per statement
+        """
+        return cls.db.insert_many(cls.table, rows, chunk_rows,
+                                  max_packet_bytes, cls)
+
+    @classmethod
+    def saved(cls, data, insert=None, upsert=False):
+        """
+        Save raw data
+
+        :param dict data: data
+        :param bool insert: default None
+        :param bool upsert: insert or update in one statement
+        :return: last row id or affected rows, (inserted, updated) on upsert
+        """
+        return cls.db.save(cls.table, data, cls.pk, insert, upsert, cls)
+
+    @classmethod
+    def update_many(cls, rows, chunk_rows=1000, case=True):
+        """
+        Update rows with different values in a few statements
+
+        :param Iterable rows: dicts holding the pk and the new values
+        :param int chunk_rows: max rows per statement
+        :param bool case: use CASE updates where possible
+        :return: affected rows
+        """
+        return cls.db.update_many(cls.table, rows, cls.pk, chunk_rows, case,
+                                  cls)
+
+    @classmethod
+    def save_many(cls, objs, chunk_rows=1000):
+        """
+        Save objects like save() in one transaction, see Db.atomic(), the
+        dirty fields of loaded objects are written with batched updates. New
+        objects are still inserted one by one to learn their pks, use
+        add_many() when they are not needed.
+
+        :param Iterable objs: objects
+        :param int chunk_rows: max rows per statement
+        :return: (inserted rows, updated rows)
+        """
+        updates = []
+        merges = []
+        inserted = 0
+
+        with cls.db.atomic():
+            for obj in objs:
+                row = obj._row
+
+                if cls.pk not in row:
+                    obj.save()
+                    inserted += 1
+                    continue
+
+                data = {k: obj.__dict__[k] for k in obj.dirty_fields}
+
+                if data:
+                    merges.append((obj, data))
+                    updates.append(dict(data, **{cls.pk: row[cls.pk]}))
+
+            updated = sum(cls.db.update_chunks(cls.table, updates, cls.pk,
+                                               chunk_rows, model=cls))
+
+        for obj, data in merges:
+            obj._merge(data)
+
+        return inserted, updated
+
+    @classmethod
+    def upsert(cls, data, update=None, chunk_rows=1000, max_packet_bytes=None):
+        """
+        Insert row(s), updating the existing ones in the same statement
+
+        :param dict|Iterable data: a dict or dicts sharing the same keys
+        :param dict|Sql|str|Iterable update: on duplicate key update
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :return: (inserted, updated)
+        """
+        return cls.db.upsert(cls.table, data, update, cls.pk, chunk_rows,
+                             max_packet_bytes, cls)
+
+    @property
+    def dirty_fields(self):
+        """
+        Fields assigned a value that differs from the loaded row
+
+        :return: set
+        """
+        row = self._row
+        data = self.fields_filter(self.__dict__)
+        return {k for k in data if k not in row or row[k] != data[k]}
+
+    def save(self, insert=None):
+        """
+        Save object, an update only writes the dirty fields and is skipped
+        when there are none
+
+        :param bool insert: default None
+        :return: last row id or affected rows
+        """
+        row = self._row
+
+        if self.pk in row and not insert:
+            # update
+            data = {k: self.__dict__[k] for k in self.dirty_fields}
+
+            if not data:
+                return 0
+
+            result = self.db.update(self.table, data, (self.pk, row[self.pk]),
+                                    model=type(self))
+        else:
+            # insert or update
+            data = self.fields_filter(self.__dict__)
+            data.update({k: row[k] for k in row if k not in data})
+            result = self.db.save(self.table, data, self.pk, insert,
+                                  model=type(self))
+
+            if self.pk not in data:
+                data[self.pk] = result
+
+        self._merge(data)
+
+        return result
+
+    def _merge(self, data):
+        """
+        Merge saved fields into the row
+
+        :param dict data: saved fields
+        """
+        # rebind, the row dict may be shared with the caller
+        self._row = dict(self._row, **data)
+
+    @classmethod
+    def update(cls, data, where=None, order_by=None, limit=None):
+        """
+        Update clause
+
+        :param dict data: data
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :return: affected rows
+        """
+        return cls.db.update(cls.table, data, where, order_by, limit, cls)
+
+    @classmethod
+    def delete(cls, where=None, order_by=None, limit=None):
+        """
+        Delete clause
+
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :return: affected rows
+        """
+        return cls.db.delete(cls.table, where, order_by, limit, cls)
+
+    def remove(self):
+        """
+        Delete object
+
+        :return: affected rows
+        """
+        return self.db.delete(self.table, (self.pk, getattr(self, self.pk)),
+                              model=type(self))
+
+    @classmethod
+    def schema(cls):
+        """
+        Get the table schema, introspected once per process
+
+        :return: Schema instance
+        """
+        return cls.schemas.get(cls.db, cls.table)
+
+    @classmethod
+    def get_fields(cls):
+        """
+        Get table fields, override it or set introspect = True
+
+        :return: fields
+        :rtype list|tuple|set
+        """
+        if cls.introspect:
+            return cls.schema().fields
+        return {}
+
+    @classmethod
+    def field_set(cls):
+        """
+        get_fields() as a frozenset, computed once per class
+
+        :return: frozenset
+        """
+        fields = Model.field_sets.get(cls)
+
+        if fields is None:
+            fields = Model.field_sets[cls] = frozenset(cls.get_fields())
+
+        return fields
+
+    @classmethod
+    def fields_filter(cls, data):
+        """
+        Remove irrelevant fields
+
+        :param dict data: data
+        :return: clean data
+        """
+        fields = cls.field_set()
+        return {k: data[k] for k in data if k in fields}
+
+    @classmethod
+    def rocks(cls, sql, args=None):
+        """
+        Execute sql
+
+        :param str sql: sql
+        :param Iterable args: args
+        :return:
+        """
+        return cls.db.rocks(sql, args, cls)
+
+
+async def resolve(value):
+    """
+    Await the value if the driver returned an awaitable, so async drivers
+    (aiomysql style) and plain DB-API objects can both back AsyncDb
+
+    :param value: value or awaitable
+    :return: value
+    """
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class AsyncPool:
+    def __init__(self, factory, max_size=10, timeout=None, max_lifetime=None):
+        """
+        Init AsyncPool instance
+
+        :param callable factory: returns a new connection or an awaitable
+        :param int max_size: max open connections
+        :param float timeout: max seconds to wait for a checkout
+        :param float max_lifetime: seconds before a connection is recycled
+        :return: AsyncPool instance
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+
+        # idle connections, used LIFO to keep conns warm
+        self.idle = deque()
+        self.born = {}
+        self.size = 0
+        self.in_use = 0
+        self.closed = False
+        # created in the running loop, see condition()
+        self.cond = None
+
+    def condition(self):
+        """
+        Get the condition guarding the pool. It is created on first use,
+        before Python 3.10 it binds to the loop current at creation, which
+        is not the running one for a pool built at import time.
+
+        :return: asyncio.Condition
+        """
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+        return self.cond
+
+    async def connect(self):
+        """
+        Open a new connection
+
+        :return: connection
+        """
+        conn = await resolve(self.factory())
+        self.born[id(conn)] = time.time()
+        return conn
+
+    def expired(self, conn):
+        """
+        Check connection lifetime
+
+        :param conn: connection
+        :return: bool
+        """
+        if self.max_lifetime is None:
+            return False
+        born = self.born.get(id(conn), 0)
+        return time.time() - born >= self.max_lifetime
+
+    async def acquire(self, timeout=None):
+        """
+        Check out a connection
+
+        :param float timeout: max seconds to wait, default self.timeout
+        :return: connection
+        """
+        timeout = self.timeout if timeout is None else timeout
+        cond = self.condition()
+
+        async with cond:
+            try:
+                await asyncio.wait_for(cond.wait_for(
+                    lambda: self.idle or self.size < self.max_size), timeout)
+            except asyncio.TimeoutError:
+                raise PoolTimeout('no connection available in %ss' % timeout)
+
+            conn = self.idle.pop() if self.idle else None
+
+            if conn is None:
+                self.size += 1
+
+            self.in_use += 1
+
+        if conn is None:
+            try:
+                conn = await self.connect()
+            except Exception:
+                await self.forget()
+                raise
+        elif self.expired(conn):
+            await self.discard(conn)
+            return await self.acquire(timeout)
+
+        return conn
+
+    async def release(self, conn, discard=False):
+        """
+        Return a checked out connection
+
+        :param conn: connection
+        :param bool discard: close it instead of reusing
+        """
+        if discard or self.closed or self.expired(conn):
+            await self.discard(conn)
+            return
+
+        async with self.condition():
+            self.in_use -= 1
+            self.idle.append(conn)
+            self.cond.notify()
+
+    async def discard(self, conn):
+        """
+        Close a checked out connection
+
+        :param conn: connection
+        """
+        self.born.pop(id(conn), None)
+
+        try:
+            await resolve(conn.close())
+        except Exception:
+            pass
+
+        await self.forget()
+
+    async def forget(self):
+        """
+        Free the slot of a checked out connection
+        """
+        async with self.condition():
+            self.size -= 1
+            self.in_use -= 1
+            self.cond.notify()
+
+    @asynccontextmanager
+    async def connection(self, timeout=None):
+        """
+        Check out a connection for the block
+
+        :param float timeout: max seconds to wait
+        """
+        conn = await self.acquire(timeout)
+
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    def stats(self):
+        """
+        Pool metrics
+
+        :return: dict
+        """
+        return {
+            'size': self.size,
+            'in_use': self.in_use,
+            'idle': len(self.idle),
+        }
+
+    async def close(self):
+        """
+        Close idle connections, checked out ones are closed on release
+        """
+        async with self.condition():
+            self.closed = True
+            idle = list(self.idle)
+            self.idle.clear()
+            self.size -= len(idle)
+
+        for conn in idle:
+            self.born.pop(id(conn), None)
+
+            try:
+                await resolve(conn.close())
+            except Exception:
+                pass
+
+
+class AsyncDb:
+    # driver of the default unbuffered cursors
+    stream_driver = 'aiomysql.cursors'
+
+    def __init__(self, factory, max_size=10, timeout=None, max_lifetime=None,
+                 autocommit=True, debug=False, stream_cursor=None,
+                 cache=None):
+        """
+        Init AsyncDb instance, the asyncio counterpart of PoolDb. Every
+        execution checks out its own connection so concurrent tasks can
+        share one AsyncDb.
+
+        :param callable factory: returns a new connection or an awaitable,
+            e.g. functools.partial(aiomysql.connect, ...)
+        :param int max_size: max open connections
+        :param float timeout: max seconds to wait for a checkout
+        :param float max_lifetime: seconds before a connection is recycled
+        :param bool autocommit: commit statements run outside transaction()
+        :param bool debug: default False
+        :param stream_cursor: cursor class for streaming, default the
+            driver's unbuffered SSDictCursor
+        :param Cache cache: result cache for queries run with cache=True
+        :return: AsyncDb instance
+        """
+        self.pool = AsyncPool(factory, max_size, timeout, max_lifetime)
+        self.autocommit = autocommit
+        self.debug = debug
+        self.stream_cursor = stream_cursor
+        self.cache = cache
+        self.hooks = []
+        # connection of the transaction open in the current task
+        self.tx = ContextVar('tx', default=None)
+        # tables it wrote
+        self.tx_tables = ContextVar('tx_tables', default=None)
+
+    add_hook = Db.add_hook
+    remove_hook = Db.remove_hook
+    stream_class = Db.stream_class
+    cache_get = Db.cache_get
+    cache_set = Db.cache_set
+    written = Db.written
+    committed = Db.committed
+
+    def sql(self, model=None):
+        """
+        Create a Sql instance, await its rocks()
+
+        :param type model: Model class issuing it
+        :return: Sql instance
+        """
+        return Sql(db=self, model=model)
+
+    def select(self, expr='*'):
+        """
+        Create a Sql instance
+
+        :param Sql|str|Iterable expr: expression
+        :return: Sql instance
+        """
+        return self.sql().select(expr)
+
+    count_sql = Db.count_sql
+    approx_sql = Db.approx_sql
+
+    async def count(self, table, where=None, cache=False, model=None,
+                    approx=False, max=None):
+        """
+        Count table
+
+        :param str table: table name
+        :param dict|list|tuple|str where: where conditions
+        :param bool|float cache: read through the result cache
+        :param type model: Model class issuing it, reported to hooks
+        :param bool approx: estimate, see Db.count()
+        :param int max: stop counting at max rows
+        :return: int
+        """
+        if approx:
+            cur = await self.approx_sql(table, where, model).rocks(cache)
+            rows = Db.estimated(cur, cur.fetchone())
+
+            if rows is not None:
+                return rows if max is None else min(rows, max)
+
+        sql = self.count_sql(table, where, max, model)
+        result = (await sql.rocks(cache)).fetchone()
+        return result['COUNT(*)'] if isinstance(result, dict) else result[0]
+
+    async def exists(self, table, where=None, model=None):
+        """
+        Whether a row matches, SELECT 1 ... LIMIT 1
+
+        :param str table: table name
+        :param dict|list|tuple|str where: where conditions
+        :param type model: Model class issuing it, reported to hooks
+        :return: bool
+        """
+        sql = self.sql(model).select('1').fr('`%s`' % table).where(where)
+        return (await sql.limit(1).rocks()).fetchone() is not None
+
+    async def describe(self, table):
+        """
+        Columns of a table
+
+        :param str table: table name
+        :return: SHOW COLUMNS rows
+        """
+        sql = 'SHOW COLUMNS FROM `%s`' % table
+        return (await self.execute(sql)).fetchall()
+
+    async def insert(self, table, data, model=None):
+        """
+        Insert clause
+
+        :param str table: table name
+        :param dict data: data
+        :param type model: Model class issuing it, reported to hooks
+        :return: last row id
+        """
+        self.touch(table)
+        sql = self.sql(model).insert(table).set(data)
+        lastrowid = (await sql.rocks()).lastrowid
+        self.written(table)
+        return lastrowid
+
+    async def update(self, table, data, where=None, order_by=None,
+                     limit=None, model=None):
+        """
+        Update clause
+
+        :param str table: table name
+        :param dict data: data
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        self.touch(table)
+        sql = self.sql(model).update(table).set(data).where(where)
+        rowcount = (await sql.order_by(order_by).limit(limit).rocks()).rowcount
+        self.written(table)
+        return rowcount
+
+    async def save(self, table, data, pk, insert=None, upsert=False,
+                   model=None):
+        """
+        Save data
+
+        :param str table: table name
+        :param dict data: data
+        :param str pk: primary key
+        :param bool insert: insert
+        :param bool upsert: insert or update in one statement, see upsert()
+        :param type model: Model class issuing it, reported to hooks
+        :return: last row id or affected rows, (inserted, updated) on upsert
+        """
+        if upsert:
+            return await self.upsert(table, data, pk=pk, model=model)
+        elif insert or pk not in data:
+            return await self.insert(table, data, model)
+        else:
+            sub_data = {k: data[k] for k in data if k != pk}
+            return await self.update(table, sub_data, (pk, data[pk]),
+                                     model=model)
+
+    async def delete(self, table, where=None, order_by=None, limit=None,
+                     model=None):
+        """
+        Delete clause
+
+        :param str table: table name
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        self.touch(table)
+        sql = self.sql(model).delete().fr('`%s`' % table).where(where)
+        rowcount = (await sql.order_by(order_by).limit(limit).rocks()).rowcount
+        self.written(table)
+        return rowcount
+
+    insert_sqls = Db.insert_sqls
+    update_sqls = Db.update_sqls
+    case_sql = Db.case_sql
+
+    async def insert_many(self, table, rows, chunk_rows=1000,
+                          max_packet_bytes=None, model=None):
+        """
+        Insert rows with multi-row VALUES statements, see Db.insert_many()
+
+        :param str table: table name
+        :param Iterable rows: dicts sharing the same keys
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :param type model: Model class issuing it, reported to hooks
+        :return: (affected rows, first insert id) per statement
+        """
+        return [(result.rowcount, result.lastrowid) async for size, result
+                in self.insert_chunks(table, rows, chunk_rows,
+                                      max_packet_bytes, model=model)]
+
+    async def insert_chunks(self, table, rows, chunk_rows=1000,
+                            max_packet_bytes=None, update=None, pk=None,
+                            model=None):
+        """
+        Execute multi-row inserts chunk by chunk, see Db.insert_chunks()
+
+        :param str table: table name
+        :param Iterable rows: dicts sharing the same keys
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :param dict|Sql|str|Iterable|bool update: add ON DUPLICATE KEY
+            UPDATE, True updates every column but pk
+        :param str pk: primary key
+        :param type model: Model class issuing it, reported to hooks
+        :return: async generator of (rows in chunk, Result instance)
+        """
+        for size, sql in self.insert_sqls(table, rows, chunk_rows,
+                                          max_packet_bytes, update, pk,
+                                          model):
+            self.touch(table)
+            result = await sql.rocks()
+            self.written(table)
+
+            yield size, result
+
+    async def upsert(self, table, data, update=None, pk=None, chunk_rows=1000,
+                     max_packet_bytes=None, model=None):
+        """
+        Insert rows, updating the existing ones in the same statement, see
+        Db.upsert()
+
+        :param str table: table name
+        :param dict|Iterable data: a dict or dicts sharing the same keys
+        :param dict|Sql|str|Iterable update: on duplicate key update, default
+            every column but pk takes the inserted value
+        :param str pk: primary key
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :param type model: Model class issuing it, reported to hooks
+        :return: (inserted, updated)
+        """
+        rows = [data] if isinstance(data, dict) else data
+        inserted = updated = 0
+
+        async for size, result in self.insert_chunks(
+                table, rows, chunk_rows, max_packet_bytes, update or True, pk,
+                model):
+            extra = Db.upserted(size, result.rowcount)
+            updated += extra
+            inserted += min(result.rowcount, size) - extra
+
+        return inserted, updated
+
+    async def update_many(self, table, rows, key='id', chunk_rows=1000,
+                          case=True, model=None):
+        """
+        Update rows with different values in a few statements, in one
+        transaction(), the caller's when one is open, see Db.update_many()
+
+        :param str table: table name
+        :param Iterable rows: dicts holding the key and the new values
+        :param str|list|tuple key: key column(s) identifying the rows
+        :param int chunk_rows: max rows per statement
+        :param bool case: use CASE updates where possible
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        async with self.transaction():
+            return sum([rowcount async for rowcount in self.update_chunks(
+                table, rows, key, chunk_rows, case, model)])
+
+    async def update_chunks(self, table, rows, key='id', chunk_rows=1000,
+                            case=True, model=None):
+        """
+        Execute batched updates chunk by chunk, see Db.update_chunks()
+
+        :param str table: table name
+        :param Iterable rows: dicts holding the key and the new values
+        :param str|list|tuple key: key column(s) identifying the rows
+        :param int chunk_rows: max rows per statement
+        :param bool case: use CASE updates where possible
+        :param type model: Model class issuing it, reported to hooks
+        :return: async generator of affected rows
+        """
+        for sql, args, many in self.update_sqls(table, rows, key, chunk_rows,
+                                                case, model):
+            self.touch(table)
+
+            if many:
+                rowcount = await self.executemany(sql, args, model)
+            else:
+                rowcount = (await self.execute(sql, args,
+                                               model=model)).rowcount
+
+            self.written(table)
+
+            yield rowcount
+
+    async def save_many(self, table, rows, pk='id', chunk_rows=1000,
+                        model=None):
+        """
+        Save rows in batches, in one transaction(), the caller's when one is
+        open, see Db.save_many()
+
+        :param str table: table name
+        :param Iterable rows: dicts
+        :param str pk: primary key
+        :param int chunk_rows: max rows per statement
+        :param type model: Model class issuing it, reported to hooks
+        :return: (inserted rows, updated rows)
+        """
+        inserts, updates = Db.save_groups(rows, pk)
+        inserted = 0
 
-        :param str item: item
-        :return:
+        async with self.transaction():
+            for group in inserts:
+                async for size, result in self.insert_chunks(
+                        table, group, chunk_rows, model=model):
+                    inserted += result.rowcount
+
+            updated = sum([rowcount async for rowcount in self.update_chunks(
+                table, updates, pk, chunk_rows, model=model)])
+
+        return inserted, updated
+
+    async def executemany(self, sql, seq_args, model=None):
         """
-        if item in self._row:
-            return self._row[item]
-        else:
-            raise AttributeError
+        Execute sql once per args, on one connection
 
-    def __getitem__(self, item):
+        :param str sql: sql
+        :param Iterable seq_args: args of each execution
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
         """
-        Get field from item
+        conn = self.tx.get()
 
-        :param str item: item
-        :return:
+        if conn is None:
+            async with self.transaction():
+                return await self.executemany(sql, seq_args, model)
+
+        cur = await self.cursor(conn)
+
+        try:
+            await self.call(cur, sql, seq_args, model, 'executemany')
+            return cur.rowcount
+        finally:
+            await resolve(cur.close())
+
+    async def gather(self, *queries, timeout=None):
         """
-        if item in self._row:
-            return self._row[item]
-        else:
-            raise AttributeError
+        Run independent queries concurrently, each on its own pooled
+        connection, and return their results in order. On the first error
+        or timeout the others are cancelled and the error is raised. Inside
+        a transaction they run one by one on its connection.
+
+        :param Sql|callable queries: Sql to fetch, or callables returning
+            an awaitable or a value
+        :param float timeout: max seconds per query
+        :return: list of Result instances or callable return values
+        """
+        if self.tx.get() is not None:
+            return [await self.perform(query, timeout) for query in queries]
 
-    @classmethod
-    def to_obj(cls, data):
+        tasks = [asyncio.ensure_future(self.perform(query, timeout))
+                 for query in queries]
+
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        errors = [task.exception() for task in tasks
+                  if task in done and not task.cancelled()]
+        errors = [e for e in errors if e is not None]
+
+        if errors:
+            raise errors[0]
+
+        return [task.result() for task in tasks]
+
+    async def perform(self, query, timeout=None):
         """
-        Mapping table row(s) to class object(s)
+        Run one query of gather()
 
-        :param list|tuple|dict data: table rows
-        :return: class objects
+        :param Sql|callable query: query
+        :param float timeout: max seconds
+        :return: Result instance or callable return value
         """
-        if data is None:
-            return None
-        elif isinstance(data, dict):
-            return cls(data)
+        if isinstance(query, Sql):
+            value = self.execute(query.sql, query.args, model=query.model)
         else:
-            return [cls(i) for i in data]
+            value = resolve(query())
 
-    @classmethod
-    def select(cls, expr='*'):
+        try:
+            return await asyncio.wait_for(value, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('query unfinished in %ss' % timeout) from None
+
+    async def rocks(self, sql, args=None, model=None):
         """
-        Select clause
+        Execute sql
 
-        :param Sql|str|Iterable expr: expression
-        :return: Sql instance
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param type model: Model class issuing it, reported to hooks
+        :return: affected rows
+        """
+        return (await self.execute(sql, args, model=model)).rowcount
+
+    async def execute(self, sql, args=None, cache=False, model=None):
+        """
+        Execute sql on a pooled connection and buffer the result
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param bool|float cache: read through the result cache
+        :param type model: Model class issuing it, reported to hooks
+        :return: Result instance
+        """
+        if isinstance(sql, Template):
+            sql, args = sql.sql, sql.bind(args if args else {})
+
+        if not cache or self.cache is None:
+            return await self.run(sql, args, model)
+
+        key, result = self.cache_get(sql, args)
+
+        if key is None:
+            return await self.run(sql, args, model)
+
+        if result is None:
+            result = await self.run(sql, args, model)
+            self.cache_set(key, result, cache)
+
+        return result.copy()
+
+    async def run(self, sql, args=None, model=None):
+        """
+        Execute sql on the transaction connection or a checked out one
+
+        :param str sql: sql
+        :param Iterable args: args
+        :param type model: Model class issuing it, reported to hooks
+        :return: Result instance
+        """
+        conn = self.tx.get()
+
+        if conn is not None:
+            return await self.query(conn, sql, args, model)
+
+        conn = await self.pool.acquire()
+
+        try:
+            result = await self.query(conn, sql, args, model)
+
+            if self.autocommit:
+                await resolve(conn.commit())
+        except Exception:
+            await self.pool.release(conn, True)
+            raise
+
+        await self.pool.release(conn)
+
+        return result
+
+    async def query(self, conn, sql, args=None, model=None):
+        """
+        Execute sql on the connection
+
+        :param conn: connection
+        :param str sql: sql
+        :param Iterable args: args
+        :param type model: Model class issuing it, reported to hooks
+        :return: Result instance
+        """
+        cur = await self.cursor(conn)
+
+        try:
+            await self.call(cur, sql, args, model)
+            rows = await resolve(cur.fetchall()) if cur.description else ()
+            return Result(cur.description, tuple(rows), cur.rowcount,
+                          cur.lastrowid)
+        finally:
+            await resolve(cur.close())
+
+    async def call(self, cur, sql, args=None, model=None, method='execute'):
+        """
+        Run cur.execute() or cur.executemany(), through the hooks if any
+
+        :param cur: cursor
+        :param str sql: sql
+        :param Iterable args: args
+        :param type model: Model class issuing it, reported to hooks
+        :param str method: execute or executemany
+        :return: what the cursor returns
+        """
+        if self.debug:
+            print('%s\n%s' % (sql, args))
+
+        if not self.hooks:
+            return await resolve(getattr(cur, method)(sql, args))
+
+        event = QueryEvent.start(self.hooks, sql, args, model)
+
+        try:
+            result = await resolve(getattr(cur, method)(sql, args))
+        except Exception as e:
+            event.fail(e)
+            raise
+
+        event.finish(cur.rowcount)
+
+        return result
+
+    @staticmethod
+    async def cursor(conn, cursorclass=None):
+        """
+        Create a new cursor
+
+        :param conn: connection
+        :param cursorclass: cursor class, default the connection's
+        :return: cursor
+        """
+        if cursorclass is None:
+            return await resolve(conn.cursor())
+        return await resolve(conn.cursor(cursorclass))
+
+    @asynccontextmanager
+    async def stream(self, sql, args=None, cursorclass=None, model=None):
+        """
+        Execute sql on a new cursor, unbuffered (server-side) by default,
+        the connection stays checked out until the block exits
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param cursorclass: cursor class, default self.stream_class()
+        :param type model: Model class issuing it, reported to hooks
+        :return: cursor, await its fetch methods
+        """
+        if isinstance(sql, Template):
+            sql, args = sql.sql, sql.bind(args if args else {})
+
+        cursorclass = self.stream_class(cursorclass)
+
+        conn = self.tx.get()
+        owned = conn is None
+
+        if owned:
+            conn = await self.pool.acquire()
+
+        done = False
+
+        try:
+            cur = await self.cursor(conn, cursorclass)
+
+            try:
+                await self.call(cur, sql, args, model)
+                yield cur
+            finally:
+                await resolve(cur.close())
+
+            done = True
+        finally:
+            if owned:
+                await self.pool.release(conn, not done)
+
+    async def iter(self, sql, args=None, batch_size=1000):
+        """
+        Iterate rows lazily, fetching batch_size rows at a time
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param int batch_size: rows per fetch
+        :return: async generator of rows
+        """
+        async with self.stream(sql, args) as cur:
+            while True:
+                rows = await resolve(cur.fetchmany(batch_size))
+
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield row
+
+    async def fetch_columns(self, sql, args=None, dtype_map=None,
+                            batch_size=10000, cursorclass=None, model=None):
+        """
+        Fetch the result into NumPy arrays, see Db.fetch_columns()
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param dict dtype_map: column name => dtype, the others are inferred
+        :param int batch_size: rows per fetch
+        :param cursorclass: cursor class, default self.stream_class(None,
+            True)
+        :param type model: Model class issuing it, reported to hooks
+        :return: dict, column name => array
+        """
+        cursorclass = self.stream_class(cursorclass, True)
+
+        async with self.stream(sql, args, cursorclass, model) as cur:
+            columns = Columns(cur.description, dtype_map, batch_size)
+
+            while True:
+                rows = await resolve(cur.fetchmany(batch_size))
+
+                if not rows:
+                    break
+
+                columns.add(rows)
+
+        return columns.result()
+
+    def touch(self, table):
+        """
+        Forget what is cached about a table, called before writing to it
+
+        :param str table: table name
+        """
+        if self.cache is not None:
+            self.cache.invalidate(table)
+
+    def uncommitted(self):
+        """
+        Tables written by the transaction of the current task, statements
+        outside one are committed as they run
+
+        :return: set, None outside a transaction
+        """
+        return self.tx_tables.get()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Run the statements of the block, in this task, on one connection
+        and in one transaction, committed on success and rolled back on
+        error. Nested blocks join the outer transaction.
+        """
+        if self.tx.get() is not None:
+            yield self
+            return
+
+        conn = await self.pool.acquire()
+        token = self.tx.set(conn)
+        tables = self.tx_tables.set(set())
+        ok = False
+
+        try:
+            yield self
+            await resolve(conn.commit())
+            self.committed()
+            ok = True
+        except Exception:
+            try:
+                await resolve(conn.rollback())
+                ok = True
+            except Exception:
+                pass
+            raise
+        finally:
+            self.tx_tables.reset(tables)
+            self.tx.reset(token)
+            await self.pool.release(conn, not ok)
+
+    async def close(self):
         """
-        return cls.db.select(expr).fr(cls.table)
+        Close the pool
+        """
+        await self.pool.close()
+
+
+class AsyncModel(Model):
+    """
+    Model backed by an AsyncDb, queries are coroutines:
+    await Song.get(1), async for row in Song.iter(...). Attribute access can
+    not await, so the default projection reads the deferred columns too.
+
+    :type db: AsyncDb
+    """
 
     @classmethod
-    def get(cls, pk, expr='*', fetch_obj=True):
+    async def get(cls, pk, expr=None, fetch_obj=True):
         """
         Get row(s) by pk(s)
 
         :param int|str|Iterable pk: primary key(s)
-        :param Sql|str|Iterable expr: expression
+        :param Sql|str|Iterable expr: expression, default the projection()
         :param fetch_obj: default True
         :return row(s)
         """
+        if expr is None:
+            expr = cls.eager_expr()
+
         if isinstance(pk, Iterable) and not isinstance(pk, str):
-            data = cls.select(expr).where((cls.pk, 'IN', pk)).rocks().fetchall()
+            sql = cls.select(expr).where((cls.pk, 'IN', pk))
+            data, description = await cls.fetch(sql.sql, sql.args)
+        elif isinstance(expr, str) and cls.templated():
+            tpl = cls.prepare(('get', expr), lambda: Sql().select(expr).fr(
+                cls.table).where((cls.pk, Param('pk'))))
+            data, description = await cls.fetch(tpl, {'pk': pk}, one=True)
         else:
-            data = cls.select(expr).where((cls.pk, pk)).rocks().fetchone()
+            sql = cls.select(expr).where((cls.pk, pk))
+            data, description = await cls.fetch(sql.sql, sql.args, one=True)
 
-        return cls.to_obj(data) if fetch_obj else data
+        return cls.to_obj(data, description) if fetch_obj else data
 
     @classmethod
-    def one(cls, expr='*', where=None, order_by=None, fetch_obj=True):
+    async def one(cls, expr=None, where=None, order_by=None, fetch_obj=True,
+                  cache=False):
         """
         Get one row
 
-        :param Sql|str|Iterable expr: expression
+        :param Sql|str|Iterable expr: expression, default the projection()
         :param dict|list|tuple|str where: where conditions
         :param str|Iterable order_by: order_by
         :param fetch_obj: default True
+        :param bool|float cache: read through the Db result cache
         :return row
         """
-        sql = cls.select(expr).where(where).order_by(order_by).limit(1)
-        row = sql.rocks().fetchone()
-        return cls.to_obj(row) if fetch_obj else row
+        if expr is None:
+            expr = cls.eager_expr()
+
+        sql = cls.one_sql(expr, where, order_by)
+        row, description = await cls.fetch(sql.sql, sql.args, cache, True)
+        return cls.to_obj(row, description) if fetch_obj else row
 
     @classmethod
-    def first(cls, expr='*', fetch_obj=True):
+    async def first(cls, expr=None, fetch_obj=True):
         """
         Get first row
 
-        :param Sql|str|Iterable expr: expression
+        :param Sql|str|Iterable expr: expression, default the projection()
         :param fetch_obj: default True
         :return row
         """
-        return cls.one(expr=expr, order_by=cls.pk, fetch_obj=fetch_obj)
+        return await cls.one(expr=expr, order_by=cls.pk, fetch_obj=fetch_obj)
 
     @classmethod
-    def last(cls, expr='*', fetch_obj=True):
+    async def last(cls, expr=None, fetch_obj=True):
         """
         Get last row
 
-        :param Sql|str|Iterable expr: expression
+        :param Sql|str|Iterable expr: expression, default the projection()
         :param fetch_obj: default True
         :return row
         """
-        return cls.one(expr=expr, order_by='-' + cls.pk, fetch_obj=fetch_obj)
+        return await cls.one(expr=expr, order_by='-' + cls.pk,
+                             fetch_obj=fetch_obj)
 
     @classmethod
-    def exists(cls, where):
+    async def exists(cls, where=None):
         """
         Exists
 
         :param dict|list|tuple|str where: where conditions
         :return: bool
         """
-        return True if cls.one('*', where, fetch_obj=False) else False
+        return await cls.db.exists(cls.table, where, cls)
 
     @classmethod
-    def all(cls, expr='*', where=None, order_by=None, limit=None,
-            fetch_obj=True):
+    async def all(cls, expr=None, where=None, order_by=None, limit=None,
+                  fetch_obj=True, cache=False):
         """
         Get rows
 
-        :param Sql|str|Iterable expr: expression
+        :param Sql|str|Iterable expr: expression, default the projection()
         :param dict|list|tuple|str where: where conditions
         :param str|Iterable order_by: order_by
         :param list|tuple|int|str limit: limit
         :param fetch_obj: default True
+        :param bool|float cache: read through the Db result cache
         :return: rows
         """
+        if expr is None:
+            expr = cls.eager_expr()
+
+        sql = cls.select(expr).where(where).order_by(order_by).limit(limit)
+        rows, description = await cls.fetch(sql.sql, sql.args, cache)
+        return cls.to_obj(rows, description) if fetch_obj else rows
+
+    @classmethod
+    async def fetch(cls, sql, args=None, cache=False, one=False):
+        """
+        Execute a query of the model and fetch its rows, see Model.fetch()
+
+        :param str|Template sql: sql
+        :param Iterable|dict args: args, param values for a Template
+        :param bool|float cache: read through the Db result cache
+        :param bool one: fetch one row
+        :return: (row(s), cursor description)
+        """
+        db = cls.db
+
+        if cls.compact and not (cache and db.cache is not None):
+            async with db.stream(sql, args, db.stream_class(None, True),
+                                 cls) as cur:
+                fetch = cur.fetchone() if one else cur.fetchall()
+                return await resolve(fetch), cur.description
+
+        cur = await db.execute(sql, args, cache, cls)
+        return cur.fetchone() if one else cur.fetchall(), cur.description
+
+    @classmethod
+    async def iter(cls, expr=None, where=None, order_by=None, limit=None,
+                   batch_size=1000, fetch_obj=True):
+        """
+        Iterate rows lazily with a streaming cursor
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :param int batch_size: rows per fetch
+        :param fetch_obj: default True
+        :return: async generator of rows
+        """
+        if expr is None:
+            expr = cls.eager_expr()
+
+        sql = cls.select(expr).where(where).order_by(order_by).limit(limit)
+        # compact rows are built from tuples
+        cursorclass = cls.db.stream_class(None, True) if cls.compact else None
+
+        async with cls.db.stream(sql.sql, sql.args, cursorclass,
+                                 cls) as cur:
+            while True:
+                rows = await resolve(cur.fetchmany(batch_size))
+
+                if not rows:
+                    break
+
+                if fetch_obj:
+                    rows = cls.to_obj(rows, cur.description)
+
+                for row in rows:
+                    yield row
+
+    @classmethod
+    async def columns(cls, expr=None, where=None, order_by=None, limit=None,
+                      dtype_map=None, batch_size=10000, cursorclass=None):
+        """
+        Get rows as NumPy arrays, one per column, see Db.fetch_columns()
+
+        :param Sql|str|Iterable expr: expression, default the projection()
+        :param dict|list|tuple|str where: where conditions
+        :param str|Iterable order_by: order_by
+        :param list|tuple|int|str limit: limit
+        :param dict dtype_map: column name => dtype, the others are inferred
+        :param int batch_size: rows per fetch
+        :param cursorclass: cursor class, default self.stream_cursor or the
+            driver's SSCursor
+        :return: dict, column name => array
+        """
         sql = cls.select(expr).where(where).order_by(order_by).limit(limit)
-        rows = sql.rocks().fetchall()
-        return cls.to_obj(rows) if fetch_obj else rows
+        return await cls.db.fetch_columns(sql.sql, sql.args, dtype_map,
+                                          batch_size, cursorclass, cls)
 
     @classmethod
-    def count(cls, where=None):
+    async def count(cls, where=None, cache=False, approx=False, max=None):
         """
         Count table
 
         :param dict|list|tuple|str where: where conditions
+        :param bool|float cache: read through the Db result cache
+        :param bool approx: estimate, see Db.count()
+        :param int max: stop counting at max rows
         :return: int
         """
-        return cls.db.count(cls.table, where)
+        return await cls.db.count(cls.table, where, cache, cls, approx,
+                                  max)
 
     @classmethod
-    def add(cls, *args, **kwargs):
+    async def add(cls, *args, **kwargs):
         """
         Insert clause
 
         :return: last row id
         """
-        return cls.db.insert(cls.table, args[0] if args else kwargs)
+        return await cls.db.insert(cls.table, args[0] if args else kwargs,
+                                   cls)
+
+    @classmethod
+    async def add_many(cls, rows, chunk_rows=1000, max_packet_bytes=None):
+        """
+        Insert rows in multi-row statements
+
+        :param Iterable rows: dicts sharing the same keys
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :return: (affected rows, first insert id) per statement
+        """
+        return await cls.db.insert_many(cls.table, rows, chunk_rows,
+                                        max_packet_bytes, cls)
 
     @classmethod
-    def saved(cls, data, insert=None):
+    async def saved(cls, data, insert=None, upsert=False):
         """
         Save raw data
 
         :param dict data: data
         :param bool insert: default None
-        :return: last row id or affected rows
+        :param bool upsert: insert or update in one statement
+        :return: last row id or affected rows, (inserted, updated) on upsert
         """
-        return cls.db.save(cls.table, data, cls.pk, insert)
+        return await cls.db.save(cls.table, data, cls.pk, insert, upsert,
+                                 cls)
 
-    def save(self, insert=None):
+    @classmethod
+    async def update_many(cls, rows, chunk_rows=1000, case=True):
+        """
+        Update rows with different values in a few statements
+
+        :param Iterable rows: dicts holding the pk and the new values
+        :param int chunk_rows: max rows per statement
+        :param bool case: use CASE updates where possible
+        :return: affected rows
+        """
+        return await cls.db.update_many(cls.table, rows, cls.pk, chunk_rows,
+                                        case, cls)
+
+    @classmethod
+    async def save_many(cls, objs, chunk_rows=1000):
+        """
+        Save objects like save() in one transaction, see Model.save_many()
+
+        :param Iterable objs: objects
+        :param int chunk_rows: max rows per statement
+        :return: (inserted rows, updated rows)
+        """
+        updates = []
+        merges = []
+        inserted = 0
+
+        async with cls.db.transaction():
+            for obj in objs:
+                row = obj._row
+
+                if cls.pk not in row:
+                    await obj.save()
+                    inserted += 1
+                    continue
+
+                data = {k: obj.__dict__[k] for k in obj.dirty_fields}
+
+                if data:
+                    merges.append((obj, data))
+                    updates.append(dict(data, **{cls.pk: row[cls.pk]}))
+
+            updated = sum([rowcount async for rowcount in
+                           cls.db.update_chunks(cls.table, updates, cls.pk,
+                                                chunk_rows, model=cls)])
+
+        for obj, data in merges:
+            obj._merge(data)
+
+        return inserted, updated
+
+    @classmethod
+    async def upsert(cls, data, update=None, chunk_rows=1000,
+                     max_packet_bytes=None):
         """
-        Save object
+        Insert row(s), updating the existing ones in the same statement
+
+        :param dict|Iterable data: a dict or dicts sharing the same keys
+        :param dict|Sql|str|Iterable update: on duplicate key update
+        :param int chunk_rows: max rows per statement
+        :param int max_packet_bytes: max estimated statement size
+        :return: (inserted, updated)
+        """
+        return await cls.db.upsert(cls.table, data, update, cls.pk,
+                                   chunk_rows, max_packet_bytes, cls)
+
+    async def save(self, insert=None):
+        """
+        Save object, an update only writes the dirty fields and is skipped
+        when there are none
 
         :param bool insert: default None
         :return: last row id or affected rows
         """
-        data = self.fields_filter(self.__dict__)
+        row = self._row
 
-        if self.pk in self._row and not insert:
+        if self.pk in row and not insert:
             # update
-            where = (self.pk, self._row[self.pk])
-            return self.db.update(self.table, data, where)
+            data = {k: self.__dict__[k] for k in self.dirty_fields}
+
+            if not data:
+                return 0
+
+            result = await self.db.update(self.table, data,
+                                          (self.pk, row[self.pk]),
+                                          model=type(self))
         else:
             # insert or update
-            data.update({k: self._row[k] for k in self._row if k not in data})
-            return self.db.save(self.table, data, self.pk, insert)
+            data = self.fields_filter(self.__dict__)
+            data.update({k: row[k] for k in row if k not in data})
+            result = await self.db.save(self.table, data, self.pk, insert,
+                                        model=type(self))
+
+            if self.pk not in data:
+                data[self.pk] = result
+
+        self._merge(data)
+
+        return result
 
     @classmethod
-    def update(cls, data, where=None, order_by=None, limit=None):
+    async def update(cls, data, where=None, order_by=None, limit=None):
         """
         Update clause
 
@@ -753,10 +6307,11 @@ class Model:
         :param list|tuple|int|str limit: limit
         :return: affected rows
         """
-        return cls.db.update(cls.table, data, where, order_by, limit)
+        return await cls.db.update(cls.table, data, where, order_by, limit,
+                                   cls)
 
     @classmethod
-    def delete(cls, where=None, order_by=None, limit=None):
+    async def delete(cls, where=None, order_by=None, limit=None):
         """
         Delete clause
 
@@ -765,44 +6320,144 @@ class Model:
         :param list|tuple|int|str limit: limit
         :return: affected rows
         """
-        return cls.db.delete(cls.table, where, order_by, limit)
+        return await cls.db.delete(cls.table, where, order_by, limit, cls)
 
-    def remove(self):
+    async def remove(self):
         """
         Delete object
 
         :return: affected rows
         """
-        return self.db.delete(self.table, (self.pk, getattr(self, self.pk)))
+        return await self.db.delete(self.table,
+                                    (self.pk, getattr(self, self.pk)),
+                                    model=type(self))
 
     @classmethod
-    def get_fields(cls):
+    async def scan(cls, batch_size=1000, where=None, expr='*', key=None,
+                   desc=False, fetch_obj=True):
         """
-        Get table fields
+        Walk the table in key order with keyset (seek) pagination, see
+        Model.scan()
 
-        :return: fields
-        :rtype list|tuple|set
+        :param int batch_size: rows per batch
+        :param dict|list|tuple|str where: where conditions
+        :param Sql|str|Iterable expr: expression, must include the key
+        :param str|list|tuple key: key column(s), default cls.pk
+        :param bool desc: walk in descending order
+        :param fetch_obj: default True
+        :return: async generator of row batches
         """
-        return {}
+        key = cls.pk if key is None else key
+        keys = [key] if isinstance(key, str) else list(key)
+        order_by = ', '.join(k + ' DESC' for k in keys) if desc else keys
+        op = '<' if desc else '>'
+        last = None
+
+        while True:
+            seek = Model.seek_cond(keys, last, op) if last else None
+            sql = cls.select(expr).where(Sql.and_where(where, seek))
+            cur = await sql.order_by(order_by).limit(batch_size).rocks()
+            rows = cur.fetchall()
+
+            if not rows:
+                break
+
+            if fetch_obj:
+                yield cls.to_obj(rows, cur.description)
+            else:
+                yield rows
+
+            if len(rows) < batch_size:
+                break
+
+            last = Model.seek_last(rows[-1], keys, cur.description)
 
     @classmethod
-    def fields_filter(cls, data):
+    def loader(cls, max_in=1000, expr='*', fetch_obj=True):
         """
-        Remove irrelevant fields
+        Get a batching loader, load() queues pks and awaiting one of them
+        fetches all the queued ones with WHERE pk IN (...)
 
-        :param dict data: data
-        :return: clean data
+        :param int max_in: max pks per IN list
+        :param Sql|str|Iterable expr: expression, must select the pk
+        :param bool fetch_obj: default True
+        :return: AsyncLoader instance
         """
-        fields = cls.get_fields()
-        return {k: data[k] for k in data if k in fields}
+        return AsyncLoader(cls, max_in, expr, fetch_obj)
 
     @classmethod
-    def rocks(cls, sql, args=None):
+    async def gather(cls, *queries, timeout=None, fetch_obj=True):
+        """
+        Run independent queries with AsyncDb.gather(), e.g.
+        await Song.gather(Song.select().where(...), Song.count)
+
+        :param Sql|callable queries: Sql to fetch, or callables returning
+            an awaitable or a value
+        :param float timeout: max seconds per query
+        :param fetch_obj: map the rows of Sql queries to objects
+        :return: list of rows or callable return values
+        """
+        results = await cls.db.gather(*queries, timeout=timeout)
+
+        for i, query in enumerate(queries):
+            if isinstance(query, Sql):
+                rows = results[i].fetchall()
+
+                if fetch_obj:
+                    rows = cls.to_obj(rows, results[i].description)
+
+                results[i] = rows
+
+        return results
+
+    def load_deferred(self, col, max_in=1000):
+        """
+        Deferred columns can not be loaded by attribute access here, they
+        are selected unless an expr leaves them out
+
+        :param str col: column name
+        :param int max_in: unused
+        """
+        raise AttributeError('%s is deferred, select it with expr' % col)
+
+    @classmethod
+    def schema(cls):
+        """
+        Get the table schema, load_schema() must have been awaited unless
+        it is in a snapshot
+
+        :return: Schema instance
+        """
+        schema = cls.schemas.load().get(cls.table)
+
+        if schema is None:
+            raise RuntimeError('await %s.load_schema() first' % cls.__name__)
+
+        return schema
+
+    @classmethod
+    async def load_schema(cls):
+        """
+        Introspect the table once per process
+
+        :return: Schema instance
+        """
+        schema = cls.schemas.load().get(cls.table)
+
+        if schema is None:
+            rows = await cls.db.describe(cls.table)
+            schema = Schema.from_rows(cls.table, rows)
+            cls.schemas.add(schema)
+
+        return schema
+
+    @classmethod
+    async def rocks(cls, sql, args=None):
         """
         Execute sql
 
         :param str sql: sql
         :param Iterable args: args
-        :return:
+        :return: affected rows
         """
-        return cls.db.rocks(sql, args)
+        return await cls.db.rocks(sql, args, cls)
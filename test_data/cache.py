@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+expire = [
+    {
+        'ttl': 10,
+        'elapsed': 5,
+        'hit': True,
+    },
+    {
+        'ttl': 10,
+        'elapsed': 10,
+        'hit': False,
+    },
+    {
+        'ttl': None,
+        'elapsed': 86400,
+        'hit': True,
+    },
+]
+
+invalidate = [
+    {
+        'entries': {
+            'a': ['song'],
+            'b': ['song', 'singer'],
+            'c': ['singer'],
+        },
+        'table': 'song',
+        'expected': {'c'},
+    },
+    {
+        'entries': {
+            'a': ['song'],
+            'b': [],
+        },
+        'table': 'singer',
+        'expected': {'a', 'b'},
+    },
+]
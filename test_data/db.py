@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from sqlrocks import *
 from test_data.config import *
 
 count = [
@@ -51,6 +52,66 @@ insert = [
     },
 ]
 
+insert_many = [
+    {
+        'rows': [{'name': 'n%s' % i, 'tag': 't%s' % i} for i in range(5)],
+        'chunk_rows': 1000,
+        'max_packet_bytes': None,
+        'expected': [5],
+    },
+    {
+        'rows': [{'name': 'n%s' % i, 'tag': 't%s' % i} for i in range(5)],
+        'chunk_rows': 2,
+        'max_packet_bytes': None,
+        'expected': [2, 2, 1],
+    },
+    {
+        'rows': ({'name': 'n%s' % i, 'tag': "'%s'" % i} for i in range(3)),
+        'chunk_rows': 1000,
+        'max_packet_bytes': 1,
+        'expected': [1, 1, 1],
+    },
+    {
+        'rows': [{'name': 'x' * 40}, {'name': 'y' * 40}, {'name': 'z'}],
+        'chunk_rows': 1000,
+        'max_packet_bytes': 140,
+        'expected': [2, 1],
+    },
+    {
+        'rows': [],
+        'chunk_rows': 1000,
+        'max_packet_bytes': None,
+        'expected': [],
+    },
+]
+
+iter = [
+    {
+        'dataset': {
+            table_song: [{'id': i, 'name': 'n%s' % i} for i in range(1, 8)]
+        },
+        'where': None,
+        'batch_size': 3,
+        'expected': list(range(1, 8)),
+    },
+    {
+        'dataset': {
+            table_song: [{'id': i, 'name': 'n%s' % i} for i in range(1, 8)]
+        },
+        'where': ('id', '>', 5),
+        'batch_size': 1000,
+        'expected': [6, 7],
+    },
+    {
+        'dataset': {
+            table_song: []
+        },
+        'where': None,
+        'batch_size': 2,
+        'expected': [],
+    },
+]
+
 update = [
     {
         'dataset': {
@@ -91,6 +152,105 @@ save = [
     },
 ]
 
+upsert = [
+    {
+        'dataset': {
+            'song': [
+                {'id': 1, 'name': 'Mojito', 'singer': 'Jay Chou'},
+            ],
+        },
+        'rows': [
+            {'id': 1, 'name': 'Mojito', 'singer': 'Jay'},
+            {'id': 2, 'name': 'Stubborn', 'singer': 'Mayday'},
+            {'id': 3, 'name': 'Sunny Day', 'singer': 'Jay Chou'},
+        ],
+        'update': None,
+        'expected': (2, 1),
+    },
+    {
+        'dataset': {
+            'song': [
+                {'id': 1, 'name': 'Mojito', 'singer': 'Jay Chou'},
+            ],
+        },
+        'rows': [
+            {'id': 1, 'name': 'Mojito', 'singer': 'Jay Chou', 'tag': 'pop'},
+        ],
+        'update': ['tag'],
+        'expected': (0, 1),
+    },
+]
+
+update_many = [
+    {
+        'dataset': {
+            table_song: [
+                {'id': 1, 'name': 'Mojito', 'tag': ''},
+                {'id': 2, 'name': 'Stubborn', 'tag': ''},
+                {'id': 3, 'name': 'Sunny Day', 'tag': ''},
+            ],
+        },
+        'rows': [
+            {'id': 1, 'tag': 'pop'},
+            {'id': 2, 'tag': 'rock'},
+            {'id': 3, 'name': 'Rainy Day', 'tag': 'pop'},
+        ],
+        'key': 'id',
+        'case': True,
+        'expected': 3,
+    },
+    {
+        'dataset': {
+            table_song: [
+                {'id': 1, 'name': 'Mojito', 'tag': ''},
+                {'id': 2, 'name': 'Stubborn', 'tag': ''},
+            ],
+        },
+        'rows': [
+            {'id': 2, 'tag': 'rock'},
+            {'id': 1, 'tag': 'pop'},
+            {'id': 86, 'tag': 'none'},
+        ],
+        'key': 'id',
+        'case': False,
+        'expected': 2,
+    },
+    {
+        'dataset': {
+            table_song: [
+                {'id': 1, 'name': 'Mojito', 'singer': 'Jay Chou'},
+                {'id': 2, 'name': 'Mojito', 'singer': 'kuga'},
+            ],
+        },
+        'rows': [
+            {'name': 'Mojito', 'singer': 'Jay Chou', 'tag': 'pop'},
+            {'name': 'Mojito', 'singer': 'kuga', 'tag': 'cover'},
+        ],
+        'key': ('name', 'singer'),
+        'case': True,
+        'expected': 2,
+    },
+]
+
+save_many = [
+    {
+        'dataset': {
+            table_song: [
+                {'id': 1, 'name': 'Mojito', 'tag': ''},
+                {'id': 2, 'name': 'Stubborn', 'tag': ''},
+            ],
+        },
+        'rows': [
+            {'id': 1, 'tag': 'pop'},
+            {'name': 'Sunny Day', 'tag': 'pop'},
+            {'id': 2, 'tag': 'rock'},
+            {'name': 'Rainy Day'},
+            {'name': 'Cloudy Day'},
+        ],
+        'expected': (3, 2),
+    },
+]
+
 delete = [
     {
         'dataset': {
@@ -122,3 +282,185 @@ delete = [
         'affected_rows': 2,
     },
 ]
+
+tables = [
+    {
+        'sql': 'SELECT COUNT(*) FROM `song` WHERE `id`=%s',
+        'expected': {'song'},
+    },
+    {
+        'sql': 'SELECT * FROM `song` AS `s` LEFT JOIN singer ON '
+               's.singer = singer.name',
+        'expected': {'song', 'singer'},
+    },
+    {
+        'sql': 'SELECT * FROM (SELECT * FROM `song`) AS `t` '
+               'INNER JOIN `album` USING (`id`)',
+        'expected': {'song', 'album'},
+    },
+]
+
+rocks_template = [
+    {
+        'dataset': {
+            table_song: [
+                {'id': 1, 'name': 'secret', 'tag': ''},
+                {'id': 2, 'name': 'abcdef', 'tag': 'band'},
+            ]
+        },
+        'sql': Sql().select(['id', 'name']).fr(table_song).where(
+            ('id', Param('id'))),
+        'values': [{'id': 2}, {'id': 1}, {'id': 3}],
+        'expected': [
+            {'id': 2, 'name': 'abcdef'},
+            {'id': 1, 'name': 'secret'},
+            None,
+        ],
+    },
+]
+
+route = [
+    {
+        'sql': 'SELECT * FROM song WHERE (id = %s)',
+        'replica': True,
+    },
+    {
+        'sql': '  select id from song',
+        'replica': True,
+    },
+    {
+        'sql': '(SELECT 1) UNION (SELECT 2)',
+        'replica': True,
+    },
+    {
+        'sql': 'SELECT * FROM song WHERE (id = %s) FOR UPDATE',
+        'replica': False,
+    },
+    {
+        'sql': 'SELECT * FROM song LOCK IN SHARE MODE',
+        'replica': False,
+    },
+    {
+        'sql': 'UPDATE `song` SET `tag`=%s',
+        'replica': False,
+    },
+    {
+        'sql': 'SHOW COLUMNS FROM `song`',
+        'replica': False,
+    },
+    {
+        'sql': 'SELECT LAST_INSERT_ID()',
+        'replica': False,
+    },
+    {
+        'sql': 'SELECT SQL_CALC_FOUND_ROWS id FROM song; SELECT FOUND_ROWS()',
+        'replica': False,
+    },
+    {
+        'sql': 'SELECT @rank := @rank + 1 FROM song',
+        'replica': False,
+    },
+]
+
+count_approx = [
+    {
+        'where': None,
+        'approx': False,
+        'max': None,
+        'expected': (5, 'SELECT COUNT(*) FROM `song`'),
+    },
+    {
+        'where': ('is_published', 1),
+        'approx': False,
+        'max': 2,
+        'expected': (2, 'SELECT COUNT(*) FROM (SELECT %s FROM `song` '
+                        'WHERE (is_published = %s) LIMIT %s) AS `t`'),
+    },
+    {
+        'where': None,
+        'approx': True,
+        'max': None,
+        'expected': (5, 'SELECT TABLE_ROWS AS `rows` FROM '
+                        'information_schema.TABLES WHERE '
+                        '(TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s)'),
+    },
+    {
+        'where': ('singer', 'Jay Chou'),
+        'approx': True,
+        'max': 1,
+        'expected': (1, 'EXPLAIN SELECT %s FROM `song` '
+                        'WHERE (singer = %s)'),
+    },
+]
+
+exists_select = [
+    {
+        'where': ('singer', 'Mayday'),
+        'expected': True,
+    },
+    {
+        'where': ('singer', 'Nobody'),
+        'expected': False,
+    },
+    {
+        'where': None,
+        'expected': True,
+    },
+]
+
+column_array = [
+    {
+        'batches': [(1, 2), (3,)],
+        'dtype': None,
+        'expected': ('int64', [1, 2, 3], None),
+    },
+    {
+        'batches': [(None, 2.5), (1.0,)],
+        'dtype': None,
+        'expected': ('float64', [0.0, 2.5, 1.0], [True, False, False]),
+    },
+    {
+        'batches': [('a', None), ('c',)],
+        'dtype': None,
+        'expected': ('object', ['a', None, 'c'], [False, True, False]),
+    },
+    {
+        # falls back to objects
+        'batches': [(1, 2), ('x',)],
+        'dtype': None,
+        'expected': ('object', [1, 2, 'x'], None),
+    },
+    {
+        'batches': [(1, 0), (1,)],
+        'dtype': 'bool',
+        'expected': ('bool', [True, False, True], None),
+    },
+    {
+        # widened, not truncated to 1
+        'batches': [(1, 2), (1.7,)],
+        'dtype': None,
+        'expected': ('float64', [1.0, 2.0, 1.7], None),
+    },
+    {
+        # widened, not cast to True
+        'batches': [(True, False), (2,)],
+        'dtype': None,
+        'expected': ('int64', [1, 0, 2], None),
+    },
+    {
+        'batches': [(None, 1), (2.5,)],
+        'dtype': None,
+        'expected': ('float64', [0.0, 1.0, 2.5], [True, False, False]),
+    },
+    {
+        # out of int64 range
+        'batches': [(1,), (2 ** 70,)],
+        'dtype': None,
+        'expected': ('object', [1, 2 ** 70], None),
+    },
+    {
+        'batches': [(None,), (None,)],
+        'dtype': None,
+        'expected': ('object', [None, None], [True, True]),
+    },
+]
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+A tiny MySQLdb look-alike backed by sqlite3, used by the tests that do not
+need a real MySQL server (pools, routing, bulk writes, ...).
+"""
+
+import re
+import asyncio
+import sqlite3
+
+schema = '''
+CREATE TABLE IF NOT EXISTS `song` (
+  `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+  `name` varchar(256) NOT NULL DEFAULT '',
+  `singer` varchar(256) NOT NULL DEFAULT '',
+  `tag` varchar(256) NOT NULL DEFAULT '',
+  `is_published` tinyint(1) NOT NULL DEFAULT '0'
+);
+'''
+
+insert_set_re = re.compile(r'^INSERT INTO (`\w+`) SET (.*)$', re.S)
+set_item_re = re.compile(r'(`\w+`)=(%s)')
+truncate_re = re.compile(r'^TRUNCATE `(\w+)`$')
+show_columns_re = re.compile(r'^SHOW COLUMNS FROM `(\w+)`$')
+values_func_re = re.compile(r'VALUES\((`\w+`)\)')
+upsert_re = re.compile(r'^INSERT INTO `(\w+)`.* ON DUPLICATE KEY UPDATE ', re.S)
+explain_re = re.compile(r'^EXPLAIN (SELECT .*)$', re.S)
+table_rows_re = re.compile(r'^SELECT TABLE_ROWS AS `rows` '
+                           r'FROM information_schema\.TABLES WHERE')
+
+
+def translate(sql):
+    """
+    Translate the MySQL dialect used by sqlrocks into sqlite
+
+    :param str sql: sql
+    :return: sql
+    """
+    sql = sql.strip()
+
+    m = insert_set_re.match(sql)
+    if m:
+        cols = set_item_re.findall(m.group(2))
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            m.group(1),
+            ', '.join(c for c, _ in cols),
+            ', '.join('%s' for _ in cols),
+        )
+
+    m = truncate_re.match(sql)
+    if m:
+        return 'DELETE FROM `%s`' % m.group(1)
+
+    m = show_columns_re.match(sql)
+    if m:
+        return 'PRAGMA table_info(`%s`)' % m.group(1)
+
+    m = explain_re.match(sql)
+    if m:
+        # one MySQL style plan row, the estimate is the exact count
+        sql = "SELECT 1 AS `id`, 'SIMPLE' AS `select_type`, " \
+              "COUNT(*) AS `rows`, 100.0 AS `filtered` FROM (%s)" % m.group(1)
+
+    sql = sql.replace('LAST_INSERT_ID()', 'last_insert_rowid()')
+
+    if ' ON DUPLICATE KEY UPDATE ' in sql:
+        sql = sql.replace(
+            ' ON DUPLICATE KEY UPDATE ', ' ON CONFLICT DO UPDATE SET ')
+        sql = values_func_re.sub(r'excluded.\1', sql)
+
+    return sql.replace('%s', '?').replace('%%', '%')
+
+
+class Cursor:
+    def __init__(self, conn, dict_rows=True):
+        self.conn = conn
+        self.dict_rows = dict_rows
+        self.cur = conn.raw.cursor()
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+        self.closed = False
+        self.pragma = False
+
+    def execute(self, sql, args=None):
+        self.conn.check()
+        self.conn.executed.append(sql)
+
+        m = truncate_re.match(sql.strip())
+        if m:
+            # TRUNCATE resets AUTO_INCREMENT too
+            self.cur.execute(
+                'DELETE FROM sqlite_sequence WHERE name = ?', (m.group(1),))
+
+        upsert = upsert_re.match(sql.strip())
+        if upsert:
+            before = self.count(upsert.group(1))
+
+        if table_rows_re.match(sql.strip()):
+            # table statistics, the estimate is the exact count
+            sql, args = 'SELECT COUNT(*) AS `rows` FROM `%s`' % args[-1], None
+
+        sql = translate(sql)
+        self.pragma = sql.startswith('PRAGMA table_info')
+
+        self.cur.execute(sql, tuple(args) if args else ())
+        self.description = self.cur.description
+        self.rowcount = self.cur.rowcount
+        self.lastrowid = self.cur.lastrowid
+
+        if upsert:
+            # MySQL counts 1 per inserted row and 2 per updated row
+            inserted = self.count(upsert.group(1)) - before
+            self.rowcount = inserted + 2 * (self.rowcount - inserted)
+
+        return self.rowcount
+
+    def count(self, table):
+        return self.conn.raw.execute(
+            'SELECT COUNT(*) FROM `%s`' % table).fetchone()[0]
+
+    def executemany(self, sql, seq_args):
+        self.conn.check()
+        self.conn.executed.append(sql)
+
+        self.cur.executemany(translate(sql), [tuple(i) for i in seq_args])
+        self.description = None
+        self.rowcount = self.cur.rowcount
+
+        return self.rowcount
+
+    def row(self, row):
+        if row is None:
+            return None
+        elif self.pragma:
+            # mimic SHOW COLUMNS
+            row = (row[1], row[2], 'YES' if not row[3] else 'NO',
+                   'PRI' if row[5] else '', row[4], '')
+            cols = ('Field', 'Type', 'Null', 'Key', 'Default', 'Extra')
+            return dict(zip(cols, row)) if self.dict_rows else row
+        elif self.dict_rows:
+            return dict(zip([d[0] for d in self.cur.description], row))
+        return row
+
+    def fetchone(self):
+        return self.row(self.cur.fetchone())
+
+    def fetchmany(self, size=1):
+        return tuple(self.row(i) for i in self.cur.fetchmany(size))
+
+    def fetchall(self):
+        return tuple(self.row(i) for i in self.cur.fetchall())
+
+    def close(self):
+        self.closed = True
+        self.cur.close()
+
+
+class Connection:
+    def __init__(self, path, dict_rows=True):
+        self.path = path
+        self.dict_rows = dict_rows
+        self.raw = sqlite3.connect(path, check_same_thread=False)
+        self.raw.executescript(schema)
+        self.executed = []
+        self.commits = 0
+        self.pings = 0
+        self.closed = False
+        self.broken = False
+
+    def check(self):
+        if self.closed or self.broken:
+            raise sqlite3.OperationalError('connection is gone')
+
+    def cursor(self, cursorclass=None):
+        if cursorclass is None:
+            return Cursor(self, self.dict_rows)
+        # DictCursor, SSDictCursor (MySQLdb or aiomysql) fetch dicts
+        return Cursor(self, 'Dict' in cursorclass.__name__)
+
+    def ping(self):
+        self.pings += 1
+        self.check()
+
+    def commit(self):
+        self.check()
+        self.commits += 1
+        self.raw.commit()
+
+    def rollback(self):
+        self.check()
+        self.raw.rollback()
+
+    def close(self):
+        self.closed = True
+        self.raw.close()
+
+
+def connect(path=':memory:', dict_rows=True):
+    """
+    Connect to a sqlite database speaking (a little) MySQL
+
+    :param str path: sqlite database path
+    :param bool dict_rows: fetch rows as dict like DictCursor
+    :return: Connection instance
+    """
+    return Connection(path, dict_rows)
+
+
+class AsyncCursor:
+    """
+    aiomysql style cursor, the I/O methods are coroutines
+    """
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def __getattr__(self, item):
+        return getattr(self.cur, item)
+
+    async def execute(self, sql, args=None):
+        await asyncio.sleep(0)
+        return self.cur.execute(sql, args)
+
+    async def executemany(self, sql, seq_args):
+        await asyncio.sleep(0)
+        return self.cur.executemany(sql, seq_args)
+
+    async def fetchone(self):
+        return self.cur.fetchone()
+
+    async def fetchmany(self, size=1):
+        return self.cur.fetchmany(size)
+
+    async def fetchall(self):
+        return self.cur.fetchall()
+
+    async def close(self):
+        self.cur.close()
+
+
+class AsyncConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, item):
+        return getattr(self.conn, item)
+
+    async def cursor(self, cursorclass=None):
+        return AsyncCursor(self.conn.cursor(cursorclass))
+
+    async def commit(self):
+        self.conn.commit()
+
+    async def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+async def connect_async(path=':memory:', dict_rows=True):
+    """
+    Connect like aiomysql.connect()
+
+    :param str path: sqlite database path
+    :param bool dict_rows: fetch rows as dict like DictCursor
+    :return: AsyncConnection instance
+    """
+    return AsyncConnection(Connection(path, dict_rows))
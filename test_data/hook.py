@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+percentile = [
+    {
+        'timings': [],
+        'q': 50,
+        'expected': 0.0,
+    },
+    {
+        'timings': [1, 2, 3, 4, 5],
+        'q': 50,
+        'expected': 3,
+    },
+    {
+        'timings': list(range(1, 101)),
+        'q': 95,
+        'expected': 95,
+    },
+    {
+        'timings': list(range(1, 101)),
+        'q': 99,
+        'expected': 99,
+    },
+]
+
+slow_log = [
+    {
+        # same shape within the interval
+        'events': [(0, 'SELECT %s'), (1, 'SELECT 2'), (2, 'SELECT 3')],
+        'expected': [('SELECT %s', 0)],
+        'suppressed': 2,
+    },
+    {
+        # again after the interval, with the suppressed count
+        'events': [(0, 'SELECT 1'), (1, 'SELECT 2'), (10, 'SELECT 3')],
+        'expected': [('SELECT %s', 0), ('SELECT %s', 1)],
+        'suppressed': 1,
+    },
+    {
+        # limit 2 per interval overall
+        'events': [(0, 'SELECT a'), (1, 'SELECT b'), (2, 'SELECT c'),
+                   (11, 'SELECT c')],
+        'expected': [('SELECT a', 0), ('SELECT b', 0), ('SELECT c', 0)],
+        'suppressed': 1,
+    },
+]
@@ -17,6 +17,48 @@ to_obj = [
     },
 ]
 
+to_obj_compact = [
+    {
+        'data': None,
+        'description': None,
+        'expected': None,
+    },
+    {
+        'data': {'id': 1, 'name': 'Common Jasmin Orange'},
+        'description': None,
+        'expected': [{'id': 1, 'name': 'Common Jasmin Orange'}],
+    },
+    {
+        'data': (1, 'Common Jasmin Orange'),
+        'description': (('id',), ('name',)),
+        'expected': [{'id': 1, 'name': 'Common Jasmin Orange'}],
+    },
+    {
+        'data': (
+            {'id': 1, 'name': 'Common Jasmin Orange'},
+            {'id': 2, 'name': 'Hair Like Snow'},
+        ),
+        'description': None,
+        'expected': [
+            {'id': 1, 'name': 'Common Jasmin Orange'},
+            {'id': 2, 'name': 'Hair Like Snow'},
+        ],
+    },
+    {
+        'data': ((1, 'Common Jasmin Orange', 'x'), (2, None, 'y')),
+        'description': (('id',), ('name',), ('table',)),
+        'expected': [
+            {'id': 1, 'name': 'Common Jasmin Orange', 'table': 'x'},
+            {'id': 2, 'name': None, 'table': 'y'},
+        ],
+    },
+    {
+        'data': (),
+        'description': (('id',),),
+        'expected': [],
+    },
+]
+
 select = [
     {
         'expr': 'id',
@@ -68,6 +110,27 @@ get = [
     },
 ]
 
+loader = [
+    {
+        'pks': [2, 1, 0, 2, 3],
+        'max_in': 2,
+        'expected': [2, 1, None, 2, 3],
+        'batches': 2,
+    },
+    {
+        'pks': [3, 1],
+        'max_in': 1000,
+        'expected': [3, 1],
+        'batches': 1,
+    },
+    {
+        'pks': [],
+        'max_in': 1000,
+        'expected': [],
+        'batches': 0,
+    },
+]
+
 one = [
     {
         'expr': '*',
@@ -176,6 +239,98 @@ all = [
     },
 ]
 
+iter = [
+    {
+        'where': None,
+        'order_by': 'id',
+        'limit': None,
+        'batch_size': 2,
+        'expected': [1, 2, 3, 4, 5],
+    },
+    {
+        'where': ('singer', 'Jay Chou'),
+        'order_by': 'id DESC',
+        'limit': None,
+        'batch_size': 1,
+        'expected': [2, 1],
+    },
+    {
+        'where': None,
+        'order_by': 'id',
+        'limit': (1, 2),
+        'batch_size': 1000,
+        'expected': [2, 3],
+    },
+]
+
+scan = [
+    {
+        'batch_size': 2,
+        'where': None,
+        'key': None,
+        'desc': False,
+        'expected': [[1, 2], [3, 4], [5]],
+    },
+    {
+        'batch_size': 2,
+        'where': [('singer', '!=', 'kuga'), 'tag IS NOT NULL'],
+        'key': None,
+        'desc': True,
+        'expected': [[5, 4], [2, 1]],
+    },
+    {
+        'batch_size': 5,
+        'where': ('id', '>', 3),
+        'key': 'id',
+        'desc': False,
+        'expected': [[4, 5]],
+    },
+    {
+        'batch_size': 2,
+        'where': None,
+        'key': ('is_published', 'id'),
+        'desc': False,
+        'expected': [[3, 1], [2, 4], [5]],
+    },
+    {
+        'batch_size': 3,
+        'where': {'OR': [('singer', 'Jay Chou'), ('singer', 'kuga')]},
+        'key': ['is_published', 'id'],
+        'desc': True,
+        'expected': [[2, 1, 3]],
+    },
+]
+
+compact = [
+    {
+        'where': ('singer', 'Jay Chou'),
+        'modified': {'tag': 'legend'},
+    },
+]
+
+session = [
+    {
+        'write': 'update',
+        'args': ({'tag': 'rocks'}, ('id', 1)),
+        'expected': 'rocks',
+    },
+    {
+        'write': 'saved',
+        'args': ({'id': 1, 'tag': 'rocks'},),
+        'expected': 'rocks',
+    },
+    {
+        'write': 'delete',
+        'args': (('id', 1),),
+        'expected': None,
+    },
+    {
+        'write': 'add',
+        'args': ({'singer': 'kuga'},),
+        'expected': 'Incomparable',
+    },
+]
+
 count = [
     {
         'where': None,
@@ -208,6 +363,17 @@ add = [
     },
 ]
 
+add_many = [
+    {
+        'rows': [
+            {'singer': 'Jay Chou', 'name': 'Mojito'},
+            {'singer': 'Mayday', 'name': 'Stubborn'},
+            {'singer': 'kuga', 'name': ''},
+        ],
+        'chunk_rows': 2,
+    },
+]
+
 saved = [
     {
         'data': {'singer': 'Jay Chou'},
@@ -219,6 +385,17 @@ saved = [
     },
 ]
 
+upsert = [
+    {
+        'data': {'id': 5, 'singer': 'Mayday', 'tag': 'band'},
+        'expected': (0, 1),
+    },
+    {
+        'data': {'id': 86, 'singer': 'kuga', 'tag': ''},
+        'expected': (1, 0),
+    },
+]
+
 save = [
     {
         'data': {'singer': 'Jay Chou'},
@@ -234,6 +411,29 @@ save = [
     },
 ]
 
+dirty = [
+    {
+        'pk': 5,
+        'modified': {'tag': 'rocks'},
+        'dirty': {'tag'},
+    },
+    {
+        'pk': 5,
+        'modified': {'tag': '11752233'},
+        'dirty': set(),
+    },
+    {
+        'pk': 5,
+        'modified': {'tag': 'rocks', 'singer': 'Mayday', 'foo': 'bar'},
+        'dirty': {'tag'},
+    },
+    {
+        'pk': 3,
+        'modified': {'name': 'Mojito', 'is_published': 1},
+        'dirty': {'name', 'is_published'},
+    },
+]
+
 update = [
     {
         'data': {'singer': 'Jay Chou'},
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+health_check = [
+    {
+        'ping_idle': 0,
+        'pings': 1,
+        'replaced': True,
+    },
+    {
+        'ping_idle': 60,
+        'pings': 0,
+        'replaced': False,
+    },
+]
@@ -4,6 +4,37 @@ import json
 
 from sqlrocks import *
 
+freeze = [
+    {
+        'sql': Sql().select().fr('song').where(('id', Param('id'))),
+        'values': {'id': 5},
+        'expected': {
+            'sql': 'SELECT * FROM song WHERE (id = %s)',
+            'args': [5],
+        },
+    },
+    {
+        'sql': Sql().select().fr('song').where([
+            ('singer', 'Mayday'),
+            ('id', 'BETWEEN', (Param('min'), Param('max'))),
+        ]),
+        'values': {'min': 1, 'max': 3},
+        'expected': {
+            'sql': 'SELECT * FROM song '
+                   'WHERE (singer = %s AND id BETWEEN %s AND %s)',
+            'args': ['Mayday', 1, 3],
+        },
+    },
+    {
+        'sql': Sql().update('song').set({'tag': Param('tag')}).where(id=1),
+        'values': {'tag': 'band'},
+        'expected': {
+            'sql': 'UPDATE `song` SET `tag`=%s WHERE (id = %s)',
+            'args': ['band', 1],
+        },
+    },
+]
+
 add_quote = [
     {
         'expr': ['id', 'name'],
@@ -363,6 +394,75 @@ parse_where_cond = [
     },
 ]
 
+where_cache = [
+    {
+        'wheres': [
+            [('name', 'Jay Chou'), ('id', 'IN', [1, 2])],
+            [('name', 'Mayday'), ('id', 'IN', [3, 4])],
+        ],
+        'expected': {
+            'cond_str_list': [
+                '(name = %s AND id IN (%s,%s))',
+                '(name = %s AND id IN (%s,%s))',
+            ],
+            'cond_arg_lists': [['Jay Chou', 1, 2], ['Mayday', 3, 4]],
+            'hits': 1,
+            'misses': 1,
+        },
+    },
+    {
+        'wheres': [
+            ('id', 'IN', [1, 2]),
+            ('id', 'IN', [1, 2, 3]),
+            ('id', 'NOT IN', [1, 2, 3]),
+        ],
+        'expected': {
+            'cond_str_list': [
+                '(id IN (%s,%s))',
+                '(id IN (%s,%s,%s))',
+                '(id NOT IN (%s,%s,%s))',
+            ],
+            'cond_arg_lists': [[1, 2], [1, 2, 3], [1, 2, 3]],
+            'hits': 0,
+            'misses': 3,
+        },
+    },
+    {
+        'wheres': [
+            {'OR': [('id', Sql('(sub1)', [1])), 'tag IS NULL']},
+            {'OR': [('id', Sql('(sub2)', [2])), 'tag IS NULL']},
+            {'OR': [('id', Sql('(sub1)', [3])), 'tag IS NULL']},
+        ],
+        'expected': {
+            'cond_str_list': [
+                '(id = (sub1) OR tag IS NULL)',
+                '(id = (sub2) OR tag IS NULL)',
+                '(id = (sub1) OR tag IS NULL)',
+            ],
+            'cond_arg_lists': [[1], [2], [3]],
+            'hits': 1,
+            'misses': 2,
+        },
+    },
+]
+
+and_where = [
+    {
+        'wheres': [None, ''],
+        'expected': None,
+    },
+    {
+        'wheres': [('id', 1)],
+        'expected': {'AND': [('id', 1)]},
+    },
+    {
+        'wheres': [[('id', 1), 'tag IS NULL'], {'OR': [('id', 2)]}, 'x = 1'],
+        'expected': {
+            'AND': [('id', 1), 'tag IS NULL', {'OR': [('id', 2)]}, 'x = 1'],
+        },
+    },
+]
+
 select = [
     {
         'expr': 'id',
@@ -640,6 +740,106 @@ insert = [
     },
 ]
 
+cols = [
+    {
+        'cols': 'name',
+        'expected': '(`name`)',
+    },
+    {
+        'cols': ('name', 'tag'),
+        'expected': '(`name`, `tag`)',
+    },
+]
+
+vals = [
+    {
+        'args': [(1, 'Mayday')],
+        'expected': {
+            'sql': ' VALUES(%s,%s)',
+            'args': [1, 'Mayday'],
+        },
+    },
+    {
+        'args': [1, 'Mayday'],
+        'expected': {
+            'sql': ' VALUES(%s,%s)',
+            'args': [1, 'Mayday'],
+        },
+    },
+    {
+        'args': [[(1, 'Mayday'), (2, 'Jay Chou')]],
+        'expected': {
+            'sql': ' VALUES(%s,%s),(%s,%s)',
+            'args': [1, 'Mayday', 2, 'Jay Chou'],
+        },
+    },
+    {
+        'args': [[1, 'Mayday'], [2, 'Jay Chou', 'legend']],
+        'expected': {
+            'sql': ' VALUES(%s,%s),(%s,%s,%s)',
+            'args': [1, 'Mayday', 2, 'Jay Chou', 'legend'],
+        },
+    },
+]
+
+on_duplicate_key_update = [
+    {
+        'expr': ['name', 'tag'],
+        'expected': {
+            'sql': ' ON DUPLICATE KEY UPDATE `name`=VALUES(`name`), '
+                   '`tag`=VALUES(`tag`)',
+            'args': [],
+        },
+    },
+    {
+        'expr': {'tag': 'band'},
+        'expected': {
+            'sql': ' ON DUPLICATE KEY UPDATE `tag`=%s',
+            'args': ['band'],
+        },
+    },
+    {
+        'expr': 'num=num+1',
+        'expected': {
+            'sql': ' ON DUPLICATE KEY UPDATE num=num+1',
+            'args': [],
+        },
+    },
+]
+
+normalize = [
+    {
+        'sql': 'SELECT * FROM `song` WHERE (`id` = %s)',
+        'expected': 'SELECT * FROM `song` WHERE (`id` = %s)',
+    },
+    {
+        'sql': 'SELECT * FROM song WHERE (id IN (%s,%s,%s))',
+        'expected': 'SELECT * FROM song WHERE (id IN (%s, ...))',
+    },
+    {
+        'sql': 'SELECT * FROM song WHERE (id IN (%s))',
+        'expected': 'SELECT * FROM song WHERE (id IN (%s, ...))',
+    },
+    {
+        'sql': "SELECT * FROM song WHERE singer = 'Jay Chou' AND id > 10 "
+               "AND tag IN ('a', \"b\", 'it''s') LIMIT 1.5e3",
+        'expected': 'SELECT * FROM song WHERE singer = %s AND id > %s '
+                    'AND tag IN (%s, ...) LIMIT %s',
+    },
+    {
+        'sql': "SELECT `col1`, t2.name FROM `t2`\n  WHERE note = 'a\\'b'",
+        'expected': 'SELECT `col1`, t2.name FROM `t2` WHERE note = %s',
+    },
+    {
+        'sql': 'INSERT INTO `song` (`name`, `tag`) VALUES (%s,%s), (%s,%s)',
+        'expected': 'INSERT INTO `song` (`name`, `tag`) VALUES (%s, ...)',
+    },
+    {
+        'sql': 'INSERT INTO `song` (`name`, `tag`) VALUES (%s,%s)',
+        'expected': 'INSERT INTO `song` (`name`, `tag`) VALUES (%s, ...)',
+    },
+]
+
 update = [
     {
         'table': 'song',
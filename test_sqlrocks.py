@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import os
 import ddt
+import asyncio
 import json
+import time
 import MySQLdb
+import tempfile
+import threading
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import test_data.sql
 import test_data.db
+import test_data.pool
+import test_data.cache
+import test_data.hook
 import test_data.model
+import test_data.fake as fake
 import test_data.config as config
 
 from sqlrocks import *
@@ -113,6 +127,50 @@ class TestSql(unittest.TestCase):
         self.assertEqual(cond_str, expected['cond_str'])
         self.assertEqual(cond_arg_list, expected['cond_arg_list'])
 
+    @ddt.data(*test_data.sql.where_cache)
+    @ddt.unpack
+    def test_where_cache(self, wheres, expected):
+        cache = Sql.where_cache
+        Sql.where_cache = LruCache(16)
+
+        try:
+            for i, where in enumerate(wheres):
+                cond_str, cond_arg_list = Sql.parse_where_cond(where)
+                self.assertEqual(cond_str, expected['cond_str_list'][i])
+                self.assertEqual(cond_arg_list, expected['cond_arg_lists'][i])
+
+            self.assertEqual(Sql.where_cache.hits, expected['hits'])
+            self.assertEqual(Sql.where_cache.misses, expected['misses'])
+        finally:
+            Sql.where_cache = cache
+
+    def test_where_iterator(self):
+        cache = Sql.where_cache
+        Sql.where_cache = LruCache(16)
+
+        def where():
+            return {'OR': (i for i in [
+                ('id', 1),
+                {'AND': iter([('name', 'Jay Chou'), 'tag IS NULL'])},
+            ])}
+
+        try:
+            for i in range(2):
+                self.assertEqual(Sql.parse_where_cond(where()), (
+                    '(id = %s OR (name = %s AND tag IS NULL))',
+                    [1, 'Jay Chou']))
+
+            self.assertEqual(Sql.parse_where_cond(
+                iter([('id', 1), ('tag', 'x')])),
+                ('(id = %s AND tag = %s)', [1, 'x']))
+        finally:
+            Sql.where_cache = cache
+
+    @ddt.data(*test_data.sql.and_where)
+    @ddt.unpack
+    def test_and_where(self, wheres, expected):
+        self.assertEqual(Sql.and_where(*wheres), expected)
+
     @ddt.data(*test_data.sql.select)
     @ddt.unpack
     def test_select(self, expr, expected):
@@ -218,6 +276,46 @@ class TestSql(unittest.TestCase):
         self.assertIsInstance(sql.insert(table), Sql)
         self.assertEqual(sql.sql, expected)
 
+    @ddt.data(*test_data.sql.cols)
+    @ddt.unpack
+    def test_cols(self, cols, expected):
+        sql = Sql()
+        self.assertIsInstance(sql.cols(cols), Sql)
+        self.assertEqual(sql.sql, expected)
+
+    @ddt.data(*test_data.sql.vals)
+    @ddt.unpack
+    def test_vals(self, args, expected):
+        sql = Sql()
+        self.assertIsInstance(sql.vals(*args), Sql)
+        self.assertEqual(sql.sql, expected['sql'])
+        self.assertEqual(sql.args, expected['args'])
+
+    @ddt.data(*test_data.sql.on_duplicate_key_update)
+    @ddt.unpack
+    def test_on_duplicate_key_update(self, expr, expected):
+        sql = Sql()
+        self.assertIsInstance(sql.on_duplicate_key_update(expr), Sql)
+        self.assertEqual(sql.sql, expected['sql'])
+        self.assertEqual(sql.args, expected['args'])
+
+    @ddt.data(*test_data.sql.normalize)
+    @ddt.unpack
+    def test_normalize(self, sql, expected):
+        self.assertEqual(Sql.normalize(sql), expected)
+        self.assertEqual(Sql.normalize(Sql(sql)), expected)
+
+    def test_fingerprint(self):
+        a = Sql().select().fr('song').where(('id', 'IN', [1, 2]))
+        b = Sql().select().fr('song').where(('id', 'IN', [1, 2, 3]))
+        c = Sql().select().fr('song').where(('singer', 'IN', [1, 2]))
+
+        self.assertRegex(Sql.fingerprint(a), '^[0-9a-f]{16}$')
+        self.assertEqual(Sql.fingerprint(a), Sql.fingerprint(b.sql))
+        self.assertEqual(Sql.fingerprint(a), Sql.fingerprint(
+            'SELECT *  FROM song WHERE (id IN (7, 8, 9, 10))'))
+        self.assertNotEqual(Sql.fingerprint(a), Sql.fingerprint(c))
+
     @ddt.data(*test_data.sql.update)
     @ddt.unpack
     def test_update(self, table, expected):
@@ -258,6 +356,15 @@ class TestSql(unittest.TestCase):
         sql = Sql()
         self.assertEqual(sql.add_quote(expr), expected)
 
+    @ddt.data(*test_data.sql.freeze)
+    @ddt.unpack
+    def test_freeze(self, sql, values, expected):
+        tpl = sql.freeze()
+        self.assertIsInstance(tpl, Template)
+        self.assertEqual(tpl.sql, expected['sql'])
+        self.assertEqual(tpl.bind(values), expected['args'])
+        self.assertEqual(tpl.bind(**values), expected['args'])
+
     @ddt.data(*test_data.sql.chain)
     @ddt.unpack
     def test_query_chain(self, methods, expected):
@@ -305,6 +412,48 @@ class TestDb(DbTestCase):
         self.cur.execute(sql.val, sql.args)
         self.assertEqual(self.cur.fetchone(), data)
 
+    @ddt.data(*test_data.db.insert_many)
+    @ddt.unpack
+    def test_insert_many(self, rows, chunk_rows, max_packet_bytes, expected):
+        rows = list(rows)
+        result = self.db.insert_many(
+            self.table, iter(rows), chunk_rows, max_packet_bytes)
+        self.db.commit()
+
+        self.assertEqual([i[0] for i in result], expected)
+        self.assertEqual(self.db.count(self.table), len(rows))
+
+        for row in rows:
+            self.assertTrue(self.db.count(self.table, list(row.items())))
+
+    @ddt.data(*test_data.db.iter)
+    @ddt.unpack
+    def test_iter(self, dataset, where, batch_size, expected):
+        self.create_dataset(self.conn, self.cur, dataset)
+
+        sql = self.db.select('id').fr(self.table).where(where).order_by('id')
+        rows = self.db.iter(sql.sql, sql.args, batch_size)
+
+        self.assertEqual([row['id'] for row in rows], expected)
+
+    def test_stream_class(self):
+        ss = MySQLdb.cursors.SSDictCursor
+        self.assertIs(self.db.stream_class(), ss)
+        self.assertIs(self.db.stream_class(None, True),
+                      MySQLdb.cursors.SSCursor)
+        self.assertIs(self.db.stream_class(MySQLdb.cursors.Cursor),
+                      MySQLdb.cursors.Cursor)
+
+        db = Db(self.conn, self.cur, stream_cursor=MySQLdb.cursors.Cursor)
+        self.assertIs(db.stream_class(), MySQLdb.cursors.Cursor)
+        self.assertIs(db.stream_class(None, True), MySQLdb.cursors.Cursor)
+
+        db.stream_driver = 'no_such_driver.cursors'
+        db.stream_cursor = None
+
+        with self.assertWarns(RuntimeWarning):
+            self.assertIsNone(db.stream_class())
+
     @ddt.data(*test_data.db.update)
     @ddt.unpack
     def test_update(self, dataset, data, where):
@@ -334,6 +483,50 @@ class TestDb(DbTestCase):
         self.cur.execute(sql.val, sql.args)
         self.assertEqual(self.cur.fetchone(), data)
 
+    @ddt.data(*test_data.db.upsert)
+    @ddt.unpack
+    def test_upsert(self, dataset, rows, update, expected):
+        self.create_dataset(self.conn, self.cur, dataset)
+
+        result = self.db.upsert(self.table, rows, update, 'id')
+        self.db.commit()
+
+        self.assertEqual(result, expected)
+
+        for row in rows:
+            self.assertTrue(self.db.count(self.table, list(row.items())))
+
+    @ddt.data(*test_data.db.update_many)
+    @ddt.unpack
+    def test_update_many(self, dataset, rows, key, case, expected):
+        self.create_dataset(self.conn, self.cur, dataset)
+
+        self.assertEqual(
+            self.db.update_many(self.table, rows, key, 2, case), expected)
+
+        total = sum(self.db.count(self.table, list(row.items()))
+                    for row in rows)
+        self.assertEqual(total, expected)
+
+    def test_update_many_rollback(self):
+        self.db.insert(self.table, {'name': 'rollback'})
+        self.db.update_many(self.table, [{'id': 1, 'name': 'x'},
+                                         {'id': 2, 'name': 'y'}])
+        self.db.save_many(self.table, [{'id': 1, 'name': 'z'}])
+        self.db.rollback()
+
+        self.assertEqual(self.db.count(self.table), 0)
+
+    @ddt.data(*test_data.db.save_many)
+    @ddt.unpack
+    def test_save_many(self, dataset, rows, expected):
+        self.create_dataset(self.conn, self.cur, dataset)
+
+        self.assertEqual(self.db.save_many(self.table, rows), expected)
+
+        for row in rows:
+            self.assertTrue(self.db.count(self.table, list(row.items())))
+
     @ddt.data(*test_data.db.delete)
     @ddt.unpack
     def test_delete(self, dataset, where, affected_rows):
@@ -345,6 +538,33 @@ class TestDb(DbTestCase):
         self.assertEqual(count, affected_rows)
         self.assertEqual(self.db.count(self.table), 0)
 
+    @ddt.data(*test_data.db.count)
+    @ddt.unpack
+    def test_gather(self, dataset, where, expected):
+        self.create_dataset(self.conn, self.cur, dataset)
+
+        sql = self.db.select('COUNT(*) AS total').fr(self.table).where(where)
+        result = self.db.gather(sql, lambda: self.db.count(self.table, where))
+
+        self.assertEqual(result[0].fetchone()['total'], expected)
+        self.assertEqual(result[1], expected)
+        self.assertRaises(ValueError, self.db.gather, sql, timeout=1)
+
+    @ddt.data(*test_data.db.tables)
+    @ddt.unpack
+    def test_tables(self, sql, expected):
+        self.assertEqual(set(Db.tables_re.findall(sql)), expected)
+
+    @ddt.data(*test_data.db.rocks_template)
+    @ddt.unpack
+    def test_rocks_template(self, dataset, sql, values, expected):
+        self.create_dataset(self.conn, self.cur, dataset)
+        tpl = sql.freeze()
+
+        for i, args in enumerate(values):
+            self.db.rocks(tpl, args)
+            self.assertEqual(self.db.cur.fetchone(), expected[i])
+
     def new_test_db(self):
         conn = MySQLdb.connect(**config.db)
         return Db(conn, conn.cursor())
@@ -383,6 +603,34 @@ class TestModel(DbTestCase):
                 self.assertIsInstance(obj[i], self.model)
                 self.assertEqual(obj[i]._row, data[i])
 
+    @ddt.data(*test_data.model.to_obj_compact)
+    @ddt.unpack
+    def test_to_obj_compact(self, data, description, expected):
+        class Compact(self.model):
+            compact = True
+
+        obj = Compact.to_obj(data, description)
+
+        if expected is None:
+            self.assertIsNone(obj)
+            return
+
+        objs = obj if isinstance(obj, list) else [obj]
+        self.assertEqual(len(objs), len(expected))
+
+        for obj, row in zip(objs, expected):
+            self.assertIsInstance(obj, Compact)
+            self.assertFalse(hasattr(obj, '__dict__') and obj.__dict__)
+            self.assertEqual(obj._row, row)
+
+            for k, v in row.items():
+                self.assertEqual(obj[k], v)
+                if k != 'table':
+                    self.assertEqual(getattr(obj, k), v)
+
+            # columns never shadow Model attributes
+            self.assertEqual(obj.table, self.table)
+
     @ddt.data(*test_data.model.select)
     @ddt.unpack
     def test_select(self, expr, expected):
@@ -396,6 +644,57 @@ class TestModel(DbTestCase):
     def test_get(self, pk, expected):
         self.assertEqual(self.model.get(pk, fetch_obj=False), expected)
 
+    def test_templates(self):
+        templates = Model.templates
+        Model.templates = LruCache(2)
+
+        try:
+            for expr in ['id', 'name', 'id, name', 'id']:
+                self.assertIsNotNone(self.model.get(1, expr))
+
+            self.assertEqual(len(Model.templates), 2)
+            self.assertEqual(Model.templates.info()['hits'], 0)
+            self.model.get(1, 'id')
+            self.assertEqual(Model.templates.info()['hits'], 1)
+        finally:
+            Model.templates = templates
+
+    def test_select_override(self):
+        class Published(self.model):
+            @classmethod
+            def select(cls, expr=None):
+                # default scope
+                return cls.db.sql(cls).select(expr or '*').fr(
+                    '(SELECT * FROM song WHERE is_published = 1) AS song')
+
+        self.assertTrue(self.model.templated())
+        self.assertFalse(Published.templated())
+
+        unpublished = self.model.one(where=('is_published', 0))
+        self.assertIsNone(Published.get(unpublished.id))
+        self.assertIsNone(Published.get(unpublished.id, 'id'))
+        self.assertEqual(Published.first().is_published, 1)
+        self.assertEqual(Published.last().is_published, 1)
+
+        self.assertEqual(self.model.first().id, self.model.get(1).id)
+        self.assertIn(('song', 'id', ('one', '*', None, 'id')),
+                      Model.templates.data)
+
+    @ddt.data(*test_data.model.loader)
+    @ddt.unpack
+    def test_loader(self, pks, max_in, expected, batches):
+        loader = self.model.loader(max_in)
+        pending = [loader.load(pk) for pk in pks]
+
+        self.assertEqual(loader.batches, 0)
+        self.assertEqual([i.value and i.value.id for i in pending], expected)
+        self.assertEqual(loader.batches, batches)
+
+        # loaded rows are not fetched again
+        rows = loader.load_many(pks)
+        self.assertEqual([i and i['id'] for i in rows], expected)
+        self.assertEqual(loader.batches, batches)
+
     @ddt.data(*test_data.model.one)
     @ddt.unpack
     def test_one(self, expr, where, expected):
@@ -422,6 +721,56 @@ class TestModel(DbTestCase):
         actual = self.model.all(expr, where, order_by, limit, fetch_obj=False)
         self.assertEqual(actual, expected)
 
+    @ddt.data(*test_data.model.iter)
+    @ddt.unpack
+    def test_iter(self, where, order_by, limit, batch_size, expected):
+        rows = self.model.iter(where=where, order_by=order_by, limit=limit,
+                               batch_size=batch_size)
+
+        self.assertNotIsInstance(rows, (list, tuple))
+        self.assertEqual([row.id for row in rows], expected)
+
+    @ddt.data(*test_data.model.scan)
+    @ddt.unpack
+    def test_scan(self, batch_size, where, key, desc, expected):
+        batches = self.model.scan(batch_size, where, key=key, desc=desc)
+        actual = [[row.id for row in batch] for batch in batches]
+        self.assertEqual(actual, expected)
+
+    @ddt.data(*test_data.model.compact)
+    @ddt.unpack
+    def test_compact(self, where, modified):
+        class Compact(self.model):
+            compact = True
+
+        objs = Compact.all(where=where)
+        expected = self.model.all(where=where, fetch_obj=False)
+
+        self.assertEqual([obj._row for obj in objs], list(expected))
+
+        obj = objs[0]
+        self.assertIsInstance(obj, Compact)
+        self.assertEqual(type(obj).__dictoffset__, 0)
+
+        for k, v in modified.items():
+            setattr(obj, k, v)
+
+        self.assertEqual(obj.save(), 1)
+        actual = self.model.get(obj.id, modified.keys(), fetch_obj=False)
+        self.assertEqual(actual, modified)
+
+    def test_fetch_compact(self):
+        class Compact(self.model):
+            compact = True
+
+        sql = Compact.select().limit(1)
+        rows, description = Compact.fetch(sql.sql, sql.args)
+        self.assertIsInstance(rows[0], tuple)
+        self.assertEqual(description[0][0], 'id')
+
+        rows, description = self.model.fetch(sql.sql, sql.args)
+        self.assertIsInstance(rows[0], dict)
+
     @ddt.data(*test_data.model.count)
     @ddt.unpack
     def test_count(self, where, expected):
@@ -434,6 +783,20 @@ class TestModel(DbTestCase):
         actual = self.model.get(pk, data.keys(), fetch_obj=False)
         self.assertEqual(actual, data)
 
+    @ddt.data(*test_data.model.add_many)
+    @ddt.unpack
+    def test_add_many(self, rows, chunk_rows):
+        total = self.model.count()
+        result = self.model.add_many(rows, chunk_rows)
+
+        self.assertEqual(sum(i[0] for i in result), len(rows))
+        self.assertEqual(self.model.count(), total + len(rows))
+
+        for row in rows:
+            actual = self.model.one(row.keys(), list(row.items()),
+                                    fetch_obj=False)
+            self.assertEqual(actual, row)
+
     @ddt.data(*test_data.model.saved)
     @ddt.unpack
     def test_saved(self, data, insert):
@@ -448,6 +811,15 @@ class TestModel(DbTestCase):
         actual = self.model.get(pk, data.keys(), fetch_obj=False)
         self.assertEqual(actual, data)
 
+    @ddt.data(*test_data.model.upsert)
+    @ddt.unpack
+    def test_upsert(self, data, expected):
+        self.assertEqual(self.model.saved(data, upsert=True), expected)
+
+        actual = self.model.get(data[self.model.pk], data.keys(),
+                                fetch_obj=False)
+        self.assertEqual(actual, data)
+
     @ddt.data(*test_data.model.save)
     @ddt.unpack
     def test_save(self, data, insert=None, modified=None):
@@ -468,6 +840,104 @@ class TestModel(DbTestCase):
         actual = self.model.get(pk, data.keys(), fetch_obj=False)
         self.assertEqual(actual, data)
 
+    @ddt.data(*test_data.model.dirty)
+    @ddt.unpack
+    def test_dirty(self, pk, modified, dirty):
+        obj = self.model.get(pk)
+        self.assertEqual(obj.dirty_fields, set())
+
+        for k, v in modified.items():
+            setattr(obj, k, v)
+
+        self.assertEqual(obj.dirty_fields, dirty)
+
+        # a concurrent write to a clean field survives the save
+        self.cur.execute('UPDATE song SET singer = %s WHERE id = %s',
+                         ('concurrent', pk))
+        self.conn.commit()
+
+        self.assertEqual(obj.save(), 1 if dirty else 0)
+        self.assertEqual(obj.dirty_fields, set())
+        self.assertEqual(obj.save(), 0)
+
+        row = self.model.get(pk, fetch_obj=False)
+        self.assertEqual(row['singer'], 'concurrent')
+
+        for k in dirty:
+            self.assertEqual(row[k], modified[k])
+
+    def test_save_many(self):
+        objs = self.model.all(where=('id', '<=', 3))
+        objs[0].tag = 'rocks'
+        objs[2].tag = 'rocks'
+        objs.append(self.model(singer='kuga', tag='rocks'))
+
+        self.assertEqual(self.model.save_many(objs), (1, 2))
+        self.assertIsNotNone(objs[3].id)
+        self.assertEqual([i.dirty_fields for i in objs], [set()] * 4)
+
+        actual = self.model.all('id', ('tag', 'rocks'), 'id', fetch_obj=False)
+        self.assertEqual([i['id'] for i in actual], [1, 3, objs[3].id])
+
+    def test_save_twice(self):
+        obj = self.model(singer='kuga')
+        pk = obj.save()
+
+        self.assertEqual(obj.id, pk)
+        self.assertEqual(obj.save(), 0)
+
+        obj.tag = 'rocks'
+        self.assertEqual(obj.save(), 1)
+        self.assertEqual(self.model.count(('singer', 'kuga')), 2)
+        self.assertEqual(self.model.get(pk).tag, 'rocks')
+
+    def test_cache(self):
+        self.model.db.cache = MemoryCache()
+        total = self.model.count()
+
+        self.assertEqual(self.model.count(cache=True), total)
+        rows = self.model.all(where=('id', '<=', 2), cache=True)
+        rows[0].tag = 'mutated'
+
+        # out of band write, the cached results stay
+        self.cur.execute('DELETE FROM song WHERE id = %s', (1,))
+        self.conn.commit()
+
+        self.assertEqual(self.model.count(cache=True), total)
+        self.assertEqual(self.model.count(), total - 1)
+        rows = self.model.all(where=('id', '<=', 2), cache=True)
+        self.assertEqual([i.id for i in rows], [1, 2])
+        self.assertNotEqual(rows[0].tag, 'mutated')
+
+        # writes through the Db drop the entries of the table
+        self.model.delete(('id', 2))
+
+        self.assertEqual(self.model.count(cache=True), total - 2)
+        self.assertEqual(self.model.one(where=('id', '<=', 2), cache=True),
+                         None)
+        self.assertEqual(self.model.db.cache.info()['hits'], 2)
+
+    @ddt.data(*test_data.model.session)
+    @ddt.unpack
+    def test_session(self, write, args, expected):
+        self.assertIsNot(self.model.get(1), self.model.get(1))
+
+        with self.model.db.session() as identity:
+            obj = self.model.get(1)
+            self.assertIs(self.model.get(1), obj)
+            self.assertIs(self.model.first(), obj)
+            self.assertIn(obj, self.model.all(where=('id', '<=', 2)))
+            self.assertIsNot(self.model.get(1, ['id', 'tag']), obj)
+
+            getattr(self.model, write)(*args)
+            self.assertNotIn(self.model.table, identity)
+
+            actual = self.model.get(1)
+            self.assertIsNot(actual, obj)
+            self.assertEqual(actual and actual.tag, expected)
+
+        self.assertIsNone(self.model.db.identity)
+
     @ddt.data(*test_data.model.update)
     @ddt.unpack
     def test_update(self, data, where):
@@ -518,5 +988,1119 @@ class TestModel(DbTestCase):
         return config.dataset
 
 
+@ddt.ddt
+class TestMemoryCache(unittest.TestCase):
+    now = 0
+
+    def clock(self):
+        return self.now
+
+    @ddt.data(*test_data.cache.expire)
+    @ddt.unpack
+    def test_expire(self, ttl, elapsed, hit):
+        cache = MemoryCache(ttl=ttl, clock=self.clock)
+        cache.set('key', 'value')
+
+        self.now += elapsed
+        self.assertEqual(cache.get('key'), 'value' if hit else None)
+        self.assertEqual(len(cache), 1 if hit else 0)
+
+    def test_lru(self):
+        cache = MemoryCache(maxsize=2)
+        cache.set('a', 1, ['song'])
+        cache.set('b', 2, ['song'])
+        cache.get('a')
+        cache.set('c', 3, ['song'])
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.tables, {'song': {'a', 'c'}})
+
+    @ddt.data(*test_data.cache.invalidate)
+    @ddt.unpack
+    def test_invalidate(self, entries, table, expected):
+        cache = MemoryCache()
+
+        for key, tables in entries.items():
+            cache.set(key, key, tables)
+
+        cache.invalidate(table)
+
+        self.assertEqual({k for k in entries if cache.get(k)}, expected)
+        self.assertNotIn(table, cache.tables)
+
+
+@ddt.ddt
+class TestQueryStats(unittest.TestCase):
+    @ddt.data(*test_data.hook.percentile)
+    @ddt.unpack
+    def test_percentile(self, timings, q, expected):
+        self.assertEqual(QueryStats.percentile(timings, q), expected)
+
+    def test_report(self):
+        stats = QueryStats(samples=2)
+
+        for elapsed, rowcount in [(0.1, 1), (0.2, 2), (0.3, 0)]:
+            event = QueryEvent([stats], 'SELECT %s, %s')
+            event.started -= elapsed
+            event.finish(rowcount)
+
+        QueryEvent([stats], 'SELECT 1').fail(Exception())
+
+        report = stats.report()
+
+        self.assertEqual([i['count'] for i in report], [3, 1])
+        self.assertEqual(report[0]['sql'], 'SELECT %s, %s')
+        self.assertEqual(report[0]['rows'], 3)
+        self.assertEqual(len(stats.data[report[0]['fingerprint']][4]), 2)
+        self.assertEqual((report[1]['sql'], report[1]['errors']),
+                         ('SELECT %s', 1))
+        self.assertEqual(len(stats.report(1)), 1)
+
+        stats.reset()
+        self.assertEqual(stats.report(), [])
+
+
+@ddt.ddt
+class TestSlowLog(unittest.TestCase):
+    @ddt.data(*test_data.hook.slow_log)
+    @ddt.unpack
+    def test_rate_limit(self, events, expected, suppressed):
+        now = [0]
+        log = SlowLog(threshold=0.5, interval=10, limit=2, logger=None,
+                      clock=lambda: now[0])
+
+        fast = QueryEvent([log], 'SELECT 0')
+        fast.finish()
+
+        for now[0], sql in events:
+            event = QueryEvent([log], sql)
+            event.started -= 1
+            event.finish()
+
+        self.assertEqual([(i['sql'], i['suppressed']) for i in log.entries],
+                         expected)
+        self.assertEqual(log.suppressed, suppressed)
+        self.assertIsNone(log.entries[0]['explain'])
+
+    def test_logger(self):
+        def run(log):
+            event = QueryEvent([log], 'SELECT 1')
+            event.started -= 1
+            event.finish()
+
+        with self.assertLogs('sqlrocks', 'WARNING') as logs:
+            run(SlowLog(threshold=0.5, explain=False))
+
+        self.assertIn('slow query', logs.output[0])
+
+        log = SlowLog(threshold=0.5, explain=False, logger=None)
+
+        with self.assertRaises(AssertionError):
+            with self.assertLogs(level='DEBUG'):
+                run(log)
+
+        self.assertEqual(len(log.entries), 1)
+
+
+class FakeDbTestCase(unittest.TestCase):
+    """
+    Test case backed by test_data.fake instead of a MySQL server
+    """
+    path = None
+    conns = None
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.conns = []
+
+    def tearDown(self):
+        for conn in self.conns:
+            if not conn.closed:
+                conn.close()
+        os.remove(self.path)
+
+    def connect(self):
+        conn = fake.connect(self.path)
+        self.conns.append(conn)
+        return conn
+
+    async def connect_async(self):
+        conn = await fake.connect_async(self.path)
+        self.conns.append(conn.conn)
+        return conn
+
+    def load(self, dataset):
+        conn = self.connect()
+        DbTestCase.create_dataset(conn, conn.cursor(), dataset)
+
+
+@ddt.ddt
+class TestPool(FakeDbTestCase):
+    def test_acquire_release(self):
+        pool = Pool(self.connect, min_size=1, max_size=2)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+        a = pool.acquire()
+        b = pool.acquire()
+        self.assertIsNot(a, b)
+        self.assertEqual(pool.stats()['in_use'], 2)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+        pool.release(a)
+        self.assertIs(pool.acquire(), a)
+
+        pool.release(a)
+        pool.release(b)
+        stats = pool.stats()
+        self.assertEqual((stats['in_use'], stats['idle']), (0, 2))
+        self.assertEqual(stats['wait_count'], 3)
+
+    def test_timeout(self):
+        pool = Pool(self.connect, max_size=1, timeout=0.05)
+        conn = pool.acquire()
+
+        self.assertRaises(PoolTimeout, pool.acquire)
+
+        threading.Timer(0.05, pool.release, [conn]).start()
+        self.assertIs(pool.acquire(1), conn)
+
+        waits = dict(pool.stats()['wait_histogram'])
+        self.assertEqual(sum(waits.values()), 3)
+        self.assertGreaterEqual(sum(waits[k] for k in waits if k >= 0.05), 2)
+
+    @ddt.data(*test_data.pool.health_check)
+    @ddt.unpack
+    def test_health_check(self, ping_idle, pings, replaced):
+        pool = Pool(self.connect, max_size=1, ping_idle=ping_idle)
+        conn = pool.acquire()
+        pool.release(conn)
+
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(conn.pings, pings)
+        pool.release(conn)
+
+        conn.broken = True
+
+        self.assertEqual(pool.acquire() is not conn, replaced)
+        self.assertEqual(conn.closed, replaced)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_max_lifetime(self):
+        pool = Pool(self.connect, max_lifetime=0.02)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+
+        time.sleep(0.03)
+        pool.release(conn)
+
+        self.assertTrue(conn.closed)
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_close(self):
+        pool = Pool(self.connect, min_size=2)
+        conn = pool.acquire()
+        pool.close()
+
+        self.assertEqual(sum(i.closed for i in self.conns), 1)
+        pool.release(conn)
+        self.assertTrue(all(i.closed for i in self.conns))
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+@ddt.ddt
+class TestPoolDb(FakeDbTestCase):
+    db = None
+    table = 'song'
+
+    def setUp(self):
+        super(TestPoolDb, self).setUp()
+        self.load(config.dataset)
+        self.db = PoolDb(self.connect, max_size=4, timeout=5)
+
+    def tearDown(self):
+        self.db.close()
+        super(TestPoolDb, self).tearDown()
+
+    @ddt.data(*test_data.model.get)
+    @ddt.unpack
+    def test_model(self, pk, expected):
+        class Song(Model):
+            table = self.table
+            db = self.db
+
+        self.assertEqual(Song.get(pk, fetch_obj=False), expected)
+        self.assertEqual(Song.count(), len(config.dataset[self.table]))
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_cache_race(self):
+        self.db.cache = MemoryCache()
+        sql = 'SELECT tag FROM song WHERE id = 1'
+
+        def read():
+            return self.db.execute(sql, cache=True).fetchone()['tag']
+
+        def read_in_thread():
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+
+        class Racing(Hook):
+            def before(self, event):
+                # a reader caches the old rows while the write runs
+                if event.sql.startswith('UPDATE'):
+                    read_in_thread()
+
+        self.db.add_hook(Racing())
+        self.db.update(self.table, {'tag': 'a'}, ('id', 1))
+        self.assertEqual(read(), 'a')
+
+        with self.db.transaction():
+            self.db.update(self.table, {'tag': 'b'}, ('id', 1))
+            read_in_thread()
+
+        self.assertEqual(read(), 'b')
+
+    def test_threads(self):
+        errors = []
+
+        def work(i):
+            try:
+                for j in range(10):
+                    self.db.insert(self.table, {'name': 'n%s-%s' % (i, j)})
+                    self.db.count(self.table)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.db.count(self.table, ('name', 'LIKE', 'n%')), 80)
+        self.assertLessEqual(self.db.pool.stats()['size'], 4)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_transaction(self):
+        total = self.db.count(self.table)
+
+        with self.db.transaction():
+            self.db.delete(self.table, ('id', 1))
+            self.assertEqual(self.db.pool.stats()['in_use'], 1)
+
+        self.assertEqual(self.db.count(self.table), total - 1)
+
+        with self.assertRaises(ZeroDivisionError):
+            with self.db.transaction():
+                self.db.delete(self.table)
+                1 / 0
+
+        self.assertEqual(self.db.count(self.table), total - 1)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_update_many_in_transaction(self):
+        rows = [{'id': 1, 'tag': 'rocks'}, {'id': 2, 'tag': 'rocks'}]
+
+        with self.assertRaises(ZeroDivisionError):
+            with self.db.transaction():
+                self.db.delete(self.table, ('id', 3))
+                self.assertEqual(self.db.update_many(self.table, rows), 2)
+                self.assertTrue(self.db.in_transaction())
+                1 / 0
+
+        self.assertFalse(self.db.in_transaction())
+        self.assertEqual(self.db.count(self.table, ('tag', 'rocks')), 0)
+        self.assertTrue(self.db.exists(self.table, ('id', 3)))
+
+    def test_iter(self):
+        rows = self.db.iter('SELECT id FROM song ORDER BY id', batch_size=2)
+
+        self.assertEqual(next(rows), {'id': 1})
+        self.assertEqual(self.db.pool.stats()['in_use'], 1)
+
+        rows.close()
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+        self.assertEqual(len(list(self.db.iter('SELECT * FROM song'))), 5)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_gather(self):
+        class Song(Model):
+            table = self.table
+            db = self.db
+
+        def slow():
+            time.sleep(0.2)
+            return Song.count()
+
+        start = time.time()
+        result = Song.gather(Song.select('id').where(('id', '<=', 2)),
+                             slow, slow, slow,
+                             Song.select('id').where(('id', 0)))
+
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual([i.id for i in result[0]], [1, 2])
+        self.assertEqual(result[1:4], [5, 5, 5])
+        self.assertEqual(result[4], [])
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+        with self.db.transaction():
+            self.db.delete(self.table, ('id', 1))
+            result = self.db.gather(Song.select('id'), Song.count)
+
+        self.assertEqual(len(result[0].fetchall()), 4)
+        self.assertEqual(result[1], 4)
+
+    def test_update_many(self):
+        rows = [{'id': i, 'tag': 't%s' % i} for i in range(1, 6)]
+        conn = self.db.pool.acquire()
+        self.db.pool.release(conn)
+        executed = len(conn.executed)
+
+        self.assertEqual(self.db.update_many(self.table, rows), 5)
+        self.assertEqual(len(conn.executed) - executed, 1)
+
+        rows = [dict(i, tag=i['tag'] * 2) for i in rows]
+        self.assertEqual(self.db.update_many(self.table, rows, case=False), 5)
+        self.assertEqual(self.db.count(self.table, ('tag', 'LIKE', 't_t_')), 5)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_gather_error(self):
+        with self.assertRaises(Exception):
+            self.db.gather(lambda: time.sleep(0.1),
+                           self.db.select().fr('nothing'))
+
+        with self.assertRaises(TimeoutError):
+            self.db.gather(lambda: time.sleep(0.3), lambda: 1, timeout=0.05)
+
+        with self.assertRaises(TimeoutError):
+            self.db.gather(lambda: time.sleep(0.3), timeout=0.05)
+
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.db.gather(lambda: 1, lambda: 2, timeout=1)
+
+        time.sleep(0.3)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_gather_timeout_per_query(self):
+        # 4 workers, the last 2 queries wait for a free one
+        result = self.db.gather(*[lambda: time.sleep(0.15) or 1] * 6,
+                                timeout=0.25)
+
+        self.assertEqual(result, [1] * 6)
+
+    def test_hooks(self):
+        class Song(Model):
+            table = self.table
+            db = self.db
+
+        class Recorder(Hook):
+            def __init__(self):
+                self.events = []
+
+            def before(self, event):
+                self.events.append(('before', event.sql))
+
+            def after(self, event):
+                self.events.append(('after', event.model))
+
+        stats = QueryStats()
+        recorder = Recorder()
+        self.db.add_hook(stats)
+        self.db.add_hook(recorder)
+
+        Song.get(1)
+        Song.get(2)
+        Song.count()
+        Song.update({'tag': 'hook'}, ('id', 'IN', [1, 2, 3]))
+        self.assertRaises(Exception, self.db.rocks, 'SELECT * FROM nothing')
+
+        report = {i['sql']: i for i in stats.report()}
+        get = report['SELECT * FROM song WHERE (id = %s)']
+
+        self.assertEqual((get['count'], get['models']), (2, ['Song']))
+        self.assertGreaterEqual(get['p99'], get['p50'])
+        self.assertEqual(report['UPDATE `song` SET `tag`=%s '
+                                'WHERE (id IN (%s, ...))']['rows'], 3)
+        self.assertEqual(report['SELECT * FROM nothing']['errors'], 1)
+        self.assertEqual(report['SELECT * FROM nothing']['models'], [])
+        self.assertEqual(recorder.events[:2], [
+            ('before', 'SELECT * FROM song WHERE (id = %s)'), ('after', Song)])
+
+        self.db.remove_hook(recorder)
+        Song.count()
+        self.assertEqual(len(recorder.events), 9)
+
+    @ddt.data(*test_data.db.count_approx)
+    @ddt.unpack
+    def test_count_approx(self, where, approx, max, expected):
+        stats = self.db.add_hook(QueryStats())
+
+        class Song(Model):
+            table = self.table
+            db = self.db
+
+        self.assertEqual(Song.count(where, approx=approx, max=max),
+                         expected[0])
+        self.assertEqual([i['sql'] for i in stats.report()], [expected[1]])
+
+    @ddt.data(*test_data.db.exists_select)
+    @ddt.unpack
+    def test_exists(self, where, expected):
+        stats = self.db.add_hook(QueryStats())
+
+        class Song(Model):
+            table = self.table
+            db = self.db
+
+        self.assertIs(Song.exists(where), expected)
+        self.assertTrue(stats.report()[0]['sql'].startswith(
+            'SELECT %s FROM `song`'))
+
+    def test_slow_log(self):
+        class Song(Model):
+            table = self.table
+            db = self.db
+
+        log = SlowLog(threshold=0, logger=None)
+        self.db.add_hook(log)
+
+        Song.all(where=('singer', 'Jay Chou'))
+        Song.all(where=('singer', 'Mayday'))
+        Song.update({'tag': 'slow'}, ('id', 1))
+
+        select, update = log.entries
+
+        self.assertEqual(select['sql'], 'SELECT * FROM song WHERE '
+                                        '(singer = %s)')
+        self.assertEqual(select['model'], 'Song')
+        self.assertTrue(select['explain'])
+        self.assertIsNone(update['explain'])
+        self.assertEqual(log.suppressed, 1)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_error(self):
+        self.assertRaises(Exception, self.db.rocks, 'SELECT * FROM nothing')
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+        self.assertEqual(self.db.rocks('SELECT * FROM song'), -1)
+        self.assertEqual(len(self.db.cur.fetchall()), 5)
+
+
+class TestSchema(FakeDbTestCase):
+    columns = ('id', 'name', 'singer', 'tag', 'is_published')
+
+    def setUp(self):
+        super(TestSchema, self).setUp()
+        self.conn = self.connect()
+        self.db = Db(self.conn, self.conn.cursor())
+        self.snapshot = self.path + '.json'
+
+    def tearDown(self):
+        if os.path.exists(self.snapshot):
+            os.remove(self.snapshot)
+        super(TestSchema, self).tearDown()
+
+    def model(self, schemas):
+        class Song(Model):
+            table = 'song'
+            db = self.db
+            introspect = True
+
+        Song.schemas = schemas
+        return Song
+
+    def introspected(self):
+        return sum(i.startswith('SHOW COLUMNS') for i in self.conn.executed)
+
+    def test_introspect(self):
+        song = self.model(SchemaCache())
+        schema = song.schema()
+
+        self.assertEqual(schema.columns, self.columns)
+        self.assertEqual(schema.fields, frozenset(self.columns))
+        self.assertEqual(schema.types['name'], 'varchar(256)')
+        self.assertEqual(schema.pk, 'id')
+
+        obj = song(name='schema')
+        obj.unknown = 1
+        obj.save()
+        song(name='schema').save()
+
+        self.assertEqual(song.field_set(), frozenset(self.columns))
+        self.assertEqual(song.count(('name', 'schema')), 2)
+        self.assertEqual(self.introspected(), 1)
+
+    def test_snapshot(self):
+        self.model(SchemaCache(self.snapshot)).schema()
+
+        with open(self.snapshot) as f:
+            self.assertEqual(json.load(f)['song']['columns'],
+                             list(self.columns))
+
+        song = self.model(SchemaCache(self.snapshot))
+
+        self.assertEqual(song.schema().columns, self.columns)
+        self.assertEqual(song.schema().pk, 'id')
+        self.assertEqual(self.introspected(), 1)
+
+    def test_from_rows(self):
+        rows = [('id', 'int(11)', 'NO', 'PRI', None, 'auto_increment'),
+                ('name', 'varchar(32)', 'NO', '', '', '')]
+        schema = Schema.from_rows('song', rows)
+
+        self.assertEqual(schema.columns, ('id', 'name'))
+        self.assertEqual(schema.types, {'id': 'int(11)',
+                                        'name': 'varchar(32)'})
+        self.assertEqual(schema.pk, 'id')
+
+
+class TestDefer(FakeDbTestCase):
+    def setUp(self):
+        super(TestDefer, self).setUp()
+        self.load(config.dataset)
+        self.conn = self.connect()
+        db = Db(self.conn, self.conn.cursor())
+
+        class Song(Model):
+            table = 'song'
+            db = None
+            defer = ('tag', 'singer')
+
+            @classmethod
+            def get_fields(cls):
+                return ['id', 'name', 'singer', 'tag', 'is_published']
+
+        Song.db = db
+        self.model = Song
+
+    def executed(self):
+        executed = self.conn.executed[:]
+        del self.conn.executed[:]
+        return executed
+
+    def test_projection(self):
+        self.assertEqual(self.model.projection(),
+                         ('`id`, `name`, `is_published`',
+                          frozenset(['tag', 'singer'])))
+        self.assertEqual(self.model.only('name').projection(),
+                         ('`id`, `name`', frozenset(['singer', 'tag',
+                                                     'is_published'])))
+        self.assertIs(self.model.only('name'), self.model.only('name'))
+
+        class Nothing(Model):
+            defer = ('body',)
+
+        self.assertRaises(ValueError, Nothing.projection)
+
+    def test_lazy_load(self):
+        songs = self.model.all(where=('id', '<=', 3))
+        self.assertNotIn('tag', songs[0]._row)
+        self.assertEqual(len(self.executed()), 1)
+
+        self.assertEqual(songs[1].tag, 'Chinese Style R&B')
+        self.assertEqual([i.tag for i in songs],
+                         ['Incomparable', 'Chinese Style R&B', ''])
+        self.assertEqual(songs[2]['singer'], 'kuga')
+        self.assertEqual(len(self.executed()), 2)
+
+        song = self.model.get(1)
+        self.assertEqual(song.singer, 'Jay Chou')
+        self.assertEqual(song.is_published, 1)
+        self.assertEqual(len(self.executed()), 2)
+        self.assertRaises(AttributeError, getattr, song, 'nothing')
+
+    def test_unsaved(self):
+        song = self.model(name='new')
+
+        self.assertEqual(getattr(song, 'tag', 'none'), 'none')
+        self.assertFalse(hasattr(song, 'singer'))
+        self.assertRaises(AttributeError, song.load_deferred, 'tag')
+        self.assertEqual(self.executed(), [])
+
+    def test_iter(self):
+        songs = list(self.model.iter(where=('id', '<=', 3), batch_size=2))
+
+        self.assertEqual([i.tag for i in songs],
+                         ['Incomparable', 'Chinese Style R&B', ''])
+        self.assertEqual(songs[2].singer, 'kuga')
+        self.assertEqual(len(self.executed()), 1)
+
+        songs = list(self.model.iter('id, name', ('id', '<=', 2)))
+
+        self.assertFalse(hasattr(songs[0], 'tag'))
+        self.assertEqual(len(self.executed()), 1)
+
+    def test_save(self):
+        song = self.model.first()
+        song.name = 'deferred'
+        self.assertEqual(song.save(), 1)
+        self.assertEqual(song.tag, 'Incomparable')
+
+        song.tag = 'rocks'
+        self.assertEqual(song.save(), 1)
+        self.assertEqual(self.model.get(1, '*').tag, 'rocks')
+
+    def test_compact(self):
+        self.model.compact = True
+        songs = self.model.only('name').all(where=('id', '<=', 2))
+
+        self.assertEqual([i.tag for i in songs],
+                         ['Incomparable', 'Chinese Style R&B'])
+        self.assertEqual(songs[0].name, 'Common Jasmin Orange')
+        self.assertEqual(songs[1]._row, {'id': 2, 'name': 'Hair Like Snow',
+                                         'tag': 'Chinese Style R&B'})
+        self.assertEqual(len(self.executed()), 2)
+
+        songs[0].tag = 'rocks'
+        self.assertEqual(songs[0].save(), 1)
+        self.assertEqual(songs[0].dirty_fields, set())
+        self.assertEqual(songs[0].tag, 'rocks')
+
+
+@ddt.ddt
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestColumns(FakeDbTestCase):
+    def setUp(self):
+        super(TestColumns, self).setUp()
+        self.load(config.dataset)
+        conn = self.connect()
+        self.db = Db(conn, conn.cursor())
+
+        class Song(Model):
+            table = 'song'
+            db = self.db
+
+        self.model = Song
+
+    @ddt.data(*test_data.db.column_array)
+    @ddt.unpack
+    def test_column_array(self, batches, dtype, expected):
+        column = ColumnArray(numpy, dtype, capacity=2)
+
+        for values in batches:
+            column.extend(values)
+
+        array = column.array()
+        data = array.data if expected[2] else array
+
+        self.assertEqual(str(array.dtype), expected[0])
+        self.assertEqual(data.tolist()[:len(expected[1])], expected[1])
+
+        if expected[2] is None:
+            self.assertNotIsInstance(array, numpy.ma.MaskedArray)
+        else:
+            self.assertEqual(array.mask.tolist(), expected[2])
+
+    def test_columns(self):
+        cursors = MySQLdb.cursors
+
+        for cursorclass in (cursors.SSCursor, cursors.SSDictCursor, None):
+            columns = self.model.columns(
+                ['id', 'name', 'is_published'], ('id', '<=', 4),
+                dtype_map={'is_published': bool}, batch_size=3,
+                cursorclass=cursorclass)
+
+            self.assertEqual(list(columns), ['id', 'name', 'is_published'])
+            self.assertEqual(columns['id'].dtype, numpy.int64)
+            self.assertEqual(columns['id'].tolist(), [1, 2, 3, 4])
+            self.assertEqual(columns['name'].dtype, object)
+            self.assertEqual(columns['name'][3], 'Love Story')
+            self.assertEqual(columns['is_published'].tolist(),
+                             [True, True, False, True])
+
+    def test_null(self):
+        columns = self.db.fetch_columns(
+            'SELECT CASE WHEN id > 3 THEN NULL ELSE singer END AS singer, '
+            'CASE WHEN id = 2 THEN NULL ELSE id * 1.5 END AS score '
+            'FROM song ORDER BY id', cursorclass=MySQLdb.cursors.SSCursor)
+
+        self.assertEqual(columns['singer'].mask.tolist(),
+                         [False, False, False, True, True])
+        self.assertEqual(columns['score'].dtype, numpy.float64)
+        self.assertEqual(columns['score'].sum(), 1.5 + 4.5 + 6 + 7.5)
+
+    def test_empty(self):
+        columns = self.model.columns(['id'], ('id', 0))
+        self.assertEqual(len(columns['id']), 0)
+
+
+@ddt.ddt
+class TestRoutingDb(FakeDbTestCase):
+    db = None
+    model = None
+    now = 0
+    paths = None
+    servers = None
+    table = 'song'
+
+    def setUp(self):
+        super(TestRoutingDb, self).setUp()
+        self.paths = [self.path]
+
+        for i in range(2):
+            fd, path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            self.paths.append(path)
+
+        self.servers = []
+
+        for path in self.paths:
+            conn = fake.connect(path)
+            self.conns.append(conn)
+            DbTestCase.create_dataset(conn, conn.cursor(), config.dataset)
+            self.servers.append(conn)
+
+        self.executed()
+        primary, replicas = self.servers[0], self.servers[1:]
+        self.db = RoutingDb(Db(primary, primary.cursor()),
+                            [Db(i, i.cursor()) for i in replicas],
+                            ryw_window=1, clock=lambda: self.now)
+
+        class Song(Model):
+            table = self.table
+            db = self.db
+
+        self.model = Song
+
+    def tearDown(self):
+        super(TestRoutingDb, self).tearDown()
+        for path in self.paths[1:]:
+            os.remove(path)
+
+    def executed(self):
+        counts = [len(i.executed) for i in self.servers]
+        for conn in self.servers:
+            del conn.executed[:]
+        return counts
+
+    @ddt.data(*test_data.db.route)
+    @ddt.unpack
+    def test_route(self, sql, replica):
+        self.assertEqual(self.db.route(sql) is not None, replica)
+
+    def test_round_robin(self):
+        self.model.get(1)
+        self.model.all()
+        self.model.count()
+        self.assertEqual(self.executed(), [0, 2, 1])
+        self.assertEqual(self.db.in_flight, [0, 0])
+
+    def test_least_busy(self):
+        self.db.strategy = 'least_busy'
+
+        with self.db.stream('SELECT * FROM song'):
+            self.model.get(1)
+            self.model.get(2)
+
+        self.assertEqual(self.executed(), [0, 1, 2])
+        self.assertEqual(self.db.in_flight, [0, 0])
+
+    def test_read_your_writes(self):
+        self.model.update({'tag': 'ryw'}, ('id', 1))
+        self.assertEqual(self.model.get(1).tag, 'ryw')
+        self.assertEqual(self.executed(), [2, 0, 0])
+
+        self.now += 1
+        self.assertEqual(self.model.get(1).tag, 'Incomparable')
+        self.assertEqual(self.executed(), [0, 1, 0])
+
+    def test_reads_do_not_pin(self):
+        self.db.execute('EXPLAIN SELECT * FROM song')
+        self.db.execute('SELECT 1')
+        self.assertEqual(self.executed(), [1, 1, 0])
+
+    def test_last_insert_id(self):
+        self.db.ryw_window = 0
+        self.model.add(name='new')
+
+        self.assertEqual(self.db.execute('SELECT LAST_INSERT_ID() AS id')
+                         .fetchone()['id'], 6)
+        self.assertEqual(self.executed(), [2, 0, 0])
+
+    def test_transaction(self):
+        with self.db.transaction():
+            self.model.get(1)
+            self.model.count()
+
+        with self.db.use_primary():
+            self.model.all()
+
+        self.assertEqual(self.executed(), [3, 0, 0])
+
+        self.now += 1
+        self.model.count()
+        self.assertEqual(self.executed(), [0, 1, 0])
+
+    def test_begin(self):
+        self.db.begin()
+        self.model.update({'tag': 'tx'}, ('id', 1))
+        self.db.begin()
+        self.db.commit()
+
+        self.now += 2
+        self.assertEqual(self.model.get(1).tag, 'tx')
+        self.db.commit()
+        self.model.count()
+        self.assertEqual(self.executed(), [3, 0, 0])
+
+        self.now += 1
+        self.model.count()
+        self.assertEqual(self.executed(), [0, 1, 0])
+
+        self.db.begin()
+        self.now += 2
+        self.model.count()
+        self.db.rollback()
+        self.assertEqual(self.executed(), [1, 0, 0])
+
+    def test_autocommit_off(self):
+        self.servers[0].get_autocommit = lambda: False
+        self.model.update({'tag': 'open'}, ('id', 1))
+
+        self.now += 2
+        self.assertEqual(self.model.get(1).tag, 'open')
+        self.db.commit()
+        self.assertEqual(self.executed(), [2, 0, 0])
+
+        self.now += 1
+        self.model.count()
+        self.assertEqual(self.executed(), [0, 1, 0])
+
+
+@ddt.ddt
+class TestAsyncDb(FakeDbTestCase):
+    db = None
+    model = None
+    table = 'song'
+
+    def setUp(self):
+        super(TestAsyncDb, self).setUp()
+        self.load(config.dataset)
+        self.db = AsyncDb(self.connect_async, max_size=3, timeout=5)
+
+        class Song(AsyncModel):
+            table = self.table
+            db = self.db
+
+            @classmethod
+            def get_fields(cls):
+                return {'id', 'name', 'singer', 'tag', 'is_published'}
+
+        self.model = Song
+
+    def tearDown(self):
+        asyncio.run(self.db.close())
+        super(TestAsyncDb, self).tearDown()
+
+    @ddt.data(*test_data.model.get)
+    @ddt.unpack
+    def test_get(self, pk, expected):
+        async def run():
+            return await self.model.get(pk, fetch_obj=False)
+
+        self.assertEqual(asyncio.run(run()), expected)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_bulk(self):
+        async def run():
+            result = await self.model.add_many(
+                [{'name': 'a%s' % i} for i in range(5)], chunk_rows=2)
+            self.assertEqual([i[0] for i in result], [2, 2, 1])
+
+            self.assertEqual(await self.model.upsert(
+                [{'id': 1, 'tag': 'up'}, {'id': 100, 'tag': 'up'}]), (1, 1))
+            self.assertEqual(await self.model.count(('tag', 'up')), 2)
+
+            rows = [{'id': i, 'tag': 'many'} for i in (1, 2, 3)]
+            self.assertEqual(await self.model.update_many(rows), 3)
+
+            objs = await self.model.all(where=('id', '<=', 2))
+            objs[0].tag = 'saved'
+            objs.append(self.model(name='new', tag='saved'))
+            self.assertEqual(await self.model.save_many(objs), (1, 1))
+            self.assertEqual([i.dirty_fields for i in objs], [set()] * 3)
+            self.assertIsNotNone(objs[2].id)
+
+            return await self.model.count(('tag', 'saved'))
+
+        self.assertEqual(asyncio.run(run()), 2)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_update_many_rollback(self):
+        async def run():
+            with self.assertRaises(ZeroDivisionError):
+                async with self.db.transaction():
+                    await self.model.add(name='rollback')
+                    await self.db.update_many(self.table, [
+                        {'id': 1, 'tag': 'x'}, {'id': 2, 'tag': 'y'}])
+                    1 / 0
+
+            return (await self.model.count(('name', 'rollback')),
+                    await self.model.count(('tag', 'IN', ['x', 'y'])))
+
+        self.assertEqual(asyncio.run(run()), (0, 0))
+
+    def test_scan(self):
+        async def run():
+            return [[i.id for i in batch]
+                    async for batch in self.model.scan(2, desc=True)]
+
+        self.assertEqual(asyncio.run(run()), [[5, 4], [3, 2], [1]])
+
+    def test_loader(self):
+        async def run():
+            loader = self.model.loader()
+            pending = [loader.load(pk) for pk in (1, 2, 9)]
+            rows = await asyncio.gather(*pending, loader.load(3))
+            self.assertEqual(await loader.load_many([3, 1]),
+                             [rows[3], rows[0]])
+            return loader.batches, rows
+
+        batches, rows = asyncio.run(run())
+
+        self.assertEqual(batches, 1)
+        self.assertEqual([i and i.id for i in rows], [1, 2, None, 3])
+
+    def test_gather(self):
+        async def slow():
+            await asyncio.sleep(0.3)
+
+        async def run():
+            result = await self.model.gather(
+                self.model.select().where(('id', 1)), self.model.count,
+                lambda: 1)
+            self.assertEqual(result[0][0].id, 1)
+            self.assertEqual(result[1:], [5, 1])
+
+            with self.assertRaises(TimeoutError):
+                await self.model.gather(slow, self.model.count, timeout=0.05)
+
+            async with self.db.transaction():
+                await self.model.delete(('id', 1))
+                return await self.model.gather(self.model.count,
+                                               self.model.count)
+
+        self.assertEqual(asyncio.run(run()), [4, 4])
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_defer(self):
+        class Song(self.model):
+            defer = ('tag',)
+
+        async def run():
+            song = await Song.get(1)
+            songs = await Song.all(where=('id', '<=', 2))
+            first = await Song.first()
+            rows = [i async for i in Song.iter(where=('id', 2))]
+            partial = await Song.get(1, 'id, name')
+            return song, songs, first, rows, partial
+
+        song, songs, first, rows, partial = asyncio.run(run())
+
+        self.assertEqual(song.tag, 'Incomparable')
+        self.assertEqual([i.tag for i in songs],
+                         ['Incomparable', 'Chinese Style R&B'])
+        self.assertEqual(first.tag, 'Incomparable')
+        self.assertEqual(rows[0].tag, 'Chinese Style R&B')
+        self.assertEqual(getattr(partial, 'tag', None), None)
+
+    def test_concurrent(self):
+        # the pool is built outside the loop, its condition in it
+        self.assertIsNone(self.db.pool.cond)
+
+        async def run():
+            pks = [i % 6 for i in range(60)]
+            rows = await asyncio.gather(*[self.model.get(i) for i in pks])
+            return pks, rows
+
+        pks, rows = asyncio.run(run())
+
+        self.assertEqual([i and i.id for i in rows],
+                         [i if i else None for i in pks])
+        self.assertLessEqual(self.db.pool.stats()['size'], 3)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    @ddt.data(*test_data.model.iter)
+    @ddt.unpack
+    def test_iter(self, where, order_by, limit, batch_size, expected):
+        async def run():
+            rows = self.model.iter('id', where, order_by, limit, batch_size)
+            return [row.id async for row in rows]
+
+        self.assertEqual(asyncio.run(run()), expected)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_save(self):
+        async def run():
+            obj = await self.model.first()
+            obj.tag = 'rocks'
+            self.assertEqual(await obj.save(), 1)
+            self.assertEqual(await obj.save(), 0)
+
+            pk = await self.model(singer='async').save()
+            self.assertEqual(await self.model.count(('singer', 'async')), 1)
+            self.assertEqual(await self.model.delete(('id', pk)), 1)
+
+            return await self.model.get(obj.id)
+
+        self.assertEqual(asyncio.run(run()).tag, 'rocks')
+
+    def test_transaction(self):
+        async def run():
+            total = await self.db.count(self.table)
+
+            async with self.db.transaction():
+                await self.model.delete(('id', 1))
+                self.assertEqual(self.db.pool.stats()['in_use'], 1)
+
+            with self.assertRaises(ZeroDivisionError):
+                async with self.db.transaction():
+                    await self.model.delete()
+                    1 / 0
+
+            return total, await self.db.count(self.table)
+
+        total, actual = asyncio.run(run())
+
+        self.assertEqual(actual, total - 1)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_load_schema(self):
+        class Song(AsyncModel):
+            table = self.table
+            db = self.db
+            introspect = True
+            schemas = SchemaCache()
+
+        self.assertRaises(RuntimeError, Song.schema)
+
+        async def run():
+            await Song.load_schema()
+            obj = Song(name='schema')
+            obj.unknown = 1
+            return await obj.save()
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertEqual(Song.schema().pk, 'id')
+
+    def test_timeout(self):
+        async def run():
+            pool = AsyncPool(self.connect_async, max_size=1, timeout=0.01)
+            conn = await pool.acquire()
+
+            with self.assertRaises(PoolTimeout):
+                await pool.acquire()
+
+            await pool.release(conn)
+            self.assertIs(await pool.acquire(), conn)
+
+        asyncio.run(run())
+
+
 if __name__ == '__main__':
     unittest.main()